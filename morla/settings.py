@@ -121,3 +121,24 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.10/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Data files (feature matrix snapshots etc.) written by the scripts in scripts/
+
+DATA_DIR = os.path.join(BASE_DIR, 'data')
+
+# Number of nearest neighbours compute_gramian.py keeps per article
+# (None keeps all pairs above the similarity cutoff)
+
+SIMILARITY_TOP_K = None
+
+# Update the classifier of a profile online on every label (see papers/online.py) and rescore
+# the given number of most recent articles
+
+ONLINE_LEARNING = False
+ONLINE_RESCORE_WINDOW = 2000
+
+# Save an online classifier after this many labels or seconds since its last save
+
+ONLINE_SAVE_EVERY = 10
+ONLINE_SAVE_INTERVAL = 60
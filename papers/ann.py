@@ -0,0 +1,158 @@
+""" Approximate nearest neighbours of articles with signed random projections.
+
+Every article is hashed to nb_tables keys of nb_bits bits. Bit b of a key is the sign of the
+projection of the (weighted) feature vector onto a random +-1 direction. Articles whose vectors
+have a small angle agree in most bits, so they end up in the same bucket of at least one table
+with high probability. Candidate pairs are the pairs of articles sharing a bucket and are scored
+exactly afterwards.
+
+The random directions are never stored: the entry of a direction for a feature column is
+derived from a hash of the column index, the direction number and the seed. The index itself
+(article ids and keys) is kept as .npy files in DATA_DIR/ann, new articles are appended.
+"""
+import os
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from scipy import sparse
+
+from django.conf import settings
+
+from papers.feature_store import append_npy
+
+
+def get_index_dir():
+    return os.path.join(settings.DATA_DIR, 'ann')
+
+
+def mix64(x):
+    """ The splitmix64 finalizer, a fast and well mixing hash of uint64 arrays """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+class RandomProjectionIndex(object):
+    """ Locality sensitive hash index of weighted feature vectors """
+
+    def __init__(self, path=None, nb_tables=16, nb_bits=8, seed=42):
+        self.path = path or get_index_dir()
+        self.meta = dict(nb_tables=nb_tables, nb_bits=nb_bits, seed=seed)
+        self.article_ids = np.zeros(0, dtype=np.int64)
+        self.keys = np.zeros((0, nb_tables), dtype=np.int64)
+        if os.path.exists(self.filename('meta.json')):
+            with open(self.filename('meta.json')) as f:
+                self.meta = json.load(f)
+            self.article_ids = np.load(self.filename('article_ids.npy'))
+            self.keys = np.load(self.filename('keys.npy'))[:len(self.article_ids)]
+        self.nb_tables = self.meta['nb_tables']
+        self.nb_bits = self.meta['nb_bits']
+        self.seed = self.meta['seed']
+
+    def filename(self, name):
+        return os.path.join(self.path, name)
+
+    def __len__(self):
+        return len(self.article_ids)
+
+    def projections(self, columns, directions):
+        """ Returns the +-1 entries of the given random directions for the given feature columns """
+        with np.errstate(over='ignore'):
+            h = columns.astype(np.uint64)[:,None]*np.uint64(0x9e3779b97f4a7c15) + np.uint64(self.seed)
+            h = mix64(h ^ mix64(np.asarray(directions, dtype=np.uint64)[None,:] + np.uint64(1)))
+        return np.where(h >> np.uint64(63), 1.0, -1.0).astype(np.float32)
+
+    def hash(self, X, chunk_size=16):
+        """ Computes the keys (one per table) of the rows of the weighted feature matrix X """
+        X = sparse.csr_matrix(X)
+        columns, inverse = np.unique(X.indices, return_inverse=True)
+        Xc = sparse.csr_matrix( (X.data.astype(np.float32), inverse, X.indptr), shape=(X.shape[0], len(columns)) )
+
+        nb_directions = self.nb_tables*self.nb_bits
+        bits = np.zeros((X.shape[0], nb_directions), dtype=bool)
+        for k in range(0, nb_directions, chunk_size):
+            directions = np.arange(k, min(k+chunk_size, nb_directions))
+            bits[:,directions] = Xc.dot(self.projections(columns, directions)) > 0
+
+        weights = np.int64(1) << np.arange(self.nb_bits, dtype=np.int64)
+        return bits.reshape(X.shape[0], self.nb_tables, self.nb_bits).dot(weights)
+
+    def add(self, article_ids, X):
+        """ Hashes the weighted feature vectors X of the given articles and appends them to the index
+
+        An article which is already in the index is superseded by the new entry.
+        """
+        keys = self.hash(X)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        n = len(self.article_ids)
+        append_npy(self.filename('keys.npy'), keys, start=n)
+        append_npy(self.filename('article_ids.npy'), np.asarray(article_ids, dtype=np.int64), start=n)
+        with open(self.filename('meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+        self.article_ids = np.concatenate((self.article_ids, np.asarray(article_ids, dtype=np.int64)))
+        self.keys = np.concatenate((self.keys, keys))
+
+    def clear(self):
+        for name in ['meta.json', 'article_ids.npy', 'keys.npy']:
+            if os.path.exists(self.filename(name)):
+                os.remove(self.filename(name))
+        self.article_ids = np.zeros(0, dtype=np.int64)
+        self.keys = np.zeros((0, self.nb_tables), dtype=np.int64)
+
+    def latest_rows(self):
+        """ Returns the rows of the index which are not superseded by a later entry """
+        order = np.argsort(self.article_ids[::-1], kind='stable')
+        rows = len(self.article_ids)-1-order
+        sorted_ids = self.article_ids[rows]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = sorted_ids[1:] != sorted_ids[:-1]
+        return np.sort(rows[first])
+
+    def candidate_pairs(self, new_article_ids=None, max_bucket_size=500):
+        """ Returns the pairs (as two arrays of article ids) of articles which share a bucket
+
+        With new_article_ids only pairs involving at least one of these articles are returned.
+        Buckets larger than max_bucket_size are split into chunks to bound the number of pairs.
+        """
+        rows = self.latest_rows()
+        ids = self.article_ids[rows]
+        is_new = None if new_article_ids is None else np.isin(ids, new_article_ids)
+
+        pairs = []
+        for t in range(self.nb_tables):
+            keys = self.keys[rows, t]
+            order = np.argsort(keys, kind='stable')
+            sorted_keys = keys[order]
+            starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+            sizes = np.diff(np.r_[starts, len(keys)])
+
+            # Split large buckets into chunks of at most max_bucket_size articles
+            nb_chunks = (sizes+max_bucket_size-1)//max_bucket_size
+            chunk_starts = np.repeat(starts, nb_chunks) + max_bucket_size*(np.arange(nb_chunks.sum()) - np.repeat(np.cumsum(nb_chunks)-nb_chunks, nb_chunks))
+            chunk_sizes = np.minimum(np.repeat(starts+sizes, nb_chunks) - chunk_starts, max_bucket_size)
+
+            for size in np.unique(chunk_sizes[chunk_sizes > 1]):
+                first, second = np.triu_indices(size, 1)
+                s = chunk_starts[chunk_sizes==size][:,None]
+                a, b = order[(s+first).ravel()], order[(s+second).ravel()]
+                if is_new is not None:
+                    sel = is_new[a] | is_new[b]
+                    a, b = a[sel], b[sel]
+                pairs.append(np.minimum(a, b)*len(ids) + np.maximum(a, b))
+
+        if not pairs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        pairs = np.unique(np.concatenate(pairs))
+        return ids[pairs//len(ids)], ids[pairs%len(ids)]
+
+
+def score_pairs(X, a, b, chunk_size=100000):
+    """ Computes the scalar products of the rows a and b of the weighted feature matrix X """
+    X = sparse.csr_matrix(X)
+    scores = np.zeros(len(a))
+    for k in range(0, len(a), chunk_size):
+        scores[k:k+chunk_size] = np.asarray(X[a[k:k+chunk_size]].multiply(X[b[k:k+chunk_size]]).sum(axis=1)).ravel()
+    return scores
@@ -0,0 +1,215 @@
+""" Dense low-rank embeddings of articles.
+
+A truncated SVD is fitted on the weighted features (see feature_store.get_weighted_features) of a
+sample of articles. To keep the components small only the max_columns columns with the highest
+document frequency in the sample are used. The embedding of an article is the projection of its
+weighted feature vector onto the components, so that scalar products of embeddings approximate
+the weighted similarities and the Gramian and the scoring of candidates become dense matrix
+products.
+
+The columns and components of the fit and the float32 embeddings of all articles are kept as .npy
+files in DATA_DIR/embeddings. Like the feature snapshot the embeddings are opened with
+mmap_mode='r' and the embeddings of new feature vectors are appended (see EmbeddingIndex.sync).
+"""
+import os
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from scipy import sparse
+from sklearn.decomposition import TruncatedSVD
+
+from django.conf import settings
+from django.utils import timezone
+
+import papers.utils as utils
+import papers.feature_store as feature_store
+from papers.feature_store import append_npy
+
+
+embedding_dtype = np.dtype('<f4')
+
+
+def get_embedding_dir():
+    return os.path.join(settings.DATA_DIR, 'embeddings')
+
+
+class EmbeddingIndex(object):
+    """ The fitted projection and the embeddings of all articles in a directory """
+
+    def __init__(self, path=None):
+        self.path = path or get_embedding_dir()
+        self.reload()
+
+    def filename(self, name):
+        return os.path.join(self.path, name)
+
+    def exists(self):
+        return os.path.exists(self.filename('meta.json'))
+
+    def reload(self):
+        """ (Re)opens the fit and the memory-mapped embeddings """
+        self.meta = {}
+        self.columns = np.zeros(0, dtype=np.int64)
+        self.components = np.zeros((0, 0), dtype=embedding_dtype)
+        self.article_ids = np.zeros(0, dtype=np.int64)
+        self.embeddings = np.zeros((0, 0), dtype=embedding_dtype)
+        self.column_lookup = None
+        self.mtime = None
+        if self.exists():
+            self.mtime = os.path.getmtime(self.filename('meta.json'))
+            with open(self.filename('meta.json')) as f:
+                self.meta = json.load(f)
+            self.columns = np.load(self.filename('columns.npy'))
+            self.components = np.load(self.filename('components.npy'), mmap_mode='r')
+            if os.path.exists(self.filename('article_ids.npy')):
+                article_ids = np.load(self.filename('article_ids.npy'), mmap_mode='r')
+                embeddings = np.load(self.filename('embeddings.npy'), mmap_mode='r')
+                n = min(len(article_ids), len(embeddings))
+                self.article_ids = article_ids[:n]
+                self.embeddings = embeddings[:n]
+
+        # Map article ids to the latest row which holds their embedding
+        order = np.argsort(self.article_ids, kind='stable')
+        sorted_ids = np.asarray(self.article_ids[order])
+        latest = np.ones(len(sorted_ids), dtype=bool)
+        latest[:-1] = sorted_ids[1:] != sorted_ids[:-1]
+        self.ids = sorted_ids[latest]
+        self.rows = order[latest]
+
+    def reload_if_changed(self):
+        if self.exists() and os.path.getmtime(self.filename('meta.json')) != self.mtime:
+            self.reload()
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nb_components(self):
+        return self.components.shape[0]
+
+    def fit(self, article_ids, n_components=128, max_columns=2**16, min_df=2, sample_size=100000):
+        """ Fits the truncated SVD on a sample of the given articles and drops all embeddings
+
+        Call sync() afterwards to compute the embeddings of all articles.
+        """
+        article_ids = np.asarray(article_ids, dtype=np.int64)
+        if len(article_ids) > sample_size:
+            article_ids = np.sort(np.random.choice(article_ids, size=sample_size, replace=False))
+        X = feature_store.get_weighted_features(article_ids)
+
+        df = np.bincount(X.indices, minlength=X.shape[1])
+        columns = np.flatnonzero(df >= min_df)
+        if len(columns) > max_columns:
+            columns = np.sort(columns[np.argsort(-df[columns], kind='stable')[:max_columns]])
+        n_components = min(n_components, len(columns)-1)
+        logger.info("Fitting %i components on %i articles and %i columns"%(n_components, len(article_ids), len(columns)))
+
+        svd = TruncatedSVD(n_components=n_components, random_state=42)
+        svd.fit(X[:,columns])
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        for name in ['meta.json', 'article_ids.npy', 'embeddings.npy']:
+            if os.path.exists(self.filename(name)):
+                os.remove(self.filename(name))
+        np.save(self.filename('columns.npy'), columns.astype(np.int64))
+        np.save(self.filename('components.npy'), svd.components_.astype(embedding_dtype))
+        self.meta = { 'nb_columns' : utils.get_feature_vector_size(), 'nb_articles_fitted' : len(article_ids),
+                'explained_variance' : float(svd.explained_variance_ratio_.sum()),
+                'date_fitted' : timezone.now().isoformat() }
+        self.save_meta()
+        self.reload()
+        return self.meta['explained_variance']
+
+    def transform(self, X):
+        """ Projects the (unweighted) feature matrix X onto the components """
+        if self.column_lookup is None:
+            self.column_lookup = -np.ones(self.meta['nb_columns'], dtype=np.int64)
+            self.column_lookup[self.columns] = np.arange(len(self.columns))
+        X = sparse.csr_matrix(X)
+        positions = self.column_lookup[X.indices]
+        keep = positions >= 0
+        rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+        indptr = np.zeros(X.shape[0]+1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[keep], minlength=X.shape[0]), out=indptr[1:])
+        weights = np.sqrt(utils.get_column_weights(self.columns))
+        Xc = sparse.csr_matrix( (X.data[keep]*weights[positions[keep]], positions[keep], indptr), shape=(X.shape[0], len(self.columns)) )
+        return np.asarray(Xc.dot(np.asarray(self.components).T), dtype=embedding_dtype)
+
+    def append(self, article_ids, embeddings):
+        if not os.path.exists(self.filename('article_ids.npy')):
+            np.save(self.filename('article_ids.npy'), np.zeros(0, dtype=np.int64))
+            np.save(self.filename('embeddings.npy'), np.zeros((0, self.nb_components), dtype=embedding_dtype))
+        n = min(len(np.load(self.filename('article_ids.npy'), mmap_mode='r')), len(np.load(self.filename('embeddings.npy'), mmap_mode='r')))
+        append_npy(self.filename('embeddings.npy'), np.asarray(embeddings, dtype=embedding_dtype), start=n)
+        append_npy(self.filename('article_ids.npy'), np.asarray(article_ids, dtype=np.int64), start=n)
+
+    def save_meta(self, **kwargs):
+        self.meta.update(kwargs)
+        with open(self.filename('meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+
+    def sync(self, chunk_size=10000):
+        """ Projects all feature vectors computed since the last sync and appends their embeddings
+
+        returns the number of appended rows
+        """
+        if not self.exists():
+            raise ValueError("The embedding index in %s has not been fitted"%self.path)
+        count = 0
+        for article_ids in feature_store.iter_unsynced_ids(self.meta, chunk_size):
+            self.append(article_ids, self.transform(feature_store.get_features(article_ids)))
+            count += len(article_ids)
+
+        self.save_meta()
+        self.reload()
+        return count
+
+    def lookup(self, article_ids):
+        """ Returns the rows of the given article ids (-1 if not contained) """
+        article_ids = np.asarray(article_ids, dtype=np.int64)
+        if not len(self.ids):
+            return -np.ones(len(article_ids), dtype=np.int64)
+        pos = np.clip(np.searchsorted(self.ids, article_ids), 0, len(self.ids)-1)
+        return np.where(self.ids[pos]==article_ids, self.rows[pos], -1)
+
+    def get_embeddings(self, article_ids):
+        """ Returns the embeddings of the given articles as a dense (len(article_ids), nb_components) array
+
+        Articles without a stored embedding or whose feature vectors were computed after the last
+        sync are projected from their features.
+        """
+        article_ids = np.asarray(article_ids, dtype=np.int64)
+        rows = self.lookup(article_ids)
+        rows[np.isin(article_ids, feature_store.get_unsynced_ids(self.meta))] = -1
+        E = np.zeros((len(article_ids), self.nb_components), dtype=embedding_dtype)
+        E[rows >= 0] = self.embeddings[rows[rows >= 0]]
+        missing = np.flatnonzero(rows < 0)
+        if len(missing):
+            logger.debug("%i articles without embedding, projecting their features"%len(missing))
+            E[missing] = self.transform(feature_store.get_features(article_ids[missing]))
+        return E
+
+
+_index = None
+
+def get_embedding_index():
+    """ Returns the shared embedding index of this process or None if no index has been fitted """
+    global _index
+    if _index is None:
+        _index = EmbeddingIndex()
+    else:
+        _index.reload_if_changed()
+    if not _index.exists():
+        return None
+    return _index
+
+
+def get_embeddings(articles):
+    """ Returns the embeddings of the given articles """
+    index = get_embedding_index()
+    if index is None:
+        raise ValueError("No embedding index in %s, run update_embeddings.py --fit"%get_embedding_dir())
+    return index.get_embeddings(utils.get_article_ids(articles))
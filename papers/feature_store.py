@@ -0,0 +1,406 @@
+""" Memory-mapped snapshot of the feature matrix.
+
+The snapshot keeps the CSR arrays of the feature matrix (indptr, indices, data) and the article id
+of every row as .npy files in DATA_DIR/features. The files are opened with mmap_mode='r', so that
+scripts and web workers share one page-cache copy and only touch the rows they actually read.
+New feature vectors are appended in place. A row appended for an article which is already in the
+snapshot supersedes the older row.
+"""
+import io
+import os
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from scipy import sparse
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+from papers.models import FeatureVector
+import papers.utils as utils
+
+
+def get_snapshot_dir():
+    return os.path.join(settings.DATA_DIR, 'features')
+
+
+def append_npy(filename, values, start=None):
+    """ Appends values along the first axis of a .npy file without rewriting the existing data
+
+    The values are written at index start (default: the current end of the array). Readers may
+    have the file memory-mapped, so it is never truncated: if start discards data behind it
+    (the leftovers of an interrupted append) or the new header does not fit into the space of
+    the old one, a new file is written and replaces the old one. Otherwise the values are
+    written behind the existing data and the array header is rewritten in place.
+    """
+    values = np.ascontiguousarray(values)
+    if not os.path.exists(filename):
+        np.save(filename, values)
+        return
+
+    with open(filename, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+        if dtype != values.dtype or shape[1:] != values.shape[1:]:
+            raise ValueError("Cannot append %s%s to %s%s in %s"%(values.dtype, values.shape, dtype, shape, filename))
+
+        if start is None:
+            start = shape[0]
+        header = io.BytesIO()
+        d = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (start+len(values),)+shape[1:]}
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, d)
+        else:
+            np.lib.format.write_array_header_2_0(header, d)
+
+        row_size = int(np.prod(shape[1:]))*dtype.itemsize
+        end = offset + start*row_size
+        if len(header.getvalue()) == offset and start == shape[0] and os.fstat(f.fileno()).st_size == end:
+            f.seek(end)
+            f.write(values.tobytes())
+            f.flush()
+            f.seek(0)
+            f.write(header.getvalue())
+            return
+
+    logger.info("Rewriting %s"%filename)
+    # Replace the file instead of truncating it, which would break the memory maps of readers
+    old = np.load(filename, mmap_mode='r')
+    np.save(filename+'.tmp.npy', np.concatenate((old[:start], values)))
+    del old
+    os.replace(filename+'.tmp.npy', filename)
+
+
+def save_shared_matrix(path, name, X):
+    """ Stores a CSR matrix (its arrays) or a dense array as .npy files to be memory-mapped by other processes """
+    if not sparse.issparse(X):
+        np.save(os.path.join(path, '%s_dense.npy'%name), np.asarray(X))
+        return
+    X = sparse.csr_matrix(X)
+    for field in ('data', 'indices', 'indptr'):
+        np.save(os.path.join(path, '%s_%s.npy'%(name, field)), getattr(X, field))
+
+
+def load_shared_matrix(path, name, nb_columns=None):
+    """ Opens a matrix stored with save_shared_matrix read-only (a CSR matrix can be widened to nb_columns) """
+    if os.path.exists(os.path.join(path, '%s_dense.npy'%name)):
+        return np.load(os.path.join(path, '%s_dense.npy'%name), mmap_mode='r')
+    data, indices, indptr = [ np.load(os.path.join(path, '%s_%s.npy'%(name, field)), mmap_mode='r')
+            for field in ('data', 'indices', 'indptr') ]
+    if nb_columns is None:
+        nb_columns = int(indices.max())+1 if len(indices) else 0
+    return sparse.csr_matrix( (data, indices, indptr), shape=(len(indptr)-1, nb_columns) )
+
+
+def get_synced_until(meta):
+    last = parse_datetime(meta['synced_until']) if meta.get('synced_until') else None
+    return last, set(meta.get('synced_ids', []))
+
+
+def iter_unsynced_ids(meta, chunk_size=10000):
+    """ Yields chunks of the article ids of the feature vectors computed after the sync recorded in meta
+
+    Feature vectors committed later may carry the timestamp of the last synced one, so the rows at
+    that timestamp are read again and the ids in meta['synced_ids'] are skipped. meta['synced_until']
+    and meta['synced_ids'] are advanced when the caller asks for the next chunk, i.e. after it has
+    stored the last one.
+    """
+    qs = FeatureVector.objects.order_by('date_computed', 'article_id')
+    last, last_ids = get_synced_until(meta)
+    if last is not None:
+        qs = qs.filter(date_computed__gte=last)
+    meta.setdefault('synced_until', None)
+    meta.setdefault('synced_ids', [])
+
+    rows = qs.values_list('article_id', 'date_computed').iterator()
+    while True:
+        chunk = [ r for _, r in zip(range(chunk_size), rows) ]
+        if not chunk:
+            break
+        chunk = [ r for r in chunk if r[1] != last or r[0] not in last_ids ]
+        if not chunk:
+            continue
+        yield np.array([ r[0] for r in chunk ], dtype=np.int64)
+        for article_id, date_computed in chunk:
+            if date_computed != last:
+                last, last_ids = date_computed, set()
+            last_ids.add(int(article_id))
+        meta.update( synced_until=last.isoformat(), synced_ids=sorted(last_ids) )
+
+
+def get_unsynced_ids(meta):
+    """ Returns the sorted article ids of the feature vectors computed after the sync recorded in meta """
+    last, last_ids = get_synced_until(meta)
+    if last is None:
+        return np.zeros(0, dtype=np.int64)
+    rows = FeatureVector.objects.filter(date_computed__gte=last).values_list('article_id', 'date_computed')
+    return np.array(sorted( a for a, d in rows if d != last or a not in last_ids ), dtype=np.int64)
+
+
+class FeatureSnapshot(object):
+    """ Read and append access to the feature matrix snapshot in a directory """
+
+    def __init__(self, path=None):
+        self.path = path or get_snapshot_dir()
+        self.reload()
+
+    def filename(self, name):
+        return os.path.join(self.path, name)
+
+    def exists(self):
+        return os.path.exists(self.filename('meta.json'))
+
+    def reload(self):
+        """ (Re)opens the memory-mapped arrays and rebuilds the article id to row map """
+        self.meta = {}
+        self.article_ids = np.zeros(0, dtype=np.int64)
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=utils.feature_index_dtype)
+        self.data = np.zeros(0, dtype=utils.feature_value_dtype)
+        self.mtime = None
+        if self.exists():
+            self.mtime = os.path.getmtime(self.filename('meta.json'))
+            with open(self.filename('meta.json')) as f:
+                self.meta = json.load(f)
+            # Only use the rows covered by all four files in case an append is in progress
+            article_ids = np.load(self.filename('article_ids.npy'), mmap_mode='r')
+            indptr = np.load(self.filename('indptr.npy'), mmap_mode='r')
+            n = min(len(article_ids), len(indptr)-1)
+            self.article_ids = article_ids[:n]
+            self.indptr = indptr[:n+1]
+            self.indices = np.load(self.filename('indices.npy'), mmap_mode='r')
+            self.data = np.load(self.filename('data.npy'), mmap_mode='r')
+
+        # Map article ids to the latest row which holds their feature vector
+        order = np.argsort(self.article_ids, kind='stable')
+        sorted_ids = np.asarray(self.article_ids[order])
+        latest = np.ones(len(sorted_ids), dtype=bool)
+        latest[:-1] = sorted_ids[1:] != sorted_ids[:-1]
+        self.ids = sorted_ids[latest]
+        self.rows = order[latest]
+
+    def reload_if_changed(self):
+        if self.exists() and os.path.getmtime(self.filename('meta.json')) != self.mtime:
+            self.reload()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, article_ids):
+        """ Returns the rows of the given article ids in the snapshot (-1 if not contained) """
+        article_ids = np.asarray(article_ids, dtype=np.int64)
+        if not len(self.ids):
+            return -np.ones(len(article_ids), dtype=np.int64)
+        pos = np.clip(np.searchsorted(self.ids, article_ids), 0, len(self.ids)-1)
+        return np.where(self.ids[pos]==article_ids, self.rows[pos], -1)
+
+    def get_rows(self, rows):
+        """ Gathers the given rows (-1 for an empty row) into a CSR matrix """
+        rows = np.asarray(rows, dtype=np.int64)
+        valid = rows >= 0
+        starts = np.where(valid, self.indptr[np.maximum(rows, 0)], 0)
+        counts = np.where(valid, self.indptr[np.maximum(rows, 0)+1] - starts, 0)
+        indptr = np.zeros(len(rows)+1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        gather = np.repeat(starts-indptr[:-1], counts) + np.arange(indptr[-1])
+        return sparse.csr_matrix( (self.data[gather].astype(np.float64), self.indices[gather], indptr),
+                shape=(len(rows), utils.get_feature_vector_size()) )
+
+    def get_matrix(self, article_ids, exclude=None):
+        """ Returns the feature matrix for the given article ids and a mask of the ids which are missing
+
+        The rows of the ids in exclude (e.g. the ones recomputed since the last sync) are left empty
+        and marked as missing.
+        """
+        rows = self.lookup(article_ids)
+        if exclude is not None and len(exclude):
+            rows[np.isin(article_ids, exclude)] = -1
+        return self.get_rows(rows), rows < 0
+
+    def append(self, article_ids, features):
+        """ Appends feature vectors (CSR matrix with one row per article id) to the snapshot """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        features = sparse.csr_matrix(features)
+        features.sort_indices()
+        if not os.path.exists(self.filename('article_ids.npy')):
+            for name, dtype in [('article_ids', np.int64), ('indptr', np.int64), ('indices', utils.feature_index_dtype), ('data', utils.feature_value_dtype)]:
+                np.save(self.filename(name+'.npy'), np.zeros(1 if name=='indptr' else 0, dtype=dtype))
+        # Write behind the last complete row, which drops the leftovers of an interrupted append
+        indptr = np.load(self.filename('indptr.npy'), mmap_mode='r')
+        n = min(len(indptr)-1, len(np.load(self.filename('article_ids.npy'), mmap_mode='r')))
+        nnz = int(indptr[n])
+        del indptr
+        append_npy(self.filename('indices.npy'), features.indices.astype(utils.feature_index_dtype), start=nnz)
+        append_npy(self.filename('data.npy'), features.data.astype(utils.feature_value_dtype), start=nnz)
+        append_npy(self.filename('indptr.npy'), (nnz + features.indptr[1:]).astype(np.int64), start=n+1)
+        append_npy(self.filename('article_ids.npy'), np.asarray(article_ids, dtype=np.int64), start=n)
+
+    def save_meta(self, **kwargs):
+        self.meta.update(kwargs)
+        with open(self.filename('meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+
+    def sync(self, chunk_size=10000):
+        """ Appends all feature vectors computed since the last sync from the database
+
+        returns the number of appended rows
+        """
+        count = 0
+        for article_ids in iter_unsynced_ids(self.meta, chunk_size):
+            self.append(article_ids, utils.get_features_from_db(article_ids))
+            count += len(article_ids)
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.save_meta(nb_columns=utils.get_feature_vector_size())
+        self.reload()
+        return count
+
+    def rebuild(self):
+        """ Removes the snapshot and recreates it from the database """
+        for name in ['meta.json', 'article_ids.npy', 'indptr.npy', 'indices.npy', 'data.npy']:
+            if os.path.exists(self.filename(name)):
+                os.remove(self.filename(name))
+        self.reload()
+        return self.sync()
+
+    def check(self, sample_size=100):
+        """ Compares the snapshot with the feature vectors in the database
+
+        All articles are compared by their number of nonzero features, the full vectors are
+        compared for a random sample of sample_size articles.
+
+        returns a dict with the arrays of article ids which are missing in the snapshot,
+        are not in the database anymore or are stale
+        """
+        db = np.array(list(FeatureVector.objects.values_list('article_id', 'nnz')), dtype=np.int64).reshape(-1, 2)
+        db_ids, db_nnz = db[:,0], db[:,1]
+
+        rows = self.lookup(db_ids)
+        contained = rows >= 0
+        rows = rows[contained]
+        nnz = self.indptr[rows+1] - self.indptr[rows]
+        stale = db_ids[contained][nnz != db_nnz[contained]]
+
+        common = db_ids[contained]
+        if len(common):
+            sample = np.random.choice(common, size=min(sample_size, len(common)), replace=False)
+            A = utils.get_features_from_db(sample)
+            B, _ = self.get_matrix(sample)
+            differs = np.asarray(abs(A-B).max(axis=1).todense()).ravel() > 0
+            stale = np.union1d(stale, sample[differs])
+
+        return { 'missing' : db_ids[~contained],
+                 'deleted' : np.setdiff1d(self.ids, db_ids),
+                 'stale' : stale }
+
+
+class ColumnMap(object):
+    """ Persisted renumbering of the active hashed feature columns to a dense range 0..K-1
+
+    Only a small fraction of the hashed columns is ever used by the corpus. The map stores the
+    hashed column of every compact column in columns.npy. Columns which appear for the first time
+    are appended, so the compact numbers of known columns never change and matrices compacted
+    earlier only need to be widened (see resize).
+    """
+
+    def __init__(self, path=None):
+        self.path = path or get_snapshot_dir()
+        self.filename = os.path.join(self.path, 'columns.npy')
+        self.lookup = -np.ones(utils.get_feature_vector_size(), dtype=np.int32)
+        self.columns = np.zeros(0, dtype=np.int32)
+        if os.path.exists(self.filename):
+            self.columns = np.load(self.filename)
+            self.lookup[self.columns] = np.arange(len(self.columns), dtype=np.int32)
+
+    def __len__(self):
+        return len(self.columns)
+
+    def update(self, indices, chunk_size=10**7):
+        """ Adds the hashed columns which occur in indices (an index array or CSR matrix) to the map
+
+        returns the number of new columns
+        """
+        if sparse.issparse(indices):
+            indices = sparse.csr_matrix(indices).indices
+        new = []
+        for k in range(0, len(indices), chunk_size):
+            cols = np.unique(indices[k:k+chunk_size])
+            new.append(cols[self.lookup[cols] < 0])
+        new = np.unique(np.concatenate(new)).astype(np.int32) if new else np.zeros(0, dtype=np.int32)
+        if len(new):
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            self.lookup[new] = np.arange(len(self.columns), len(self.columns)+len(new), dtype=np.int32)
+            self.columns = np.concatenate((self.columns, new))
+            append_npy(self.filename, new, start=len(self.columns)-len(new))
+        return len(new)
+
+    def transform(self, X):
+        """ Renumbers the columns of the feature matrix X to the compact column space """
+        X = sparse.csr_matrix(X)
+        indices = self.lookup[X.indices]
+        if (indices < 0).any():
+            raise ValueError("Feature matrix contains columns which are not in the column map")
+        Y = sparse.csr_matrix( (X.data, indices, X.indptr), shape=(X.shape[0], len(self)) )
+        Y.sort_indices()
+        return Y
+
+    def resize(self, X):
+        """ Widens a matrix compacted earlier to the current number of columns """
+        X = sparse.csr_matrix(X)
+        return sparse.csr_matrix( (X.data, X.indices, X.indptr), shape=(X.shape[0], len(self)) )
+
+    def weights(self):
+        """ Returns the feature weight of every compact column """
+        return utils.get_column_weights(self.columns)
+
+
+_snapshot = None
+
+def get_snapshot():
+    """ Returns the shared snapshot of this process or None if no snapshot has been built """
+    global _snapshot
+    if _snapshot is None:
+        _snapshot = FeatureSnapshot()
+    else:
+        _snapshot.reload_if_changed()
+    if not _snapshot.exists():
+        return None
+    return _snapshot
+
+
+def get_features(articles):
+    """ Returns the feature matrix of the given articles
+
+    Rows are taken from the memory-mapped snapshot if there is one. Articles which are not
+    contained in the snapshot or whose feature vectors were computed after its last sync are
+    loaded from the database.
+    """
+    snapshot = get_snapshot()
+    if snapshot is None:
+        return utils.get_features_from_db(articles)
+
+    article_ids = utils.get_article_ids(articles)
+    X, missing = snapshot.get_matrix(article_ids, exclude=get_unsynced_ids(snapshot.meta))
+    if missing.any():
+        logger.debug("%i articles not in snapshot or changed since its sync, loading them from the database"%missing.sum())
+        rows = np.flatnonzero(missing)
+        Y = utils.get_features_from_db(article_ids[rows])
+        P = sparse.csr_matrix( (np.ones(len(rows)), (rows, np.arange(len(rows)))), shape=(len(article_ids), len(rows)) )
+        X = X + P.dot(Y)
+    return X
+
+
+def get_weighted_features(articles):
+    """ Returns the feature matrix of the given articles with every column scaled by the square root
+    of its weight in the similarity metric, so that scalar products of rows are weighted similarities
+    """
+    return get_features(articles).dot(sparse.diags(np.sqrt(utils.get_column_weights()), format='csr'))
@@ -0,0 +1,159 @@
+""" Concurrent and polite fetching of web pages for the scrapers.
+
+The requests are issued from an asyncio event loop. A shared requests.Session, whose connection
+pool holds one connection per concurrent request, performs them in a thread pool. Per host at
+most `concurrency` requests are in flight, and a token bucket spaces their starts to `rate`
+requests per second. Connection errors, 429 and 5xx responses are retried with exponential
+backoff (or after the delay of a Retry-After header).
+
+    with Fetcher(concurrency=4, rate=5) as fetcher:
+        responses = fetcher.fetch_all(urls)
+
+get_page_filename maps the urls of fetched pages to files, in the layout in which the scrapers
+save pages and scripts/biorxiv_stub_server.py replays them.
+"""
+import os
+import re
+import time
+import random
+import asyncio
+import functools
+import logging
+logger = logging.getLogger(__name__)
+
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from urllib.parse import urlparse, unquote
+except ImportError:
+    from urlparse import urlparse
+    from urllib import unquote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+limit_from_re = re.compile(r"limit_from:(\d+)-(\d+)-(\d+)")
+
+
+def get_page_filename(root, url):
+    """ Returns the file of root in which the page of url is saved
+
+    The search listing of a day goes to search/<year>-<month>-<day>.html, every other page to its
+    path with .html appended.
+    """
+    url = unquote(url)
+    path = urlparse(url).path
+    if path.startswith('/search'):
+        m = limit_from_re.search(url)
+        name = "%s-%s-%s"%m.groups() if m else "index"
+        filename = os.path.join(root, 'search', name + '.html')
+    else:
+        filename = os.path.join(root, path.strip('/') + '.html')
+    filename = os.path.normpath(filename)
+    if not filename.startswith(os.path.normpath(root) + os.sep):
+        raise ValueError("%s is outside of %s"%(url, root))
+    return filename
+
+
+class TokenBucket(object):
+    """ Allows rate acquisitions per second on average with bursts of up to capacity """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now-self.last)*self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1-self.tokens)/self.rate)
+
+
+class Fetcher(object):
+    """ Fetches pages concurrently with a bounded number of requests and request rate per host """
+
+    retry_status = (429, 500, 502, 503, 504)
+
+    def __init__(self, concurrency=4, rate=5.0, burst=1, max_retries=3, backoff=1.0, timeout=30):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.limits = {}
+        self.nb_requests = 0
+        self.nb_retries = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+    def get_limits(self, url):
+        """ Returns the semaphore and token bucket of the host of url (created in the running loop) """
+        host = urlparse(url).netloc
+        if host not in self.limits:
+            self.limits[host] = ( asyncio.Semaphore(self.concurrency), TokenBucket(self.rate, self.burst) )
+        return self.limits[host]
+
+    def get_delay(self, attempt, response=None):
+        if response is not None and response.headers.get('retry-after', '').isdigit():
+            return int(response.headers['retry-after'])
+        return self.backoff * 2**attempt * (0.5 + random.random())
+
+    async def fetch(self, url, method='GET', **kwargs):
+        """ Requests url and returns the response, retrying failed requests
+
+        Raises the last exception or a requests.HTTPError if all attempts failed. Responses with
+        other status codes (e.g. 404) are returned.
+        """
+        semaphore, bucket = self.get_limits(url)
+        loop = asyncio.get_event_loop()
+        request = functools.partial(self.session.request, method, url, timeout=self.timeout, **kwargs)
+        async with semaphore:
+            for attempt in range(self.max_retries+1):
+                await bucket.acquire()
+                self.nb_requests += 1
+                response = None
+                try:
+                    response = await loop.run_in_executor(self.executor, request)
+                    if response.status_code not in self.retry_status:
+                        return response
+                    error = requests.HTTPError("%i error for %s"%(response.status_code, url), response=response)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+                if attempt == self.max_retries:
+                    break
+                delay = self.get_delay(attempt, response)
+                logger.warning("%s, retrying in %.1fs"%(error, delay))
+                self.nb_retries += 1
+                await asyncio.sleep(delay)
+        raise error
+
+    async def gather(self, urls, method='GET', **kwargs):
+        return await asyncio.gather(*[ self.fetch(url, method, **kwargs) for url in urls ], return_exceptions=True)
+
+    def fetch_all(self, urls, method='GET', **kwargs):
+        """ Fetches all urls and returns their responses (or the exception of a failed url) in the same order """
+        loop = asyncio.new_event_loop()
+        try:
+            self.limits = {}
+            return loop.run_until_complete(self.gather(urls, method, **kwargs))
+        finally:
+            loop.close()
@@ -0,0 +1,133 @@
+""" Canonical identity keys of articles.
+
+An article is identified by its normalized DOI ("doi:10.1101/123456"), else by the arXiv id in its
+url ("arxiv:1801.00001"), else by a hash of its normalized title and the surname of its first
+author ("hash:..."). The key is stored in Article.canonical_key, which is unique and indexed. The
+title hash is also stored in Article.title_hash for every article, so a record without a DOI finds
+the article of the same paper that was keyed by its DOI and the other way round. All ingestion
+paths resolve articles through both columns with a KeyResolver (see utils.add_or_update_articles).
+
+The functions only depend on the standard library, so the migrations can use them as well.
+"""
+import re
+import hashlib
+import unicodedata
+
+doi_prefix_re = re.compile(r"^(?:https?://(?:dx\.)?doi\.org/|doi:\s*)", re.IGNORECASE)
+arxiv_re = re.compile(r"arxiv\.org/(?:abs|pdf)/([a-z\-\.]+/\d{7}|\d{4}\.\d{4,5})(?:v\d+)?", re.IGNORECASE)
+non_alnum_re = re.compile(r"[^0-9a-z]+")
+
+key_max_length = 150
+
+
+def normalize_doi(doi):
+    if not doi:
+        return ''
+    return doi_prefix_re.sub('', doi.strip()).strip().lower()
+
+
+def get_arxiv_id(url):
+    m = arxiv_re.search(url or '')
+    return m.groups()[0].lower() if m else ''
+
+
+def normalize_text(text):
+    """ Lowercases text, strips accents and replaces everything but letters and digits by single spaces """
+    text = unicodedata.normalize('NFKD', u'%s'%(text or ''))
+    text = u''.join( c for c in text if not unicodedata.combining(c) ).lower()
+    return non_alnum_re.sub(' ', text).strip()
+
+
+def get_first_author(authors):
+    """ Returns the normalized surname of the first author of "First Last, ..." or "Last, First and ..." lists """
+    authors = (authors or '').strip()
+    if ' and ' in authors and ',' in authors.split(' and ')[0]:
+        # BibTeX style "Last, First and Last, First"
+        return normalize_text(authors.split(' and ')[0].split(',')[0])
+    first = re.split(r",| and ", authors)[0]
+    words = normalize_text(first).split()
+    return words[-1] if words else ''
+
+
+def get_hash_key(title, authors):
+    text = normalize_text(title) + u'|' + get_first_author(authors)
+    return 'hash:' + hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def get_article_keys(title, authors, doi=None, url=None):
+    """ Returns the candidate keys of an article, the canonical key first """
+    keys = []
+    doi = normalize_doi(doi)
+    if doi:
+        keys.append(('doi:' + doi)[:key_max_length])
+    arxiv_id = get_arxiv_id(url)
+    if arxiv_id:
+        keys.append('arxiv:' + arxiv_id)
+    keys.append(get_hash_key(title, authors))
+    return keys
+
+
+def get_article_key(title, authors, doi=None, url=None):
+    return get_article_keys(title, authors, doi, url)[0]
+
+
+def get_key_rank(key):
+    """ Returns 0 for DOIs, 1 for arXiv ids and 2 for title hashes """
+    for rank, prefix in enumerate(('doi:', 'arxiv:')):
+        if key.startswith(prefix):
+            return rank
+    return 2
+
+
+def conflicting(candidates, keys):
+    """ Whether two sets of keys hold different DOIs or different arXiv ids, i.e. belong to different articles """
+    for prefix in ('doi:', 'arxiv:'):
+        a = set( key for key in candidates if key.startswith(prefix) )
+        b = set( key for key in keys if key.startswith(prefix) )
+        if a and b and not a & b:
+            return True
+    return False
+
+
+class KeyResolver(object):
+    """ Assigns lists of candidate keys to rows, so that lists which share a key get the same row
+
+    Every key belongs to the first row which claims it, but a canonical key always belongs to its
+    row. A title hash only matches a row whose DOI and arXiv id do not contradict the candidates,
+    since different papers can have the same title and first author.
+    """
+
+    def __init__(self):
+        self.owner = {}
+        self.keys = []
+        self.canonical = []
+
+    def add_row(self, canonical_key, candidates=()):
+        row = len(self.keys)
+        self.keys.append(set())
+        self.canonical.append(canonical_key)
+        self.owner[canonical_key] = row
+        self.claim(row, [canonical_key] + list(candidates))
+        return row
+
+    def claim(self, row, candidates):
+        for key in candidates:
+            self.owner.setdefault(key, row)
+            self.keys[row].add(key)
+
+    def find(self, candidates):
+        """ Returns the row of the first candidate key that has one, None if there is none """
+        for key in candidates:
+            row = self.owner.get(key)
+            if row is None or (get_key_rank(key) == 2 and conflicting(candidates, self.keys[row])):
+                continue
+            return row
+        return None
+
+    def promote(self, row, key):
+        """ Makes key the canonical key of row unless it is weaker than the current one or belongs to another row """
+        if key == self.canonical[row] or self.owner.get(key, row) != row or get_key_rank(key) > get_key_rank(self.canonical[row]):
+            return False
+        self.canonical[row] = key
+        self.claim(row, [key])
+        return True
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import numpy as np
+
+
+index_dtype = np.dtype('<i4')
+value_dtype = np.dtype('<f4')
+
+
+def pack_features(apps, schema_editor):
+    """ Converts the rows of the old Feature table into one packed FeatureVector per article """
+    Feature = apps.get_model('papers', 'Feature')
+    FeatureVector = apps.get_model('papers', 'FeatureVector')
+
+    def make_vector(article_id, indices, values):
+        return FeatureVector(article_id=article_id, nnz=len(indices),
+                indices=np.asarray(indices, dtype=index_dtype).tobytes(),
+                data=np.asarray(values, dtype=value_dtype).tobytes())
+
+    batch = []
+    current, indices, values = None, [], []
+    rows = Feature.objects.order_by('article', 'index').values_list('article_id', 'index', 'value')
+    for article_id, index, value in rows.iterator():
+        if article_id != current:
+            if current is not None:
+                batch.append(make_vector(current, indices, values))
+            current, indices, values = article_id, [], []
+            if len(batch) >= 1000:
+                FeatureVector.objects.bulk_create(batch)
+                batch = []
+        indices.append(index)
+        values.append(value)
+    if current is not None:
+        batch.append(make_vector(current, indices, values))
+    FeatureVector.objects.bulk_create(batch)
+
+
+def unpack_features(apps, schema_editor):
+    """ Expands packed FeatureVector records back into one Feature row per nonzero entry """
+    Feature = apps.get_model('papers', 'Feature')
+    FeatureVector = apps.get_model('papers', 'FeatureVector')
+    for article_id, indices, values in FeatureVector.objects.values_list('article_id', 'indices', 'data').iterator():
+        indices = np.frombuffer(indices, dtype=index_dtype)
+        values = np.frombuffer(values, dtype=value_dtype)
+        Feature.objects.bulk_create([ Feature(article_id=article_id, index=int(i), value=float(v)) for i, v in zip(indices, values) ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papers', '0004_auto_20170408_2334'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeatureVector',
+            fields=[
+                ('article', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='papers.Article')),
+                ('nnz', models.IntegerField()),
+                ('indices', models.BinaryField()),
+                ('data', models.BinaryField()),
+            ],
+        ),
+        migrations.RunPython(pack_features, unpack_features),
+        migrations.DeleteModel(
+            name='Feature',
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 14:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papers', '0006_featurevector_date_computed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='similarities_dirty',
+            field=models.BooleanField(db_index=True, default=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 16:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papers', '0007_article_similarities_dirty'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NeighbourList',
+            fields=[
+                ('article', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='papers.Article')),
+                ('neighbours', models.TextField()),
+                ('date_computed', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
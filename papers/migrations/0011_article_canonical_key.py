@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 20:10
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations, models
+
+from papers import keys
+
+
+def set_canonical_keys(apps, schema_editor):
+    """ Computes the canonical keys of all articles and merges the articles which share a key
+
+    The articles are resolved with a KeyResolver like in utils.add_or_update_articles: an article
+    is a duplicate of an earlier one if one of its candidate keys (see keys.get_article_keys)
+    belongs to the earlier article, but a title hash does not join articles with different DOIs
+    or arXiv ids. The labels of the duplicates are moved to the kept article, which is marked for
+    the similarity job and gets the strongest key of its duplicates, and the duplicates are
+    deleted. Neighbour lists which show a deleted article are dropped.
+    """
+    Article = apps.get_model('papers', 'Article')
+    Profile = apps.get_model('papers', 'Profile')
+    NeighbourList = apps.get_model('papers', 'NeighbourList')
+    connection = schema_editor.connection
+
+    resolver = keys.KeyResolver()
+    kept = []
+    duplicates = {}
+    rows = Article.objects.order_by('id').values_list('id', 'title', 'authors', 'doi', 'url').iterator()
+    for article_id, title, authors, doi, url in rows:
+        candidates = keys.get_article_keys(title, authors, doi, url)
+        row = resolver.find(candidates)
+        if row is None:
+            resolver.add_row(candidates[0], candidates)
+            kept.append(article_id)
+            continue
+        duplicates[article_id] = kept[row]
+        resolver.claim(row, candidates)
+        resolver.promote(row, candidates[0])
+
+    for name in ['ham', 'spam', 'starred']:
+        through = getattr(Profile, name).through
+        for article_id, kept_id in duplicates.items():
+            labelled = through.objects.filter( article_id=kept_id ).values_list( 'profile_id', flat=True )
+            through.objects.filter( article_id=article_id ).exclude( profile_id__in=list(labelled) ).update( article_id=kept_id )
+
+    removed = sorted(duplicates)
+    if removed:
+        Article.objects.filter( id__in=sorted(set(duplicates.values())) ).update( similarities_dirty=True )
+        removed_set = set(removed)
+        stale = [ article_id for article_id, neighbours in NeighbourList.objects.values_list('article_id', 'neighbours').iterator()
+                if any( n['id'] in removed_set for n in json.loads(neighbours) ) ]
+        for k in range(0, len(stale), 900):
+            NeighbourList.objects.filter( article_id__in=stale[k:k+900] ).delete()
+            Article.objects.filter( id__in=stale[k:k+900] ).update( similarities_dirty=True )
+        for k in range(0, len(removed), 900):
+            Article.objects.filter( id__in=removed[k:k+900] ).delete()
+
+    sql = "UPDATE %s SET %s = %%s WHERE %s = %%s"%tuple( connection.ops.quote_name(name) for name in (Article._meta.db_table, 'canonical_key', 'id') )
+    updates = [ (resolver.canonical[row], article_id) for row, article_id in enumerate(kept) ]
+    with connection.cursor() as cursor:
+        for k in range(0, len(updates), 10000):
+            cursor.executemany(sql, updates[k:k+10000])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papers', '0009_recommendation_score'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='canonical_key',
+            field=models.CharField(editable=False, max_length=150, null=True),
+        ),
+        migrations.RunPython(set_canonical_keys, migrations.RunPython.noop),
+    ]
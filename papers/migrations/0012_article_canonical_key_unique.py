@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 20:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papers', '0011_article_canonical_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='article',
+            name='canonical_key',
+            field=models.CharField(editable=False, max_length=150, unique=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 22:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papers', '0012_article_canonical_key_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recommendation',
+            name='online',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 23:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from papers import keys
+
+
+def set_title_hashes(apps, schema_editor):
+    """ Stores the title hash key of every article """
+    Article = apps.get_model('papers', 'Article')
+    connection = schema_editor.connection
+
+    sql = "UPDATE %s SET %s = %%s WHERE %s = %%s"%tuple( connection.ops.quote_name(name) for name in (Article._meta.db_table, 'title_hash', 'id') )
+    rows = Article.objects.order_by('id').values_list('id', 'title', 'authors').iterator()
+    updates = [ (keys.get_hash_key(title, authors), article_id) for article_id, title, authors in rows ]
+    with connection.cursor() as cursor:
+        for k in range(0, len(updates), 10000):
+            cursor.executemany(sql, updates[k:k+10000])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papers', '0013_recommendation_online'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='title_hash',
+            field=models.CharField(editable=False, max_length=150, null=True),
+        ),
+        migrations.RunPython(set_title_hashes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 23:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papers', '0014_article_title_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='article',
+            name='title_hash',
+            field=models.CharField(db_index=True, editable=False, max_length=150),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 23:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papers', '0015_article_title_hash_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='similarity',
+            name='b',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='b', to='papers.Article'),
+        ),
+    ]
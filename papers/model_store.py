@@ -0,0 +1,104 @@
+""" Persisted classifiers of the user profiles.
+
+The weight vector and intercept of the classifier of every profile are kept as one .npz file in
+DATA_DIR/models together with the fingerprint of the training set they were fitted on. The
+fingerprint hashes the ids of the ham and spam articles of the profile and the version of the
+feature configuration, so a stored model can be reused as long as neither the labels of the
+profile nor the feature space have changed. Sparse weight vectors are stored in the hashed column
+space, so they are independent of the compacted column numbering.
+"""
+import os
+import json
+import hashlib
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from scipy import sparse
+
+from django.conf import settings
+
+import papers.utils as utils
+
+
+def get_model_dir():
+    return os.path.join(settings.DATA_DIR, 'models')
+
+
+def get_feature_config(embedding_index=None):
+    """ Describes the feature space classifiers are trained in
+
+    Changing the hashing or weighting of the features or refitting the embeddings changes the
+    description and invalidates all stored models.
+    """
+    config = { 'fields' : list(utils.feature_fields), 'dims' : utils.feature_dims, 'weights' : utils.feature_weights }
+    if embedding_index is not None:
+        config['embeddings'] = embedding_index.meta.get('date_fitted') or os.path.getmtime(embedding_index.filename('components.npy'))
+    return config
+
+
+def get_feature_config_version(embedding_index=None):
+    config = json.dumps(get_feature_config(embedding_index), sort_keys=True)
+    return hashlib.sha1(config.encode('utf-8')).hexdigest()[:16]
+
+
+def get_training_fingerprint(profile, version):
+    """ Hashes the labelled articles of a profile and the feature config version """
+    h = hashlib.sha1(version.encode('utf-8'))
+    for qs in [ profile.ham, profile.spam ]:
+        ids = np.sort(np.array(list(qs.values_list('id', flat=True)), dtype=np.int64))
+        h.update(np.int64(len(ids)).tobytes())
+        h.update(ids.tobytes())
+    return h.hexdigest()
+
+
+class ModelStore(object):
+    """ The stored classifiers of all profiles in a directory """
+
+    def __init__(self, path=None):
+        self.path = path or get_model_dir()
+        self.hits = 0
+        self.misses = 0
+
+    def filename(self, profile_id):
+        return os.path.join(self.path, '%i.npz'%profile_id)
+
+    def load(self, profile_id, fingerprint):
+        """ Returns the weight vector and intercept stored for the profile or None if they were
+        fitted on a different training set
+        """
+        model = None
+        try:
+            with np.load(self.filename(profile_id)) as f:
+                if str(f['fingerprint']) == fingerprint:
+                    if 'coef' in f:
+                        coef = f['coef']
+                    else:
+                        coef = sparse.csr_matrix( (f['data'], f['indices'], np.array([0, len(f['indices'])])), shape=(1, int(f['nb_columns'])) )
+                    model = (coef, float(f['intercept']))
+        except (IOError, OSError, KeyError, ValueError) as e:
+            if os.path.exists(self.filename(profile_id)):
+                logger.warning("Could not read the stored model of profile %i: %s"%(profile_id, e))
+        if model is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return model
+
+    def save(self, profile_id, fingerprint, coef, intercept):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        arrays = { 'fingerprint' : np.array(fingerprint), 'intercept' : np.array(intercept) }
+        if sparse.issparse(coef):
+            coef = sparse.csr_matrix(coef)
+            arrays.update( data=coef.data, indices=coef.indices, nb_columns=np.array(coef.shape[1]) )
+        else:
+            arrays['coef'] = np.asarray(coef)
+        # Write to a temporary file first so readers never see a partial model
+        tmp = os.path.join(self.path, '%i.tmp.npz'%profile_id)
+        np.savez(tmp, **arrays)
+        os.rename(tmp, self.filename(profile_id))
+
+    def delete(self, profile_id):
+        if os.path.exists(self.filename(profile_id)):
+            os.remove(self.filename(profile_id))
@@ -1,8 +1,13 @@
 from __future__ import unicode_literals
 
 from django.db import models
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from django.contrib.auth.models import User
 
+from papers import keys
+
 
 class Article(models.Model):
     title = models.CharField(max_length=250)
@@ -16,28 +21,44 @@ class Article(models.Model):
     pmid = models.IntegerField(null=True, blank=True)
     # source = models.ForeignKey(Source, on_delete=models.CASCADE)
     date_added = models.DateTimeField( )
+    # Set when the article is new, its features changed or a similar article was deleted, cleared by the similarity job
+    similarities_dirty = models.BooleanField(default=True, db_index=True)
+    # Normalized DOI, arXiv id or title hash which identifies the article (see papers/keys.py)
+    canonical_key = models.CharField(max_length=keys.key_max_length, unique=True, editable=False)
+    # Title hash key of the article, also if its canonical key is a DOI or arXiv id
+    title_hash = models.CharField(max_length=keys.key_max_length, db_index=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        if not self.canonical_key:
+            self.canonical_key = keys.get_article_key(self.title, self.authors, self.doi, self.url)
+        self.title_hash = keys.get_hash_key(self.title, self.authors)
+        super(Article, self).save(*args, **kwargs)
 
     def __str__(self):
         return "%s (%s). %s." % (self.authors, self.pubdate, self.title)
 
 
-class Feature(models.Model):
-    id = models.BigAutoField(primary_key=True)
-    article = models.ForeignKey(Article, on_delete=models.CASCADE)
-    index = models.IntegerField()
-    value = models.FloatField()
+class FeatureVector(models.Model):
+    """ Sparse feature vector of an article packed into a single record.
 
-    class Meta:
-        unique_together = ('article', 'index')
+    The column indices and values of the nonzero entries are stored as raw
+    little-endian int32 and float32 arrays (see utils.pack_feature_vector).
+    """
+    article = models.OneToOneField(Article, primary_key=True, on_delete=models.CASCADE)
+    nnz = models.IntegerField()
+    indices = models.BinaryField()
+    data = models.BinaryField()
+    date_computed = models.DateTimeField(default=timezone.now, db_index=True)
 
     def __str__(self):
-        return "<Feature(index=%i, value=%f)>" % (self.index, self.value)
+        return "<FeatureVector(article=%i, nnz=%i)>" % (self.article_id, self.nnz)
 
 
 class Similarity(models.Model):
     id = models.BigAutoField(primary_key=True)
     a = models.ForeignKey(Article, related_name='a', on_delete=models.CASCADE)
-    b = models.ForeignKey(Article, related_name='b', db_index=False, on_delete=models.CASCADE)
+    # Indexed since the incremental similarity jobs look up the pairs of changed articles on both sides
+    b = models.ForeignKey(Article, related_name='b', on_delete=models.CASCADE)
     value = models.FloatField()
 
     class Meta:
@@ -47,6 +68,20 @@ class Similarity(models.Model):
         return "<Similarity(a=%i, b=%i, value=%f)>" % (self.a.id, self.b.id, self.value)
 
 
+class NeighbourList(models.Model):
+    """ The most similar articles of an article, denormalized for the details view.
+
+    neighbours is a JSON list ordered by decreasing similarity whose entries carry the
+    displayed fields of the neighbours (see utils.save_neighbour_lists).
+    """
+    article = models.OneToOneField(Article, primary_key=True, on_delete=models.CASCADE)
+    neighbours = models.TextField()
+    date_computed = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return "<NeighbourList(article=%i)>" % (self.article_id)
+
+
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     spam = models.ManyToManyField(Article, related_name='spam')
@@ -65,6 +100,20 @@ class Recommendation(models.Model):
     article = models.ForeignKey(Article, on_delete=models.CASCADE)
     profile = models.ForeignKey(Profile, on_delete=models.CASCADE)
     date_added = models.DateTimeField( )
+    # Decision value of the classifier of the profile, the suggestions are ordered by it
+    score = models.FloatField(default=0.0)
+    # Scored by the online classifier (see papers/online.py) since the last run of compute_recommendations.py
+    online = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [ models.Index(fields=['profile', '-score'], name='papers_reco_profile_score') ]
 
     def __str__(self):
         return "<Recommendation(profile=%i, article=%i)>" % (self.profile.id, self.article.id)
+
+
+@receiver(pre_delete, sender=Article)
+def flag_similar_articles(sender, instance, **kwargs):
+    """ Flags the articles similar to a deleted article, so that the similarity job refills their neighbour lists """
+    Article.objects.filter( models.Q(id__in=Similarity.objects.filter(b=instance).values('a'))
+            | models.Q(id__in=Similarity.objects.filter(a=instance).values('b')) ).update(similarities_dirty=True)
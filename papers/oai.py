@@ -0,0 +1,90 @@
+""" Streaming parser of OAI-PMH ListRecords responses in the arXivRaw metadata format.
+
+The responses of the arXiv OAI interface (see scripts/scrape_arxiv.py) and the dumps written by
+scripts/arxiv_download_xml.py are read with iterparse. Every record is turned into a dict as
+soon as its end tag is read and its element is removed from the tree, so the memory used does
+not grow with the number of records in a response.
+"""
+import re
+from datetime import datetime
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+oai_ns = '{http://www.openarchives.org/OAI/2.0/}'
+record_tag = oai_ns + 'record'
+ns_re = re.compile(r"\{(?:.*?)\}(.*)")
+date_fmt = "%a, %d %b %Y %H:%M:%S GMT"
+
+base_url = "https://arxiv.org/abs"
+
+
+def local_name(tag):
+    m = ns_re.match(tag)
+    return m.groups()[0] if m else tag
+
+
+def get_text(el):
+    if el is None or el.text is None:
+        return ''
+    return el.text.strip()
+
+
+def parse_record(record):
+    """ Converts a record element to a dict (None for deleted records)
+
+    The dict holds the arXiv id, title, authors, abstract, doi and journal_ref as stripped
+    strings, the categories as a list, the date of the first version as datetime and the
+    url of the abstract page.
+    """
+    header = record.find(oai_ns + 'header')
+    if header is not None and header.get('status') == 'deleted':
+        return None
+    metadata = record.find(oai_ns + 'metadata')
+    if metadata is None or not len(metadata):
+        return None
+
+    fields = {}
+    date = None
+    for el in metadata[0]:
+        name = local_name(el.tag)
+        if name == 'version':
+            if date is None:
+                for child in el:
+                    if local_name(child.tag) == 'date':
+                        date = datetime.strptime(get_text(child), date_fmt)
+        else:
+            fields[name] = get_text(el)
+
+    return { 'id' : fields.get('id', ''),
+             'title' : fields.get('title', ''),
+             'authors' : fields.get('authors', ''),
+             'abstract' : fields.get('abstract', ''),
+             'date' : date,
+             'categories' : fields.get('categories', '').split(),
+             'journal_ref' : fields.get('journal-ref', ''),
+             'doi' : fields.get('doi', ''),
+             'url' : "%s/%s"%(base_url, fields.get('id', '')) }
+
+
+def iter_records(source):
+    """ Yields the records of a ListRecords response or dump as dicts (see parse_record)
+
+    args:
+        source a file name or a file object opened in binary mode
+    """
+    parents = []
+    for event, el in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            parents.append(el)
+            continue
+        parents.pop()
+        if el.tag == record_tag:
+            record = parse_record(el)
+            # Remove the parsed record from its parent, so the tree never holds more than one record
+            if parents:
+                parents[-1].remove(el)
+            el.clear()
+            if record is not None:
+                yield record
@@ -0,0 +1,225 @@
+""" Online learning of the user profiles between the runs of compute_recommendations.py.
+
+Every profile has a linear SGDClassifier which is updated with partial_fit whenever the user
+labels an article (see views.ajax_set_label). It is initialized with a few passes over the
+training set of the profile and stored gzipped in DATA_DIR/online with a sparse weight vector.
+Every process keeps the classifiers it updated and only writes them after ONLINE_SAVE_EVERY
+labels or ONLINE_SAVE_INTERVAL seconds. If another process saved a classifier in the meantime, it
+is loaded and the labels not saved yet are learned again. Labels that were never saved are
+only lost for the online classifier, compute_recommendations.py trains on all labels. After every
+update the ONLINE_RESCORE_WINDOW most recent articles are rescored and the recommendations of
+the profile among them are replaced, so the suggestions follow the labels within seconds. The
+recommendations of older articles and the classifier used by the cron job are left to
+compute_recommendations.py. The online recommendations are flagged as such and their scores are
+calibrated to the scale of the batch classifier, so both rank together on the Suggested page.
+
+Enable with settings.ONLINE_LEARNING.
+"""
+import os
+import copy
+import gzip
+import pickle
+import tempfile
+from time import time
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from sklearn.linear_model import SGDClassifier
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from papers.models import Article, Recommendation
+import papers.utils as utils
+import papers.feature_store as feature_store
+
+
+classes = np.array([-1, 1])
+
+# The classifiers updated by this process: profile id -> dict with the classifier, the mtime of
+# its file when it was loaded or saved, the labels learned since and the time of the last save
+_models = {}
+
+
+def get_online_dir():
+    return os.path.join(settings.DATA_DIR, 'online')
+
+
+def get_model_filename(profile_id, path=None):
+    return os.path.join(path or get_online_dir(), '%i.pkl.gz'%profile_id)
+
+
+def load_model(profile_id, path=None):
+    """ Returns the online classifier of a profile or None if it has not been initialized """
+    filename = get_model_filename(profile_id, path)
+    if not os.path.exists(filename):
+        return None
+    try:
+        with gzip.open(filename, 'rb') as f:
+            svm = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError) as e:
+        logger.warning("Could not read the online model of profile %i: %s"%(profile_id, e))
+        return None
+    svm.densify()
+    return svm
+
+
+def save_model(profile_id, svm, path=None):
+    """ Stores the classifier of a profile (with a sparse weight vector) and returns the mtime of the file """
+    filename = get_model_filename(profile_id, path)
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    # Only the weights of the features of labelled articles are nonzero
+    stored = copy.copy(svm)
+    stored.sparsify()
+    # A unique temporary file, concurrent saves of the same profile must not write into each other
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=1) as f:
+        pickle.dump(stored, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, filename)
+    return os.path.getmtime(filename)
+
+
+def get_mtime(filename):
+    return os.path.getmtime(filename) if os.path.exists(filename) else None
+
+
+def get_model(profile_id, path=None):
+    """ Returns the cache entry of the classifier of a profile, (re)loading it if its file changed """
+    filename = get_model_filename(profile_id, path)
+    entry = _models.get((profile_id, path))
+    mtime = get_mtime(filename)
+    if entry is None or (mtime is not None and mtime != entry['mtime']):
+        pending = entry['pending'] if entry is not None else []
+        entry = dict(svm=load_model(profile_id, path), mtime=mtime, pending=[], saved=time())
+        _models[(profile_id, path)] = entry
+        # Learn the labels again which this process had not saved yet
+        for article_id, label in pending:
+            if entry['svm'] is not None:
+                partial_fit(entry['svm'], article_id, label)
+                entry['pending'].append( (article_id, label) )
+    return entry
+
+
+def flush_model(profile_id, path=None, force=False):
+    """ Saves the classifier of a profile if this process learned labels since it was saved (or if force) """
+    entry = _models.get((profile_id, path))
+    if entry is not None and (entry['pending'] or force):
+        entry['mtime'] = save_model(profile_id, entry['svm'], path)
+        entry['pending'] = []
+        entry['saved'] = time()
+
+
+def delete_model(profile_id, path=None):
+    """ Removes the classifier of a profile, e.g. after all its labels were removed """
+    _models.pop((profile_id, path), None)
+    filename = get_model_filename(profile_id, path)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def partial_fit(svm, article_id, label):
+    svm.partial_fit(feature_store.get_features(np.array([ int(article_id) ])), np.array([ 1 if label > 0 else -1 ]))
+
+
+def fit_training_set(profile, nb_passes=5):
+    """ Initializes the online classifier of a profile with its whole training set, None if it is empty """
+    X_train, y_train = utils.get_training_set( profile )
+    if len(y_train) == 0:
+        return None
+    svm = SGDClassifier(loss='hinge', alpha=1e-4, random_state=42)
+    for k in range(nb_passes):
+        order = np.random.RandomState(k).permutation(len(y_train))
+        svm.partial_fit(X_train[order], y_train[order], classes=classes)
+    return svm
+
+
+def learn_label(profile, article_id, label, path=None):
+    """ Updates the online classifier of a profile with a newly labelled article
+
+    Removed labels cannot be unlearned, in that case and for profiles without an online
+    classifier it is fitted on the training set again and saved. Otherwise the classifier is
+    saved after settings.ONLINE_SAVE_EVERY labels or settings.ONLINE_SAVE_INTERVAL seconds.
+    If the last label was removed, the classifier is deleted.
+
+    returns the updated classifier or None if the profile has no labels
+    """
+    entry = get_model(profile.id, path)
+    if entry['svm'] is None or label == 0:
+        svm = fit_training_set(profile)
+        if svm is None:
+            delete_model(profile.id, path)
+            return None
+        entry['svm'] = svm
+        flush_model(profile.id, path, force=True)
+        return svm
+    partial_fit(entry['svm'], article_id, label)
+    entry['pending'].append( (int(article_id), label) )
+    if len(entry['pending']) >= settings.ONLINE_SAVE_EVERY or time()-entry['saved'] >= settings.ONLINE_SAVE_INTERVAL:
+        flush_model(profile.id, path)
+    return entry['svm']
+
+
+def get_recent_articles(window):
+    return Article.objects.order_by('-pubdate', '-id')[:window]
+
+
+def get_calibration(profile, svm, min_pairs=20):
+    """ Returns the factor which maps decision values of the online classifier to the scale of the batch scores
+
+    Both classifiers are linear with a hinge loss and their decision boundary at 0, so the factor
+    is the slope through the origin between the online decision values and the stored scores of
+    the recommendations written by compute_recommendations.py. Without enough of them it is 1.
+    """
+    rows = np.array(list(Recommendation.objects.filter( profile=profile, online=False ).values_list( 'article_id', 'score' )), dtype=np.float64).reshape(-1, 2)
+    if len(rows) < min_pairs:
+        return 1.0
+    values = svm.decision_function(feature_store.get_features(rows[:,0].astype(np.int64)))
+    scale = values.dot(rows[:,1])/max(values.dot(values), 1e-12)
+    return scale if scale > 0 else 1.0
+
+
+def cap_recommendations(profile, max_suggestions, chunk_size=900):
+    """ Deletes the recommendations of a profile behind the max_suggestions first ones of the Suggested page """
+    ids = list(Recommendation.objects.filter( profile=profile ).order_by( '-score', '-article__pubdate' ).values_list( 'id', flat=True )[max_suggestions:])
+    for k in range(0, len(ids), chunk_size):
+        Recommendation.objects.filter( id__in=ids[k:k+chunk_size] ).delete()
+    return len(ids)
+
+
+def rescore_recent_articles(profile, svm, window=None, max_suggestions=500, chunk_size=900):
+    """ Replaces the recommendations of a profile among the window most recent articles
+
+    The scores are calibrated with get_calibration and the profile keeps at most
+    max_suggestions recommendations in total.
+
+    returns the number of recommended articles in the window
+    """
+    window = window or settings.ONLINE_RESCORE_WINDOW
+    article_ids = utils.get_article_ids(get_recent_articles(window))
+    if not len(article_ids):
+        return 0
+    scores = get_calibration(profile, svm)*svm.decision_function(feature_store.get_features(article_ids))
+    positive = np.flatnonzero(scores > 0)
+    positive = positive[np.argsort(-scores[positive], kind='stable')][:max_suggestions]
+
+    now = timezone.now()
+    with transaction.atomic():
+        for k in range(0, len(article_ids), chunk_size):
+            Recommendation.objects.filter( profile=profile, article_id__in=article_ids[k:k+chunk_size].tolist() ).delete()
+        Recommendation.objects.bulk_create( [ Recommendation( profile=profile, article_id=int(a), date_added=now, score=float(v), online=True )
+            for a, v in zip(article_ids[positive], scores[positive]) ] )
+        cap_recommendations(profile, max_suggestions)
+    return len(positive)
+
+
+def update_profile(profile, article_id, label, window=None):
+    """ Learns a label of a profile online and updates its recent recommendations """
+    svm = learn_label(profile, article_id, int(label))
+    if svm is None:
+        return 0
+    count = rescore_recent_articles(profile, svm, window)
+    logger.debug("Online update of profile %s: %i recent suggestions"%(profile, count))
+    return count
@@ -0,0 +1,139 @@
+""" A directory of harvested raw pages waiting to be imported.
+
+The scrapers only download: every page is written to the spool directory (DATA_DIR/spool/<name>)
+and recorded in its manifest, and the importers parse and write the pages into the database
+separately (see scripts/scrape_arxiv.py and scripts/import_arxiv_xml.py). The manifest is an
+append-only file of JSON lines. A "harvested" line records a page with its checksum and metadata
+(e.g. the journal name its articles get), an "imported" line records that the page with that
+checksum has been written to the database. A page is pending as long as its current checksum has
+no imported line, so an import that crashed is replayed from the spool without downloading the
+pages again, and importing a page twice only updates the same articles. A "failed" line records
+that the page could not be parsed or written, such a page is skipped by later imports until it is
+harvested again or the import is asked to retry failed pages. Imported pages are deleted together
+with their lines by prune, since the directory and the manifest grow with every harvest otherwise.
+"""
+import os
+import json
+import fcntl
+import hashlib
+import datetime
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+def get_spool_dir(name):
+    return os.path.join(settings.DATA_DIR, 'spool', name)
+
+
+class Spool(object):
+    """ The spooled pages of a directory and their manifest """
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest = os.path.join(path, 'manifest.jsonl')
+
+    def filename(self, name):
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def lock(self):
+        """ Holds the exclusive lock of the manifest
+
+        The lock is taken on a separate file, since prune replaces the manifest.
+        """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        with open(os.path.join(self.path, 'manifest.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def append(self, entry):
+        entry['time'] = datetime.datetime.utcnow().isoformat()
+        with self.lock(), open(self.manifest, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def add(self, name, content, **meta):
+        """ Writes the page content (bytes) as name and records it with the meta data """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        # Write to a temporary file first so importers never see a partial page
+        tmp = self.filename(name + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.rename(tmp, self.filename(name))
+        entry = dict(meta, event='harvested', name=name, size=len(content), sha1=hashlib.sha1(content).hexdigest())
+        self.append(entry)
+        return entry
+
+    def mark_imported(self, entry, nb_records):
+        self.append( dict(event='imported', name=entry['name'], sha1=entry['sha1'], records=nb_records) )
+
+    def mark_failed(self, entry, error):
+        self.append( dict(event='failed', name=entry['name'], sha1=entry['sha1'], error=error) )
+
+    def get_entries(self):
+        """ Returns the harvested pages in the order of harvesting as dicts of their meta data
+
+        The key 'imported' holds the number of records imported from the current version of the
+        page, None if it has not been imported yet. The key 'failed' holds the error of the last
+        failed import of the current version, None if it has not failed since it was imported.
+        """
+        entries = OrderedDict()
+        if not os.path.exists(self.manifest):
+            return entries
+        with open(self.manifest) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut off by a crash
+                    continue
+                name = entry['name']
+                if entry['event'] == 'harvested':
+                    entries.pop(name, None)
+                    entries[name] = dict(entry, imported=None, failed=None)
+                elif name not in entries or entries[name]['sha1'] != entry['sha1']:
+                    continue
+                elif entry['event'] == 'imported':
+                    entries[name].update( imported=entry['records'], failed=None )
+                elif entry['event'] == 'failed':
+                    entries[name]['failed'] = entry['error']
+        return entries
+
+    def get_pending(self, force=False, retry_failed=False):
+        """ Returns the entries of the pages that have not been imported and not failed (all pages if force) """
+        return [ e for e in self.get_entries().values() if (force or (e['imported'] is None and (retry_failed or e['failed'] is None)))
+                and os.path.exists(self.filename(e['name'])) ]
+
+    def prune(self, keep_days=0):
+        """ Deletes the imported pages harvested more than keep_days ago and their lines of the manifest
+
+        The manifest is rewritten to a temporary file which replaces it, while holding the lock
+        of the manifest, so no line appended by a harvester or an importer meanwhile is lost.
+
+        returns the names of the deleted pages
+        """
+        cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=keep_days)).isoformat()
+        with self.lock():
+            pruned = set( e['name'] for e in self.get_entries().values() if e['imported'] is not None and e['time'] < cutoff )
+            if not pruned:
+                return []
+            for name in pruned:
+                if os.path.exists(self.filename(name)):
+                    os.remove(self.filename(name))
+            tmp = self.manifest + '.tmp'
+            with open(self.manifest) as f, open(tmp, 'w') as out:
+                for line in f:
+                    try:
+                        name = json.loads(line)['name']
+                    except ValueError:
+                        continue
+                    if name not in pruned:
+                        out.write(line)
+            os.replace(tmp, self.manifest)
+        return sorted(pruned)
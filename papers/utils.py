@@ -3,16 +3,20 @@ from scipy import sparse
 from sklearn.feature_extraction.text import HashingVectorizer
 import numpy as np
 import re
-from tqdm import tqdm
+import json
+import multiprocessing
 
 import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 import django
+from django.conf import settings
 from django.utils import timezone
 from django.utils.encoding import smart_text
+from django.db import connection, transaction
 from django.db.models import Q
+from django.db.models.query import QuerySet
 
 import bibtexparser
 from bibtexparser.bparser import BibTexParser
@@ -24,33 +28,64 @@ from datetime import datetime
 
 django.setup()
 
-from papers.models import Article, Profile, Feature, Recommendation, Similarity
+from papers.models import Article, Profile, FeatureVector, NeighbourList, Similarity
+from papers import keys
 from django.contrib.auth.models import User
 
 
 feature_dims = { 'title' : 2**20,  'authors' : 2**16,  'abstract' : 2**20, 'keywords' : 2**16 }
 
+# Weights of the fields in the metric used for article similarities
+feature_weights = { 'title' : 1.0,  'authors' : 0.5,  'abstract' : 1.0, 'keywords' : 1.0 }
+
+# Storage types of packed feature vectors (see FeatureVector)
+feature_index_dtype = np.dtype('<i4')
+feature_value_dtype = np.dtype('<f4')
+
+# Length of the stored neighbour lists (see NeighbourList) and the fields of their entries
+neighbour_list_size = 11
+neighbour_list_fields = ('id', 'title', 'authors', 'url', 'journal', 'pubdate')
+
 
 
 def get_recommended_articles(request):
     articles = []
     if request.user.is_authenticated:
         profile,_ = Profile.objects.get_or_create(user=request.user, defaults={'last_prediction_run': timezone.now(), 'last_traindata_update': timezone.now()})
-        articles = profile.suggested.all().order_by('-pubdate')
+        # Best suggestions first, served by the (profile, -score) index of the recommendations
+        articles = Article.objects.filter(recommendation__profile=profile).order_by('-recommendation__score', '-pubdate')
     else: # Get suggested articles from all users
         articles = Article.objects.filter(suggested__isnull=False).distinct().order_by('-pubdate')
     return articles
 
-def get_similar_articles(article, limit=11):
-    # similarities = Similarity.objects.filter( a=article ).order_by('-value')[:limit]
-    similarities = Similarity.objects.filter( Q(a=article) | Q(b=article) ).order_by('-value')[:limit]
-    articles = []
-    for s in similarities:
-        if s.a==article:
-            articles.append(s.b)
-        else:
-            articles.append(s.a)
-    return articles
+def get_similar_articles(article, limit=neighbour_list_size):
+    """ Returns the most similar articles of an article
+
+    The precomputed neighbour list of the article is read in a single query. Articles without a
+    list yet fall back to the similarity table. Either way the neighbours are dicts with the
+    fields of neighbour_list_fields and the similarity value, ordered by decreasing similarity.
+    """
+    neighbours = NeighbourList.objects.filter( article_id=article.id ).values_list( 'neighbours', flat=True ).first()
+    if neighbours is not None:
+        neighbours = json.loads(neighbours)[:limit]
+        for n in neighbours:
+            n['pubdate'] = datetime.strptime(n['pubdate'], '%Y-%m-%d').date()
+        return neighbours
+
+    if settings.SIMILARITY_TOP_K is not None:
+        # Top-k similarities are stored directed, the neighbours of an article are in the rows with a=article
+        rows = Similarity.objects.filter( a=article ).order_by('-value').values_list( 'value', *[ 'b__'+f for f in neighbour_list_fields ] )[:limit]
+        return [ dict(zip(neighbour_list_fields, r[1:]), value=r[0]) for r in rows ]
+
+    rows = Similarity.objects.filter( Q(a=article) | Q(b=article) ).order_by('-value').values_list( 'value',
+            *[ side+f for side in ('a__', 'b__') for f in neighbour_list_fields ] )[:limit]
+    n = len(neighbour_list_fields)
+    neighbours = []
+    for r in rows:
+        # The fields of a come first, the neighbour is the other article of the pair
+        fields = r[n+1:] if r[1] == article.id else r[1:n+1]
+        neighbours.append( dict(zip(neighbour_list_fields, fields), value=r[0]) )
+    return neighbours
 
 def set_label(request, article_id, label=0):
     """ Adds article to training set of the authenticated user with given label 
@@ -150,7 +185,7 @@ def import_bibtex(bibtex_str, nb_max=None, update=True):
     logger.info("Entries read from BibTeX data %i"%len(bib_database.entries))
 
     # packaging into django objects
-    data = []
+    records = []
     for e in bib_database.entries:
         title = key2str('title',e, 250)
         authors  = key2str('author',e,500)
@@ -159,7 +194,7 @@ def import_bibtex(bibtex_str, nb_max=None, update=True):
         if not key2int('year',e) or not abstract or not title: continue 
         pubdate = datetime(key2int('year',e),1,1)
         keywords = key2str('keyword',e,250)
-        args = dict(title=title, 
+        records.append(dict(title=title, 
                 authors=authors, 
                 pubdate=pubdate,
                 journal=journal,
@@ -168,47 +203,75 @@ def import_bibtex(bibtex_str, nb_max=None, update=True):
                 url=key2str('link',e),
                 doi=key2str('doi',e),
                 pmid=key2int('pmid',e),
-                )
-        if update:
-            art, created = add_or_update_article(**args)
-        else:
-            art, created = get_or_create(**args)
-
-        art.save()
-        data.append(art)
+                ))
 
         if nb_max is not None:
-            if len(data)>=nb_max:
+            if len(records)>=nb_max:
                 break
 
+    # resolve all entries through their canonical keys at once
+    article_ids, created, changed = add_or_update_articles(records, update=update)
+    articles = Article.objects.in_bulk(article_ids.tolist())
+    data = [ articles[int(a)] for a in article_ids ]
+
     logger.info("%i entries processed"%len(data))
     return data
 
-def compute_features( data ):
-    """ Converts a list of tuples with title, authors, abstract, keywords to sparse tokenized feature vectors. """
-    titles, authors, abstracts, keywords = zip(*data)
+feature_fields = ('title', 'authors', 'abstract', 'keywords') # column order of the feature vectors
 
+def get_vectorizer( field ):
     shared_params = dict(stop_words='english', strip_accents=None, non_negative=True, analyzer="word", ngram_range=(1,2) )
-    title_vectorizer    = HashingVectorizer( n_features=feature_dims['title'], **shared_params )
-    authors_vectorizer  = HashingVectorizer( n_features=feature_dims['authors'], **shared_params )
-    # journal_vectorizer  = HashingVectorizer( n_features=feature_dims['journal'], **shared_params )
-    abstract_vectorizer = HashingVectorizer( n_features=feature_dims['abstract'], **shared_params )
-    keywords_vectorizer = HashingVectorizer( n_features=feature_dims['keywords'], **shared_params )
-
-    title_vecs = title_vectorizer.transform(titles)
-    authors_vecs = authors_vectorizer.transform(authors)
-    # journal_vecs = journal_vectorizer.transform(journals)
-    abstract_vecs = abstract_vectorizer.transform(abstracts)
-    keyword_vecs = keywords_vectorizer.transform(keywords)
-
-    feature_vectors = sparse.hstack((title_vecs, authors_vecs, abstract_vecs, keyword_vecs))
+    return HashingVectorizer( n_features=feature_dims[field], **shared_params )
+
+def hash_field( task ):
+    """ Hashes a list of texts of the given field (task is a tuple field, texts) """
+    field, texts = task
+    return get_vectorizer( field ).transform( texts )
+
+def compute_features( data, n_jobs=1, pool=None, shard_size=500 ):
+    """ Converts a list of tuples with title, authors, abstract, keywords to sparse tokenized feature vectors.
+
+    With n_jobs>1 (or a multiprocessing pool) the fields are split into shards of shard_size
+    documents which are hashed concurrently and stacked afterwards. Since the vectorizers are
+    stateless the result is identical to the serial computation.
+    """
+    columns = dict(zip(feature_fields, zip(*data)))
+
+    if pool is None and n_jobs == 1:
+        vecs = [ hash_field( (field, columns[field]) ) for field in feature_fields ]
+    else:
+        tasks = [ (field, columns[field][k:k+shard_size]) for field in feature_fields for k in range(0, len(data), shard_size) ]
+        if pool is None:
+            with multiprocessing.Pool( n_jobs ) as p:
+                shards = p.map( hash_field, tasks )
+        else:
+            shards = pool.map( hash_field, tasks )
+        nb_shards = len(shards)//len(feature_fields)
+        vecs = [ sparse.vstack( shards[k*nb_shards:(k+1)*nb_shards], format='csr' ) for k in range(len(feature_fields)) ]
+
+    feature_vectors = sparse.hstack(vecs)
     return feature_vectors
 
+def pack_feature_vector( indices, values ):
+    """ Packs the indices and values of a sparse feature vector into bytes for a FeatureVector record """
+    indices = np.asarray(indices, dtype=feature_index_dtype)
+    values  = np.asarray(values, dtype=feature_value_dtype)
+    return indices.tobytes(), values.tobytes()
+
+def unpack_feature_vector( indices, values ):
+    """ Converts the packed bytes of a FeatureVector record back to index and value arrays """
+    return np.frombuffer(indices, dtype=feature_index_dtype), np.frombuffer(values, dtype=feature_value_dtype)
+
+def make_feature_vector( article_id, indices, values ):
+    """ Returns an unsaved FeatureVector instance for the given article id and sparse row """
+    packed_indices, packed_values = pack_feature_vector(indices, values)
+    return FeatureVector(article_id=article_id, nnz=len(packed_indices)//feature_index_dtype.itemsize, indices=packed_indices, data=packed_values)
+
 def get_feature_vector( article ):
-    fts = Feature.objects.filter( article=article )
-    index = fts.values_list('index', flat=True)
-    val = fts.values_list('value', flat=True)
-    return index, val
+    fv = FeatureVector.objects.filter( article=article ).values_list('indices', 'data').first()
+    if fv is None:
+        return np.zeros(0, dtype=feature_index_dtype), np.zeros(0, dtype=feature_value_dtype)
+    return unpack_feature_vector( *fv )
 
 def get_feature_vector_size():
     feature_vector_size = 0
@@ -217,19 +280,164 @@ def get_feature_vector_size():
     return feature_vector_size
 
 
-def get_features_from_db( articles ):
-    data = []
-    row = []
-    col = []
-    for i,ai in enumerate(articles):
-        c,v = get_feature_vector( ai )
-        r = np.ones(len(c))*i
-        data.extend(v)
-        row.extend(r)
-        col.extend(c)
+def get_article_ids( articles ):
+    """ Returns the ids of a QuerySet or list of articles as a numpy array (in the same order) """
+    if isinstance(articles, np.ndarray):
+        return articles.astype(np.int64)
+    if isinstance(articles, QuerySet):
+        return np.fromiter(articles.values_list('id', flat=True), dtype=np.int64)
+    return np.array([ a.id for a in articles ], dtype=np.int64)
+
+def iter_feature_vectors( articles, article_ids, chunk_size=900 ):
+    """ Streams (article_id, indices, data) tuples of the packed feature vectors of the given articles
+
+    For an unsliced QuerySet all vectors are read with a single streamed query. Lists and sliced
+    QuerySets are read in chunks of chunk_size ids to stay below the bound parameter limits of the
+    database backends.
+    """
+    fields = ('article_id', 'indices', 'data')
+    if isinstance(articles, QuerySet) and articles.query.can_filter():
+        qs = FeatureVector.objects.filter(article__in=articles.values('id'))
+        for row in qs.values_list(*fields).iterator():
+            yield row
+    else:
+        uniq = np.unique(article_ids)
+        for k in range(0, len(uniq), chunk_size):
+            qs = FeatureVector.objects.filter(article_id__in=uniq[k:k+chunk_size].tolist())
+            for row in qs.values_list(*fields).iterator():
+                yield row
+
+def get_column_weights( columns=None ):
+    """ Returns the feature weight of every column of the feature vectors (or of the given columns only) """
+    weights = np.concatenate([ feature_weights[field]*np.ones(feature_dims[field]) for field in feature_fields ])
+    if columns is None:
+        return weights
+    return weights[columns]
+
+def get_features_from_db( articles, chunk_size=10000 ):
+    """ Loads the feature vectors of the given articles into a sparse CSR matrix with one row per article
+
+    The packed vectors are streamed from the database and decoded in chunks of chunk_size records,
+    so that peak memory stays proportional to the size of the returned matrix. Articles without
+    feature vectors yield empty rows.
 
-    A = sparse.coo_matrix( (data, (row, col)), shape=(len(articles),get_feature_vector_size()))
-    return A
+    args:
+        articles QuerySet or list of articles
+    returns:
+        CSR matrix of shape (len(articles), get_feature_vector_size())
+    """
+    article_ids = get_article_ids( articles )
+    nb_cols = get_feature_vector_size()
+
+    # Decode the streamed records into CSR chunks whose rows are in arrival order
+    ids, nnz, indices, data = [], [], [], []
+    id_chunks, nnz_chunks, index_chunks, data_chunks = [], [], [], []
+    def flush():
+        id_chunks.append(np.array(ids, dtype=np.int64))
+        nnz_chunks.append(np.array(nnz, dtype=np.int64))
+        index_chunks.append(np.frombuffer(b''.join(indices), dtype=feature_index_dtype))
+        data_chunks.append(np.frombuffer(b''.join(data), dtype=feature_value_dtype).astype(np.float64))
+        del ids[:], nnz[:], indices[:], data[:]
+
+    for article_id, packed_indices, packed_data in iter_feature_vectors( articles, article_ids ):
+        ids.append(article_id)
+        nnz.append(len(packed_indices)//feature_index_dtype.itemsize)
+        indices.append(bytes(packed_indices))
+        data.append(bytes(packed_data))
+        if len(ids) >= chunk_size:
+            flush()
+    flush()
+
+    ids = np.concatenate(id_chunks)
+    indptr = np.zeros(len(ids)+2, dtype=np.int64) # last row stays empty for articles without features
+    np.cumsum(np.concatenate(nnz_chunks), out=indptr[1:len(ids)+1])
+    indptr[-1] = indptr[-2]
+    R = sparse.csr_matrix( (np.concatenate(data_chunks), np.concatenate(index_chunks), indptr), shape=(len(ids)+1, nb_cols) )
+
+    # Map every requested article to its row in arrival order
+    rows = np.zeros(len(article_ids), dtype=np.int64)
+    if len(ids):
+        order = np.argsort(ids)
+        pos = np.clip(np.searchsorted(ids[order], article_ids), 0, len(ids)-1)
+        rows = np.where(ids[order][pos]==article_ids, order[pos], len(ids))
+    return R[rows]
+
+
+def select_neighbours( src_ids, dst_ids, values, limit=neighbour_list_size ):
+    """ Keeps the limit largest values of every source article, sorted by source and decreasing value """
+    order = np.lexsort((-values, src_ids))
+    src_ids, dst_ids, values = src_ids[order], dst_ids[order], values[order]
+    rank = np.arange(len(src_ids)) - np.searchsorted(src_ids, src_ids)
+    sel = rank < limit
+    return src_ids[sel], dst_ids[sel], values[sel]
+
+def get_display_fields( article_ids, chunk_size=900 ):
+    """ Returns a dict of the neighbour_list_fields of the given articles by id """
+    fields = {}
+    for k in range(0, len(article_ids), chunk_size):
+        for row in Article.objects.filter( id__in=article_ids[k:k+chunk_size].tolist() ).values_list( *neighbour_list_fields ):
+            entry = dict(zip(neighbour_list_fields, row))
+            entry['pubdate'] = entry['pubdate'].isoformat()
+            fields[entry['id']] = entry
+    return fields
+
+def save_neighbour_lists( article_ids, src_ids, dst_ids, values, limit=neighbour_list_size, chunk_size=1000 ):
+    """ Replaces the neighbour lists of the given articles
+
+    The similarities (src_ids[i], dst_ids[i], values[i]) must contain all neighbours of these
+    articles, an article without similarities gets an empty list.
+    """
+    article_ids = np.unique(article_ids)
+    src_ids, dst_ids, values = select_neighbours( np.asarray(src_ids), np.asarray(dst_ids), np.asarray(values), limit )
+    for k in range(0, len(article_ids), chunk_size):
+        chunk = article_ids[k:k+chunk_size]
+        start, end = np.searchsorted(src_ids, chunk[0], side='left'), np.searchsorted(src_ids, chunk[-1], side='right')
+        src, dst, val = src_ids[start:end], dst_ids[start:end], values[start:end]
+        fields = get_display_fields( np.unique(dst) )
+
+        lists = dict( (int(a), []) for a in chunk )
+        for a, b, v in zip(src.tolist(), dst.tolist(), val.tolist()):
+            if a in lists and b in fields:
+                lists[a].append( dict(fields[b], value=v) )
+        with transaction.atomic():
+            NeighbourList.objects.filter( article_id__in=chunk.tolist() ).delete()
+            NeighbourList.objects.bulk_create( [ NeighbourList(article_id=a, neighbours=json.dumps(n)) for a, n in lists.items() ] )
+
+def get_referrers( article_ids, directed=False, chunk_size=500 ):
+    """ Returns the ids of the articles with a stored similarity to one of article_ids, whose neighbour lists may show them
+
+    Directed similarities (top-k) refer from a to b, undirected ones both ways. Call it before the
+    similarities of article_ids are replaced.
+    """
+    article_ids = np.asarray(article_ids, dtype=np.int64)
+    referrers = []
+    for k in range(0, len(article_ids), chunk_size):
+        chunk = article_ids[k:k+chunk_size].tolist()
+        referrers.extend( Similarity.objects.filter( b__in=chunk ).values_list( 'a_id', flat=True ) )
+        if not directed:
+            referrers.extend( Similarity.objects.filter( a__in=chunk ).values_list( 'b_id', flat=True ) )
+    return np.unique(np.array(referrers, dtype=np.int64))
+
+def get_stored_similarities( article_ids, directed=False, chunk_size=500 ):
+    """ Returns the similarities of the given articles from the similarity table as (source, neighbour, value) arrays
+
+    Directed similarities (top-k) are read from the rows with a=article, undirected ones from
+    the rows with the article on either side.
+    """
+    article_ids = np.asarray(article_ids, dtype=np.int64)
+    rows = []
+    for k in range(0, len(article_ids), chunk_size):
+        chunk = article_ids[k:k+chunk_size].tolist()
+        rows.extend( Similarity.objects.filter( a__in=chunk ).values_list( 'a_id', 'b_id', 'value' ) )
+        if not directed:
+            rows.extend( (b, a, v) for a, b, v in Similarity.objects.filter( b__in=chunk ).values_list( 'a_id', 'b_id', 'value' ) )
+    rows = np.array(rows, dtype=np.float64).reshape(-1, 3)
+    return rows[:,0].astype(np.int64), rows[:,1].astype(np.int64), rows[:,2]
+
+def rebuild_neighbour_lists( article_ids, directed=False, limit=neighbour_list_size ):
+    """ Replaces the neighbour lists of the given articles by the neighbours in the similarity table """
+    src_ids, dst_ids, values = get_stored_similarities( article_ids, directed )
+    save_neighbour_lists( article_ids, src_ids, dst_ids, values, limit )
 
 
 def add_to_training_set( profile, articles, label ):
@@ -241,43 +449,138 @@ def add_to_training_set( profile, articles, label ):
 
 
 def add_or_update_article(title, authors, pubdate, journal, abstract, url=None, doi=None, keywords=None, pmid=None ):
-    art, created = Article.objects.get_or_create(
-            title=title, 
-            authors=authors,
-            defaults={ 'pubdate' : pubdate, 'date_added' : timezone.now() }
-            )
-
-    art.journal=journal
-    art.pubdate=pubdate
-    art.abstract=abstract
-    art.url=url
-    art.doi=doi
-    if keywords is not None: art.keywords=keywords
-    if pmid is not None: art.pmid=pmid
-    art.date_added = timezone.now()
-    art.save()
-
-    Feature.objects.filter( article=art ).delete()
-    return art, created
+    """ Inserts or updates a single article (see add_or_update_articles) and returns it """
+    article_ids, created, changed = add_or_update_articles( [ dict(title=title, authors=authors, pubdate=pubdate, journal=journal,
+        abstract=abstract, url=url, doi=doi, keywords=keywords, pmid=pmid) ] )
+    return Article.objects.get(id=article_ids[0]), bool(created[0])
+
+
+# Fields of the articles set by add_or_update_articles and the ones which enter the feature vectors
+article_fields = ('title', 'authors', 'pubdate', 'journal', 'abstract', 'url', 'doi', 'keywords', 'pmid')
+article_text_fields = ('title', 'authors', 'abstract', 'keywords')
+
+def get_articles_by_keys( candidates, chunk_size=900 ):
+    """ Looks up the articles of lists of candidate keys (see keys.get_article_keys) in the canonical key and title hash indexes
+
+    returns a list (ordered by id) of dicts with the id, article_fields, canonical_key, title_hash, date_added and similarities_dirty of the articles
+    """
+    all_keys = sorted(set( key for c in candidates for key in c ))
+    hash_keys = [ key for key in all_keys if keys.get_key_rank(key) == 2 ]
+    found = {}
+    for column, values in (('canonical_key', all_keys), ('title_hash', hash_keys)):
+        for k in range(0, len(values), chunk_size):
+            qs = Article.objects.filter( **{ column+'__in': values[k:k+chunk_size] } )
+            for a in qs.values('id', 'canonical_key', 'title_hash', 'date_added', 'similarities_dirty', *article_fields):
+                found[a['id']] = a
+    return [ found[article_id] for article_id in sorted(found) ]
+
+def get_record_values( record ):
+    """ Returns the article_fields of a record as they are stored """
+    values = {}
+    for f in article_fields:
+        v = record.get(f)
+        if f in ('keywords', 'pmid') and v is None:
+            continue
+        if f in ('url', 'doi') and v is None:
+            v = ''
+        if f == 'pubdate' and isinstance(v, datetime):
+            v = v.date()
+        values[f] = v
+    return values
+
+def update_articles( rows ):
+    """ Writes the article_fields, canonical_key, title_hash, date_added and similarities_dirty of several articles with one executemany
+
+    args:
+        rows a list of dicts with the id and the new values of the articles
+    """
+    fields = [ Article._meta.get_field(f) for f in article_fields + ('canonical_key', 'title_hash', 'date_added', 'similarities_dirty') ]
+    sql = "UPDATE %s SET %s WHERE %s = %%s"%( connection.ops.quote_name(Article._meta.db_table),
+            ", ".join( "%s = %%s"%connection.ops.quote_name(f.column) for f in fields ), connection.ops.quote_name('id') )
+    params = [ [ f.get_db_prep_save(r[f.name], connection) for f in fields ] + [ r['id'] ] for r in rows ]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+def add_or_update_articles( records, update=True, chunk_size=900 ):
+    """ Inserts or updates the articles of a list of records in one transaction
+
+    The records are dicts with the arguments of add_or_update_article. Articles are resolved
+    through their keys (see papers/keys.py): a record belongs to the article which has one of the
+    candidate keys of the record as canonical key or title hash, preferring the DOI, then the arXiv
+    id and then the title hash. The articles of earlier records of the batch count like existing
+    ones, so all records of a paper end up in one article. New articles are inserted with
+    bulk_create and changed ones are updated with a single executemany (existing articles are left
+    alone if update is False). An article found through a weaker key gets the canonical key of the
+    record. Only if the text of an article changed, its feature vector is deleted and it is marked
+    for the similarity job (date_added is reset like for new articles). Unchanged articles are not
+    written.
+
+    returns:
+    the ids of the articles (in the order of records) and boolean arrays marking the created and the changed ones
+    """
+    candidates = [ keys.get_article_keys(r['title'], r['authors'], r.get('doi'), r.get('url')) for r in records ]
+    now = timezone.now()
+    with transaction.atomic():
+        existing = get_articles_by_keys(candidates, chunk_size)
+        # The first rows are the existing articles, the following ones the new articles of the batch
+        resolver = keys.KeyResolver()
+        rows = []
+        for art in existing:
+            resolver.add_row(art['canonical_key'])
+            rows.append(dict(art))
+        for row, art in enumerate(existing):
+            resolver.claim(row, [ art['title_hash'] ] + keys.get_article_keys(art['title'], art['authors'], art['doi'], art['url']))
+        record_rows = []
+        for c, record in zip(candidates, records):
+            row = resolver.find(c)
+            if row is None:
+                row = resolver.add_row(c[0], c)
+                rows.append(get_record_values(record))
+            else:
+                resolver.claim(row, c)
+                if update or row >= len(existing):
+                    rows[row].update(get_record_values(record))
+                    resolver.promote(row, c[0])
+            record_rows.append(row)
+
+        for row, values in enumerate(rows):
+            values.update( canonical_key=resolver.canonical[row], title_hash=keys.get_hash_key(values['title'], values['authors']) )
+        changed = []
+        changed_rows = set()
+        text_changed = []
+        for row, (art, values) in enumerate(zip(existing, rows)):
+            diff = [ f for f in values if values[f] != art[f] ]
+            if diff:
+                if any( f in article_text_fields for f in diff ):
+                    values.update( date_added=now, similarities_dirty=True )
+                    text_changed.append(art['id'])
+                changed.append(values)
+                changed_rows.add(row)
+
+        new = rows[len(existing):]
+        Article.objects.bulk_create( [ Article( date_added=now, similarities_dirty=True, **values ) for values in new ] )
+        if changed:
+            update_articles(changed)
+        for k in range(0, len(text_changed), chunk_size):
+            FeatureVector.objects.filter( article_id__in=text_changed[k:k+chunk_size] ).delete()
+        new_keys = [ values['canonical_key'] for values in new ]
+        new_ids = {}
+        for k in range(0, len(new_keys), chunk_size):
+            new_ids.update( Article.objects.filter( canonical_key__in=new_keys[k:k+chunk_size] ).values_list('canonical_key', 'id') )
+
+    ids = [ art['id'] for art in existing ] + [ new_ids[key] for key in new_keys ]
+    article_ids = np.array([ ids[row] for row in record_rows ], dtype=np.int64)
+    created = np.array([ row >= len(existing) for row in record_rows ], dtype=bool)
+    changed = np.array([ row in changed_rows for row in record_rows ], dtype=bool)
+    logger.info("%i records: %i articles added, %i updated"%(len(records), len(new), len(changed_rows)))
+    return article_ids, created, changed
 
 
 def get_or_create(title, authors, pubdate, journal, abstract, url=None, doi=None, keywords=None, pmid=None ):
-    art, created = Article.objects.get_or_create(
-            title=title, 
-            authors=authors,
-            defaults={ 'pubdate' : pubdate, 'date_added' : timezone.now() }
-            )
-
-    if created:
-        art.journal=journal
-        art.abstract=abstract
-        art.url=url
-        art.doi=doi
-        if keywords is not None: art.keywords=keywords
-        if pmid is not None: art.pmid=pmid
-        art.save()
-
-    return art, created
+    """ Returns the article of the given data (see add_or_update_articles), which is only created if it does not exist """
+    article_ids, created, changed = add_or_update_articles( [ dict(title=title, authors=authors, pubdate=pubdate, journal=journal,
+        abstract=abstract, url=url, doi=doi, keywords=keywords, pmid=pmid) ], update=False )
+    return Article.objects.get(id=article_ids[0]), bool(created[0])
 
 def get_training_set( profile, padrandom=True ):
     articles = list( profile.ham.all() )
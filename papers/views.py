@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.shortcuts import render
 from django.http import HttpResponse
 from django.template import loader
@@ -7,11 +8,15 @@ from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.http import JsonResponse, HttpResponseRedirect
 
 from . import utils 
+from . import online
 
-from papers.models import Article, Profile, Feature, Recommendation, Similarity
+from papers.models import Article, Profile
 
 from .forms import UploadFileForm
 
+import logging
+logger = logging.getLogger(__name__)
+
 # from django.contrib.auth.models import User
 
 def index(request):
@@ -130,6 +135,12 @@ def ajax_set_label(request):
 
     if article_id:
         err = utils.set_label(request,article_id,label)
+        if err and settings.ONLINE_LEARNING:
+            # The label is saved, a failure of the online update must not turn it into an error
+            try:
+                online.update_profile(Profile.objects.get(user=request.user), article_id, label)
+            except Exception:
+                logger.exception("Online update of the profile of %s failed"%request.user)
 
     response_data = {}
     response_data['article_id'] = article_id
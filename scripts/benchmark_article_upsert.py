@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+""" Compares the per-record utils.add_or_update_article with the batched utils.add_or_update_articles
+
+Synthetic records are inserted, imported again unchanged and imported again with changed
+abstracts. Every measurement runs inside a transaction which is rolled back afterwards, so the
+articles in the database are left untouched.
+
+usage: benchmark_article_upsert.py [number_of_records ...]
+"""
+from __future__ import print_function
+
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import datetime
+from time import time
+
+import django
+from django.db import connection, reset_queries, transaction
+from django.test.utils import CaptureQueriesContext
+
+django.setup()
+
+import papers.utils as utils
+
+
+def make_records(nb_records, version=0):
+    return [ dict(title="Benchmark article %i"%n, authors="A. Author, B. Author", pubdate=datetime.date(2018, 1, 1),
+            journal="arXiv cs", abstract="Abstract %i of article %i"%(version, n), url="https://arxiv.org/abs/1801.%05i"%n,
+            doi="10.1000/%i"%n) for n in range(nb_records) ]
+
+
+def upsert_per_record(records):
+    for r in records:
+        utils.add_or_update_article(**r)
+
+
+def measure(fun, steps):
+    """ Runs fun on the records of every step and returns the time and number of queries of every step """
+    results = []
+    with transaction.atomic():
+        for records in steps:
+            reset_queries()
+            with CaptureQueriesContext(connection) as ctx:
+                t0 = time()
+                fun(records)
+                results.append( (time()-t0, len(ctx.captured_queries)) )
+        transaction.set_rollback(True)
+    return results
+
+
+if __name__ == "__main__":
+    sizes = [ int(n) for n in sys.argv[1:] ] or [ 1000 ]
+    print("%8s %10s %16s %16s %14s %10s"%("records", "step", "single rec/sec", "batch rec/sec", "batch queries", "speedup"))
+    for n in sizes:
+        names = [ "insert", "unchanged", "changed" ]
+        steps = [ make_records(n), make_records(n), make_records(n, version=1) ]
+        single = measure(upsert_per_record, steps)
+        batch = measure(utils.add_or_update_articles, steps)
+        for name, (t_old, _), (t_new, queries) in zip(names, single, batch):
+            print("%8i %10s %16.0f %16.0f %14i %9.1fx"%(n, name, n/t_old, n/max(t_new, 1e-9), queries, t_old/max(t_new, 1e-9)))
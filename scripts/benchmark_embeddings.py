@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+""" Compares the similarities of the dense article embeddings with the sparse weighted features
+
+For every number of components an embedding index is fitted in a temporary directory (the index
+in DATA_DIR is left untouched). The similarities of a sample of articles to all articles are
+computed with both paths and the dense ones are rated by the recall of the exact top-k
+neighbours and of the exact pairs above the cutoff.
+
+usage: benchmark_embeddings.py [--samples N] [--components N ...] [--max-columns N]
+"""
+from __future__ import print_function
+
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import argparse
+import shutil
+import tempfile
+import numpy as np
+from time import time
+
+import django
+
+django.setup()
+
+from papers.models import Article
+import papers.utils as utils
+import papers.feature_store as feature_store
+from papers.embeddings import EmbeddingIndex
+
+
+def top_k_sets(G, k):
+    idx = np.argpartition(-G, k-1, axis=1)[:,:k]
+    return [ set(row) for row in idx ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the dense embedding similarities with the sparse path")
+    parser.add_argument('--samples', type=int, default=500, help="Number of articles whose similarities are compared")
+    parser.add_argument('--components', type=int, nargs='+', default=[32, 64, 128, 256], help="Numbers of components to fit")
+    parser.add_argument('--max-columns', type=int, default=2**16, help="Number of most frequent feature columns used by the fit")
+    parser.add_argument('--top-k', type=int, default=10, help="Number of neighbours for the recall")
+    parser.add_argument('--cutoff', type=float, default=0.33, help="Cutoff value of the similarity")
+    args = parser.parse_args()
+
+    article_ids = utils.get_article_ids(Article.objects.filter(featurevector__isnull=False).order_by('id'))
+    if len(article_ids) <= args.top_k:
+        sys.exit("Not enough articles with feature vectors in the database")
+    sample = np.random.choice(len(article_ids), size=min(args.samples, len(article_ids)), replace=False)
+    X = feature_store.get_weighted_features(article_ids)
+
+    t0 = time()
+    G = X[sample].dot(X.T).toarray()
+    t_sparse = time()-t0
+    G[np.arange(len(sample)), sample] = -np.inf
+    exact_top = top_k_sets(G, args.top_k)
+    exact_pairs = G >= args.cutoff
+    print("%i articles, %i samples: sparse similarities in %.3fs, %i pairs above cutoff"%(len(article_ids), len(sample), t_sparse, exact_pairs.sum()))
+
+    print("%10s %9s %8s %13s %10s %8s %10s %11s %10s"%("components", "variance", "fit [s]", "project [1/s]", "dense [s]", "speedup", "recall@%i"%args.top_k, "cut recall", "cut prec."))
+    path = tempfile.mkdtemp(prefix='embeddings-')
+    try:
+        for n in args.components:
+            index = EmbeddingIndex(os.path.join(path, str(n)))
+            t0 = time()
+            variance = index.fit(article_ids, n_components=n, max_columns=args.max_columns, sample_size=len(article_ids))
+            t_fit = time()-t0
+            t0 = time()
+            index.sync()
+            t_project = time()-t0
+            E = np.asarray(index.get_embeddings(article_ids))
+
+            t0 = time()
+            D = E[sample].dot(E.T)
+            t_dense = time()-t0
+            D[np.arange(len(sample)), sample] = -np.inf
+
+            dense_top = top_k_sets(D, args.top_k)
+            recall = np.mean([ len(a & b)/float(args.top_k) for a, b in zip(exact_top, dense_top) ])
+            dense_pairs = D >= args.cutoff
+            cut_recall = (exact_pairs & dense_pairs).sum()/max(exact_pairs.sum(), 1.0)
+            cut_precision = (exact_pairs & dense_pairs).sum()/max(dense_pairs.sum(), 1.0)
+            print("%10i %8.1f%% %8.1f %13.0f %10.3f %7.1fx %10.3f %11.3f %10.3f"%(index.nb_components, 100*variance, t_fit,
+                len(article_ids)/t_project, t_dense, t_sparse/max(t_dense, 1e-9), recall, cut_recall, cut_precision))
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+""" Measures the throughput of utils.compute_features in documents per second against the number of processes
+
+usage: benchmark_feature_hashing.py [number_of_documents]
+"""
+from __future__ import print_function
+
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import multiprocessing
+from time import time
+
+import django
+
+django.setup()
+
+from papers.models import Article
+import papers.utils as utils
+
+
+if __name__ == "__main__":
+    nb_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    data = list(Article.objects.values_list('title', 'authors', 'abstract', 'keywords')[:nb_docs])
+    if not data:
+        sys.exit("No articles in the database")
+
+    t0 = time()
+    reference = utils.compute_features(data).tocsr()
+    elapsed = time()-t0
+    print("%6s %12s %10s"%("jobs", "docs/sec", "speedup"))
+    print("%6s %12.1f %10s"%("serial", len(data)/elapsed, "1.0x"))
+
+    jobs = 1
+    while jobs <= multiprocessing.cpu_count():
+        with multiprocessing.Pool(jobs) as pool:
+            t0 = time()
+            features = utils.compute_features(data, pool=pool).tocsr()
+            t = time()-t0
+        assert (features != reference).nnz == 0, "Parallel result differs from serial result"
+        print("%6i %12.1f %9.1fx"%(jobs, len(data)/t, elapsed/t))
+        jobs *= 2
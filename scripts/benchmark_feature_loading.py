@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+""" Compares the per-article feature loading with the bulk path of utils.get_features_from_db
+
+usage: benchmark_feature_loading.py [number_of_articles ...]
+"""
+from __future__ import print_function
+
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import numpy as np
+from scipy import sparse
+from time import time
+
+import django
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+django.setup()
+
+from papers.models import Article
+import papers.utils as utils
+
+
+def get_features_per_article(articles):
+    """ The previous implementation which issues one query per article """
+    data = []
+    row = []
+    col = []
+    for i,ai in enumerate(articles):
+        c,v = utils.get_feature_vector( ai )
+        r = np.ones(len(c))*i
+        data.extend(v)
+        row.extend(r)
+        col.extend(c)
+
+    A = sparse.coo_matrix( (data, (row, col)), shape=(len(articles),utils.get_feature_vector_size()))
+    return A
+
+
+def measure(fun, articles):
+    with CaptureQueriesContext(connection) as ctx:
+        t0 = time()
+        A = fun(articles)
+        elapsed = time()-t0
+    return A, len(ctx.captured_queries), elapsed
+
+
+if __name__ == "__main__":
+    sizes = [ int(n) for n in sys.argv[1:] ] or [ 100, 1000, 10000 ]
+
+    print("%10s %12s %9s %12s %9s %10s"%("articles", "old queries", "old [s]", "new queries", "new [s]", "speedup"))
+    for n in sizes:
+        articles = list(Article.objects.order_by('id')[:n])
+        A, q_old, t_old = measure(get_features_per_article, articles)
+        B, q_new, t_new = measure(utils.get_features_from_db, articles)
+        assert abs(A.tocsr()-B).max() == 0.0, "Results differ"
+        print("%10i %12i %9.3f %12i %9.3f %9.1fx"%(len(articles), q_old, t_old, q_new, t_new, t_old/max(t_new,1e-9)))
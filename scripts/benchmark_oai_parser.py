@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+""" Compares the records/sec and peak memory of the arXiv OAI-PMH parsers
+
+The streaming parser papers.oai.iter_records is compared with the previous BeautifulSoup walk of
+scrape_arxiv.py and the ET.parse of import_arxiv_xml.py. Every parser runs in a child process
+whose peak resident memory is reported. Without a dump (see arxiv_download_xml.py) a synthetic
+ListRecords response with the given number of records is written to a temporary file.
+
+usage: benchmark_oai_parser.py [--records N] [dump.xml ...]
+"""
+from __future__ import print_function
+
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import argparse
+import multiprocessing
+import resource
+import tempfile
+from time import time
+
+import papers.oai as oai
+
+record_template = u"""<record><header><identifier>oai:arXiv.org:{id}</identifier><datestamp>2018-01-02</datestamp><setSpec>cs</setSpec></header>
+<metadata><arXivRaw xmlns="http://arxiv.org/OAI/arXivRaw/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+<id>{id}</id><submitter>A. Author</submitter>
+<version version="v1"><date>Mon, 1 Jan 2018 10:00:00 GMT</date><size>100kb</size><source_type>D</source_type></version>
+<version version="v2"><date>Tue, 2 Jan 2018 10:00:00 GMT</date><size>101kb</size><source_type>D</source_type></version>
+<title>A synthetic article number {n} on the
+  learning of representations</title>
+<authors>First Author, Second Author and Third Author</authors>
+<categories>cs.LG stat.ML</categories><comments>10 pages</comments><doi>10.1000/{n}</doi>
+<abstract>  {abstract}
+</abstract></arXivRaw></metadata></record>
+"""
+
+
+def write_dump(filename, nb_records):
+    abstract = u" ".join([u"word%i"%(k%97) for k in range(150)])
+    with open(filename, 'w') as f:
+        f.write(u'<?xml version="1.0" encoding="UTF-8"?>\n<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><responseDate>2018-01-03T00:00:00Z</responseDate><ListRecords>\n')
+        for n in range(nb_records):
+            f.write(record_template.format(id=u"1801.%05i"%n, n=n, abstract=abstract))
+        f.write(u'<resumptionToken cursor="0" completeListSize="%i"></resumptionToken></ListRecords></OAI-PMH>\n'%nb_records)
+
+
+def parse_bs4(filename):
+    """ The previous scraper which builds a BeautifulSoup tree of the whole response """
+    from bs4 import BeautifulSoup as bs
+    with open(filename, 'rb') as f:
+        xml = bs(f.read(), 'lxml')
+    count = 0
+    for entry in xml.find_all('record'):
+        [ entry.find(name).text.strip() for name in ['id', 'title', 'authors', 'abstract', 'date'] ]
+        count += 1
+    return count
+
+
+def parse_etree(filename):
+    """ The previous importer which parses the whole file with ET.parse """
+    root = oai.ET.parse(filename).getroot()
+    count = 0
+    for r in root.findall('.//' + oai.record_tag):
+        oai.parse_record(r)
+        count += 1
+    return count
+
+
+def parse_iter(filename):
+    count = 0
+    for record in oai.iter_records(filename):
+        count += 1
+    return count
+
+
+def measure(task):
+    fun, filenames = task
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time()
+    count = sum(fun(filename) for filename in filenames)
+    elapsed = time()-t0
+    # ru_maxrss is in kilobytes on Linux
+    return count, elapsed, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-rss)/1024.0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the arXiv OAI-PMH parsers")
+    parser.add_argument('--records', type=int, default=50000, help="Number of records of the synthetic dump")
+    parser.add_argument('filenames', nargs='*', help="OAI-PMH ListRecords dumps")
+    args = parser.parse_args()
+
+    filenames = args.filenames
+    tmp = None
+    if not filenames:
+        tmp = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+        tmp.close()
+        write_dump(tmp.name, args.records)
+        filenames = [ tmp.name ]
+    size = sum(os.path.getsize(f) for f in filenames)/1024.0**2
+    print("%i files, %.1f MB"%(len(filenames), size))
+
+    try:
+        print("%12s %10s %14s %14s"%("parser", "records", "records/sec", "peak mem [MB]"))
+        for name, fun in [ ("bs4", parse_bs4), ("ET.parse", parse_etree), ("iterparse", parse_iter) ]:
+            # A fresh process per parser, so the peak memory of one does not hide the next
+            pool = multiprocessing.Pool(1, maxtasksperchild=1)
+            count, elapsed, mem = pool.map(measure, [ (fun, filenames) ])[0]
+            pool.close()
+            pool.join()
+            print("%12s %10i %14.0f %14.1f"%(name, count, count/max(elapsed, 1e-9), mem))
+    finally:
+        if tmp is not None:
+            os.remove(tmp.name)
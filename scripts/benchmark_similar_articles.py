@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+""" Measures the latency of the similar articles of the details view
+
+Compares the previous lookup in the Similarity table with the precomputed neighbour lists of
+utils.get_similar_articles. With --rows the Similarity table is first filled with random pairs
+(inside a transaction which is rolled back afterwards) to measure the lookup on a large table.
+
+usage: benchmark_similar_articles.py [--rows N] [--samples N]
+"""
+from __future__ import print_function
+
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import argparse
+import numpy as np
+from time import time
+
+import django
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+
+django.setup()
+
+from papers.models import Article, NeighbourList, Similarity
+import papers.utils as utils
+from compute_gramian import add_similarity_pairs_to_db
+
+
+def get_similar_articles_from_table(article, limit=11):
+    """ The previous implementation which queries the similarity table and loads the articles lazily """
+    similarities = Similarity.objects.filter( Q(a=article) | Q(b=article) ).order_by('-value')[:limit]
+    articles = []
+    for s in similarities:
+        if s.a==article:
+            articles.append(s.b)
+        else:
+            articles.append(s.a)
+    # Access the displayed fields like the template does
+    return [ (a.id, a.title, a.authors, a.url, a.journal, a.pubdate) for a in articles ]
+
+
+def get_similar_articles_from_lists(article, limit=11):
+    return [ (a['id'], a['title'], a['authors'], a['url'], a['journal'], a['pubdate']) for a in utils.get_similar_articles(article, limit) ]
+
+
+def measure(fun, articles):
+    latencies = []
+    with CaptureQueriesContext(connection) as ctx:
+        for article in articles:
+            t0 = time()
+            fun(article)
+            latencies.append(time()-t0)
+    return 1000*np.array(latencies), 1.0*len(ctx.captured_queries)/len(articles)
+
+
+def add_random_similarities(article_ids, nb_rows, sample_ids):
+    """ Adds random pairs to the Similarity table and the neighbour lists of the sample articles """
+    n = len(article_ids)
+    keys = np.unique(np.random.randint(0, n**2, size=nb_rows))
+    a, b = article_ids[keys//n], article_ids[keys%n]
+    values = np.random.rand(len(keys))
+    sel = a != b
+    a, b, values = a[sel], b[sel], values[sel]
+    add_similarity_pairs_to_db(a, b, values)
+    utils.save_neighbour_lists(sample_ids, np.concatenate((a, b)), np.concatenate((b, a)), np.concatenate((values, values)))
+
+
+def run(samples):
+    print("Similarity table: %i rows, %i neighbour lists"%(Similarity.objects.count(), NeighbourList.objects.count()))
+    print("%12s %14s %12s %12s"%("path", "queries/view", "median [ms]", "p95 [ms]"))
+    for name, fun in [ ("table", get_similar_articles_from_table), ("lists", get_similar_articles_from_lists) ]:
+        latencies, queries = measure(fun, samples)
+        print("%12s %14.1f %12.2f %12.2f"%(name, queries, np.median(latencies), np.percentile(latencies, 95)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the latency of the similar articles lookup")
+    parser.add_argument('--rows', type=int, default=0, help="Add this many random similarities before measuring (rolled back)")
+    parser.add_argument('--samples', type=int, default=200, help="Number of articles to look up")
+    args = parser.parse_args()
+
+    if args.rows:
+        article_ids = utils.get_article_ids(Article.objects.order_by('id'))
+        sample_ids = np.random.choice(article_ids, size=min(args.samples, len(article_ids)), replace=False)
+        with transaction.atomic():
+            Similarity.objects.all().delete()
+            add_random_similarities(article_ids, args.rows, sample_ids)
+            run(list(Article.objects.filter(id__in=sample_ids.tolist())))
+            transaction.set_rollback(True)
+    else:
+        samples = list(Article.objects.filter(neighbourlist__isnull=False).order_by('?')[:args.samples])
+        if not samples:
+            sys.exit("No neighbour lists in the database, run compute_gramian.py first")
+        run(samples)
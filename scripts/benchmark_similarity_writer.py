@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+""" Compares the insert throughput (rows/sec) of the ORM Similarity writer with add_similarities_to_db
+
+Random similarity matrices over the articles in the database are written inside a transaction
+which is rolled back afterwards, so the stored similarities are left untouched.
+
+usage: benchmark_similarity_writer.py [number_of_rows ...]
+"""
+from __future__ import print_function
+
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import numpy as np
+from scipy import sparse
+from time import time
+
+import django
+from django.db import transaction
+
+django.setup()
+
+from papers.models import Article, Similarity
+import papers.utils as utils
+from compute_gramian import add_similarities_to_db
+
+
+def add_similarities_to_db_orm(articles, C, commit_count=5000):
+    """ The previous implementation which builds one ORM object per pair """
+    off = C.shape[0]-C.shape[1]
+    batch = []
+    for i in range(len(articles)):
+        a = articles[i]
+        row = C.getrow(i)
+        _,idx,vals = sparse.find(row)
+        batch.extend( [ Similarity( a=a, b=articles[int(k+off)], value=v) for k,v in zip(idx, vals) ] )
+        if len(batch)>commit_count:
+            Similarity.objects.bulk_create( batch )
+            batch = []
+    Similarity.objects.bulk_create( batch )
+
+
+def random_similarities(nb_articles, nb_rows):
+    keys = np.unique(np.random.randint(0, nb_articles**2, size=nb_rows))
+    return sparse.coo_matrix( (np.random.rand(len(keys)), (keys//nb_articles, keys%nb_articles)), shape=(nb_articles, nb_articles) )
+
+
+def measure(fun, articles, C):
+    with transaction.atomic():
+        Similarity.objects.all().delete()
+        t0 = time()
+        fun(articles, C)
+        elapsed = time()-t0
+        assert Similarity.objects.count() == C.nnz, "Wrong number of rows"
+        transaction.set_rollback(True)
+    return elapsed
+
+
+if __name__ == "__main__":
+    sizes = [ int(n) for n in sys.argv[1:] ] or [ 10000, 100000 ]
+    articles = list(Article.objects.order_by('id').only('id'))
+    if not articles:
+        sys.exit("No articles in the database")
+    article_ids = utils.get_article_ids(articles)
+
+    print("%10s %14s %14s %10s"%("rows", "orm rows/sec", "new rows/sec", "speedup"))
+    for n in sizes:
+        C = random_similarities(len(articles), n)
+        t_old = measure(add_similarities_to_db_orm, articles, C)
+        t_new = measure(add_similarities_to_db, article_ids, C)
+        print("%10i %14.0f %14.0f %9.1fx"%(C.nnz, C.nnz/t_old, C.nnz/t_new, t_old/max(t_new,1e-9)))
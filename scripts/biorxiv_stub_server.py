@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+""" A local stand-in for biorxiv.org which replays saved listing and detail pages
+
+The pages are read from a directory in the layout written by `scrape_bioarxiv.py --save-pages`:
+the search listing of a day in search/<year>-<month>-<day>.html and a detail page
+/content/early/... in content/early/....html. Requests (GET or POST) for other pages get a 404.
+The response delay and a fraction of 503 errors can be set to try the concurrency and retries
+of the scraper against it:
+
+    python3 biorxiv_stub_server.py pages/ --port 8765 --delay 0.2 --fail-rate 0.1
+    python3 scrape_bioarxiv.py --base-url http://localhost:8765 --concurrency 8
+"""
+from __future__ import print_function
+
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import time
+import random
+import argparse
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+from papers.fetcher import get_page_filename
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    root = '.'
+    delay = 0.
+    fail_rate = 0.
+
+    def reply(self):
+        time.sleep(self.delay)
+        if random.random() < self.fail_rate:
+            self.send_error(503)
+            return
+        try:
+            filename = get_page_filename(self.root, self.path)
+        except ValueError:
+            filename = None
+        if filename is None or not os.path.isfile(filename):
+            self.send_error(404)
+            return
+        with open(filename, 'rb') as f:
+            content = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.reply()
+
+    def do_POST(self):
+        # The scraper posts its requests like biorxiv.org expected them, the body is ignored
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.reply()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve saved bioRxiv pages")
+    parser.add_argument('root', help="Directory of the saved pages")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--delay', type=float, default=0., help="Seconds before every response")
+    parser.add_argument('--fail-rate', type=float, default=0., help="Fraction of requests answered with a 503")
+    args = parser.parse_args()
+
+    StubHandler.root = args.root
+    StubHandler.delay = args.delay
+    StubHandler.fail_rate = args.fail_rate
+    server = ThreadingHTTPServer(('localhost', args.port), StubHandler)
+    print("Serving %s on http://localhost:%i"%(args.root, args.port))
+    server.serve_forever()
@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+""" Computes article similarities from the candidate pairs of the random projection index
+
+Instead of the exact all-pairs Gramian of compute_gramian.py only the pairs of articles which
+share a bucket of the index (papers.ann) are scored with the weighted metric. New articles and
+articles flagged with similarities_dirty (their features changed) are (re)hashed into the index,
+and only their pairs are recomputed. In top-k mode (settings.SIMILARITY_TOP_K) the hashing is
+incremental as well, but the candidate pairs of all articles are rescored and replace all
+similarities, because a new article can displace the neighbours of any article.
+
+usage: compute_ann_similarities.py [--rebuild] [--recall-sample N]
+"""
+from __future__ import print_function
+
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir) 
+
+import argparse
+import numpy as np
+from scipy import sparse
+from time import time
+
+import django
+from django.conf import settings
+from django.utils import timezone
+
+django.setup()
+
+from papers.models import Article, Similarity
+from papers.ann import RandomProjectionIndex, score_pairs
+import papers.utils as utils
+import papers.feature_store as feature_store
+from compute_gramian import TopKNeighbours, add_similarities_to_db, store_neighbour_lists, clear_dirty_flags
+
+
+def measure_recall(X, a, b, scores, cutoff, sample_size=200, top_k=None, rows=None):
+    """ Compares the pairs found with the exact similarities of a sample of rows
+
+    The exact pairs are those above the cutoff, or the top_k most similar articles of every
+    sample row if top_k is given. The sample is drawn from rows (default all rows), which must
+    contain the rows the candidate pairs were searched for in an incremental run. Returns the
+    fraction of exact pairs (involving a sample row) which were found and their number.
+    """
+    rows = np.arange(X.shape[0]) if rows is None else np.asarray(rows)
+    sample = np.random.choice(rows, size=min(sample_size, len(rows)), replace=False)
+    G = X[sample].dot(X.T).toarray()
+    G[np.arange(len(sample)), sample] = -np.inf
+    if top_k is None:
+        rows, cols = np.nonzero(G >= cutoff)
+        sel = scores >= cutoff
+    else:
+        k = min(top_k, G.shape[1]-1)
+        cols = np.argpartition(-G, k-1, axis=1)[:,:k].ravel()
+        rows = np.repeat(np.arange(len(sample)), k)
+        keep = G[rows, cols] > 0
+        rows, cols = rows[keep], cols[keep]
+        sel = np.ones(len(a), dtype=bool)
+    exact = set(zip(sample[rows], cols))
+
+    src, dst, val = np.concatenate((a[sel], b[sel])), np.concatenate((b[sel], a[sel])), np.concatenate((scores[sel], scores[sel]))
+    s = np.isin(src, sample)
+    if top_k is not None:
+        neighbours = TopKNeighbours(X.shape[0], top_k)
+        neighbours.add(src[s], dst[s], val[s])
+        src, dst, _ = neighbours.edges()
+        s = np.ones(len(src), dtype=bool)
+    found = set(zip(src[s], dst[s]))
+    return 1.0*len(exact & found)/max(len(exact), 1), len(exact)
+
+
+def compute_ann_similarities(rebuild=False, cutoff=0.33, recall_sample=0, **index_params):
+    top_k = settings.SIMILARITY_TOP_K
+    started = timezone.now()
+    articles = Article.objects.filter(featurevector__isnull=False).order_by('id')
+    article_ids = utils.get_article_ids(articles)
+    dirty_ids = utils.get_article_ids(articles.filter(similarities_dirty=True))
+
+    print("Loading weighted features of %i articles..."%len(article_ids))
+    X = feature_store.get_weighted_features(article_ids)
+
+    index = RandomProjectionIndex(**index_params)
+    if rebuild:
+        index.clear()
+        new_ids = article_ids
+    else:
+        # Entries of changed articles are superseded by their new keys
+        new_ids = np.union1d(np.setdiff1d(article_ids, index.article_ids), dirty_ids)
+    print("Hashing %i articles..."%len(new_ids))
+    t0 = time()
+    index.add(new_ids, X[np.searchsorted(article_ids, new_ids)])
+    if top_k is not None:
+        new_ids = article_ids
+
+    a, b = index.candidate_pairs(None if len(new_ids)==len(article_ids) else new_ids)
+    # Drop articles which were deleted since they were indexed
+    known = np.isin(a, article_ids) & np.isin(b, article_ids)
+    a, b = np.searchsorted(article_ids, a[known]), np.searchsorted(article_ids, b[known])
+    print("Scoring %i candidate pairs..."%len(a))
+    scores = score_pairs(X, a, b)
+    print("Found candidates in %.1fs (%.2f%% of all pairs)"%(time()-t0, 200.0*len(a)/max(len(article_ids)**2, 1)))
+
+    if recall_sample:
+        # An incremental run only searches the pairs of the new articles
+        rows = np.searchsorted(article_ids, new_ids)
+        recall, nb_exact = measure_recall(X, a, b, scores, cutoff, recall_sample, top_k, rows)
+        print("Recall %.1f%% of %i exact pairs (%s) in a sample of %i %sarticles"%(100*recall, nb_exact,
+            "above cutoff" if top_k is None else "top %i"%top_k, min(recall_sample, len(rows)),
+            "" if len(new_ids)==len(article_ids) else "new "))
+
+    if top_k is not None:
+        neighbours = TopKNeighbours(len(article_ids), top_k)
+        neighbours.add(np.concatenate((a, b)), np.concatenate((b, a)), np.concatenate((scores, scores)))
+        src, dst, val = neighbours.edges()
+    else:
+        sel = scores >= cutoff
+        src, dst, val = a[sel], b[sel], scores[sel]
+
+    print("Saving %i similarities to db..."%len(val))
+    stale = None
+    if len(new_ids)==len(article_ids):
+        Similarity.objects.all().delete()
+    else:
+        # The articles which showed a changed article, collected before its similarities are replaced
+        stale = utils.get_referrers(new_ids)
+        Similarity.objects.filter(a__in=new_ids.tolist()).delete()
+        Similarity.objects.filter(b__in=new_ids.tolist()).delete()
+    C = sparse.coo_matrix( (val, (src, dst)), shape=(len(article_ids), len(article_ids)) )
+    add_similarities_to_db(article_ids, C)
+    print("Saving neighbour lists...")
+    store_neighbour_lists(article_ids, src, dst, val, directed=top_k is not None,
+            dirty=None if len(new_ids)==len(article_ids) else np.searchsorted(article_ids, new_ids), stale=stale)
+    clear_dirty_flags(new_ids, started)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute similarities of candidate pairs from the random projection index")
+    parser.add_argument('--rebuild', action='store_true', help="Rebuild the index and all similarities")
+    parser.add_argument('--cutoff', type=float, default=0.33, help="Cutoff value of the similarity")
+    parser.add_argument('--recall-sample', type=int, default=0, help="Measure the recall against the exact similarities of a sample of articles")
+    parser.add_argument('--tables', type=int, default=16, help="Number of hash tables of a new index")
+    parser.add_argument('--bits', type=int, default=8, help="Number of bits per hash table of a new index")
+    args = parser.parse_args()
+
+    compute_ann_similarities(rebuild=args.rebuild, cutoff=args.cutoff, recall_sample=args.recall_sample,
+            nb_tables=args.tables, nb_bits=args.bits)
@@ -7,48 +7,83 @@ parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir) 
 
 import sys
+import argparse
+import multiprocessing
 import scipy
 from tqdm import tqdm
 
 import django
 from django.utils import timezone
-from django.db.models import Count
+from django.db import transaction
 
 
 django.setup()
 
-from papers.models import Article, Feature
+from papers.models import Article, FeatureVector
 import papers.utils as utils
 
-def get_articles_without_features():
-    articles = Article.objects.annotate(num_children=Count('feature')).filter(num_children=0)
-    data = []
-    for art in articles:
-        data.append( (art.title, art.authors, art.abstract, art.keywords) )
-    return articles, data
+def count_articles_without_features():
+    return Article.objects.filter(featurevector__isnull=True).count()
 
-def get_features(data):
-    features = scipy.sparse.csr_matrix( utils.compute_features( data ) )
+def iter_articles_without_features(chunk_size=1000):
+    """ Yields lists of (id, title, authors, abstract, keywords) tuples of articles without feature vectors
+
+    Articles are paged by id, so every chunk costs one indexed query and only one chunk is held
+    in memory. Since articles which already have features are skipped, an interrupted run simply
+    resumes with the first article it did not finish.
+    """
+    last_id = 0
+    while True:
+        chunk = list(Article.objects.filter(featurevector__isnull=True, id__gt=last_id).order_by('id')
+                .values_list('id', 'title', 'authors', 'abstract', 'keywords')[:chunk_size])
+        if not chunk:
+            break
+        last_id = chunk[-1][0]
+        yield chunk
+
+def get_features(data, pool=None):
+    features = scipy.sparse.csr_matrix( utils.compute_features( data, pool=pool ) )
     return features
 
-def add_features_to_db(articles, features, stride=200):
-    for k in tqdm(range(len(articles)//stride+1)):
-        start = int(k*stride)
-        end   = min((k+1)*stride,features.shape[0])
-        A = scipy.sparse.coo_matrix(features[start:end])
-        Feature.objects.bulk_create( [ Feature( article=articles[int(i+k*stride)], index=int(j), value=float(v)) for i,j,v in zip(A.row, A.col, A.data) ] )
+def add_features_to_db(article_ids, features):
+    features = scipy.sparse.csr_matrix(features)
+    features.sort_indices()
+    FeatureVector.objects.bulk_create( [ utils.make_feature_vector( article_id,
+        features.indices[features.indptr[i]:features.indptr[i+1]],
+        features.data[features.indptr[i]:features.indptr[i+1]] ) for i,article_id in enumerate(article_ids) ] )
 
-if __name__ == "__main__":
-    # Feature.objects.all().delete()
+def compute_missing_features(chunk_size=1000, n_jobs=1):
+    """ Computes and stores the features of all articles without feature vectors chunk by chunk
 
-    print("Finding articles without features...")
-    articles, data = get_articles_without_features()
+    Each chunk is hashed (by a pool of n_jobs processes if n_jobs>1), written and committed
+    before the next one is read.
 
-    if not len(data):
-        sys.exit()
+    returns the number of processed articles
+    """
+    pool = multiprocessing.Pool(n_jobs) if n_jobs != 1 else None
+    count = 0
+    try:
+        with tqdm(total=count_articles_without_features()) as progress:
+            for chunk in iter_articles_without_features(chunk_size):
+                article_ids = [ c[0] for c in chunk ]
+                features = get_features([ c[1:] for c in chunk ], pool=pool)
+                with transaction.atomic():
+                    add_features_to_db(article_ids, features)
+                count += len(chunk)
+                progress.update(len(chunk))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return count
 
-    print("Computing features for %i articles..."%(len(data)))
-    features = get_features(data)
+if __name__ == "__main__":
+    # FeatureVector.objects.all().delete()
+    parser = argparse.ArgumentParser(description="Compute feature vectors of new articles")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of hashing processes (0 for one per core)")
+    parser.add_argument('--chunk-size', type=int, default=1000, help="Number of articles per committed chunk")
+    args = parser.parse_args()
 
-    print("Adding %i feature vectors to db... "%(features.shape[0]))
-    add_features_to_db(articles, features)
+    print("Computing features for articles without feature vectors...")
+    count = compute_missing_features(chunk_size=args.chunk_size, n_jobs=args.jobs or None)
+    print("Added %i feature vectors to db"%count)
@@ -6,6 +6,12 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir) 
 
+import argparse
+import io
+import multiprocessing
+import shutil
+import tempfile
+from collections import OrderedDict
 import numpy as np
 import scipy
 from scipy import sparse
@@ -25,145 +31,599 @@ from sklearn import metrics
 from time import time
 
 import django
+from django.conf import settings
 from django.utils import timezone
-from django.db.models import Max
+from django.db import connection, transaction
 
 django.setup()
 
-from papers.models import Article, Feature, Profile, Recommendation, Similarity
+from papers.models import Article, Profile, Recommendation, Similarity
 
 import papers.utils as utils
+import papers.feature_store as feature_store
+import papers.embeddings as embeddings
 from compute_feature_vectors import *
 
 
-feature_weights = { 'title' : 1.0,  'authors' : 0.5,  'abstract' : 1.0, 'keywords' : 1.0 }
+class BlockCache(object):
+    """ Bounded LRU cache of weighted feature blocks for the Gramian
 
+    Block i holds the feature vectors of the articles article_ids[i*block_size:(i+1)*block_size]
+    with every column scaled by the square root of its weight in the metric M, so that the block
+    product A.dot(B.T) equals A M B^T. With max_blocks=None every block is loaded exactly once.
+    With an embeddings.EmbeddingIndex the blocks are the dense embeddings of the articles instead.
+    """
+
+    def __init__(self, article_ids, block_size, max_blocks=None, columns=None, embeddings=None):
+        self.article_ids = article_ids
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.columns = columns
+        self.embeddings = embeddings
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, i):
+        return self.load_articles(self.article_ids[i*self.block_size:(i+1)*self.block_size])
+
+    def load_articles(self, article_ids):
+        """ Loads the weighted features of the given articles (bypassing the cache) """
+        if self.embeddings is not None:
+            return self.embeddings.get_embeddings(article_ids)
+        if self.columns is None:
+            return feature_store.get_weighted_features(article_ids)
+        X = feature_store.get_features(article_ids)
+        self.columns.update(X)
+        X = self.columns.transform(X)
+        return X.dot(sparse.diags(np.sqrt(self.columns.weights()), format='csr'))
+
+    def get(self, i):
+        if i in self.blocks:
+            self.hits += 1
+            self.blocks.move_to_end(i)
+        else:
+            self.misses += 1
+            self.blocks[i] = self.load(i)
+            if self.max_blocks is not None and len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+        return self.blocks[i]
+
+    def hit_rate(self):
+        return 1.0*self.hits/max(self.hits+self.misses, 1)
+
+
+def select_top_k(D, k):
+    """ Selects the k largest positive entries of every row of the dense block D
+
+    returns:
+    row indices, column indices and values of the selected entries
+    """
+    k = min(k, D.shape[1])
+    if k == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    idx = np.argpartition(-D, k-1, axis=1)[:,:k]
+    vals = np.take_along_axis(D, idx, axis=1).ravel()
+    rows = np.repeat(np.arange(D.shape[0]), k)
+    mask = vals > 0
+    return rows[mask], idx.ravel()[mask], vals[mask]
+
+
+class TopKNeighbours(object):
+    """ Bounded buffer of the k most similar articles of every article (O(N k) memory) """
+
+    def __init__(self, nb_articles, k):
+        self.k = k
+        self.vals = -np.inf*np.ones((nb_articles, k))
+        self.idx = -np.ones((nb_articles, k), dtype=np.int64)
+
+    def add(self, src, dst, val):
+        """ Merges the candidate neighbours dst of the articles src with the current ones """
+        rows = np.unique(src)
+        old_dst = self.idx[rows].ravel()
+        keep = old_dst >= 0
+        src = np.concatenate((np.repeat(rows, self.k)[keep], src))
+        dst = np.concatenate((old_dst[keep], dst))
+        val = np.concatenate((self.vals[rows].ravel()[keep], val))
+
+        # Rank the candidates of every article by value and keep the first k
+        order = np.lexsort((-val, src))
+        src, dst, val = src[order], dst[order], val[order]
+        rank = np.arange(len(src)) - np.searchsorted(src, src)
+        sel = rank < self.k
+
+        self.vals[rows] = -np.inf
+        self.idx[rows] = -1
+        self.vals[src[sel], rank[sel]] = val[sel]
+        self.idx[src[sel], rank[sel]] = dst[sel]
+
+    def edges(self):
+        """ Returns source, neighbour and value arrays of all stored neighbours """
+        src, col = np.nonzero(self.idx >= 0)
+        return src, self.idx[src, col], self.vals[src, col]
+
+
+def compute_block(A, B, i, j, cutoff=0.33, top_k=None):
+    """ Computes and sparsifies the block (i, j) of the Gramian from the weighted feature blocks A and B
+
+    A and B are either sparse feature blocks or dense embedding blocks.
 
-def compute_gramian(start_block=0, maxblock=None, cutoff=0.33, block_size=1000):
+    returns:
+    The sparsified block in coo format or, in top-k mode, a list with the (row, column, value)
+    candidates of the rows of block i and (for i!=j, transposed) of the rows of block j
+    """
+    C = A.dot(B.transpose())
+    if not sparse.issparse(C):
+        C = np.asarray(C, dtype=np.float64)
+    if top_k is not None:
+        D = C.toarray() if sparse.issparse(C) else C
+        if i==j:
+            np.fill_diagonal(D, -np.inf)
+            return [ select_top_k(D, top_k) ]
+        return [ select_top_k(D, top_k), select_top_k(D.T, top_k) ]
+    if not sparse.issparse(C):
+        if i==j:
+            C = np.tril(C,-1)
+        return sparse.coo_matrix(np.where(C >= cutoff, C, 0))
+    if i==j:
+        C = sparse.tril(C,-1)
+    return sparse.coo_matrix(C.multiply(C >= cutoff))
+
+
+_shared_blocks = {}
+
+def load_shared_block(path, i, nb_columns):
+    if (path, i) not in _shared_blocks:
+        _shared_blocks[(path, i)] = feature_store.load_shared_matrix(path, str(i), nb_columns)
+    return _shared_blocks[(path, i)]
+
+
+def compute_shared_block(task):
+    """ Worker of the parallel Gramian: computes a block from the shared feature blocks """
+    path, i, j, nb_columns, cutoff, top_k = task
+    t0 = time()
+    A = load_shared_block(path, i, nb_columns)
+    B = load_shared_block(path, j, nb_columns)
+    return i, j, compute_block(A, B, i, j, cutoff, top_k), time()-t0
+
+
+def iter_blocks(tasks, cache, cutoff=0.33, top_k=None, columns=None):
+    """ Computes the blocks of tasks one after the other and yields (i, j, block, seconds) """
+    for i,j in tasks:
+        t0 = time()
+        A = cache.get(i)
+        B = cache.get(j)
+        if columns is not None:
+            # The column map may have grown since the blocks were loaded
+            A, B = columns.resize(A), columns.resize(B)
+        yield i, j, compute_block(A, B, i, j, cutoff, top_k), time()-t0
+
+
+def iter_blocks_parallel(tasks, cache, nb_blocks, n_jobs, cutoff=0.33, top_k=None):
+    """ Computes the blocks of tasks with a pool of n_jobs processes and yields (i, j, block, seconds)
+
+    Every feature block is loaded once through the cache and written to a temporary directory,
+    from which the workers memory-map it, so no features are pickled per task. The workers
+    sparsify the blocks and the results are yielded in the order of tasks.
+    """
+    path = tempfile.mkdtemp(prefix='gramian-')
+    try:
+        nb_columns = 0
+        for i in range(nb_blocks):
+            X = cache.get(i)
+            feature_store.save_shared_matrix(path, str(i), X)
+            nb_columns = max(nb_columns, X.shape[1])
+        with multiprocessing.Pool(n_jobs) as pool:
+            for result in pool.imap(compute_shared_block, [ (path, i, j, nb_columns, cutoff, top_k) for i,j in tasks ]):
+                yield result
+    finally:
+        shutil.rmtree(path)
+
+
+def compute_update_block(A, B, rows, j, block_size, cutoff=0.33, top_k=None):
+    """ Computes the similarities of the dirty articles at the positions rows (features A) with block j (features B)
+
+    returns:
+    The entries above the cutoff in coo format or, in top-k mode, a list with the (row, column,
+    value) candidates of the dirty articles and (transposed) of the articles of block j
+    """
+    C = A.dot(B.transpose())
+    if top_k is not None:
+        D = C.toarray() if sparse.issparse(C) else np.asarray(C, dtype=np.float64)
+        own = (rows >= j*block_size) & (rows < (j+1)*block_size)
+        D[np.flatnonzero(own), rows[own]-j*block_size] = -np.inf
+        return [ select_top_k(D, top_k), select_top_k(D.T, top_k) ]
+    C = sparse.coo_matrix(C)
+    sel = C.data >= cutoff
+    return sparse.coo_matrix( (C.data[sel].astype(np.float64), (C.row[sel], C.col[sel])), shape=C.shape )
+
+
+def compute_shared_update_block(task):
+    """ Worker of the parallel Gramian update: computes a dirty chunk against a shared feature block """
+    path, k, rows, j, block_size, nb_columns, cutoff, top_k = task
+    t0 = time()
+    A = load_shared_block(path, 'dirty%i'%k, nb_columns)
+    B = load_shared_block(path, j, nb_columns)
+    return k, j, compute_update_block(A, B, rows, j, block_size, cutoff, top_k), time()-t0
+
+
+def iter_update_blocks(chunks, cache, nb_blocks, cutoff=0.33, top_k=None, columns=None):
+    """ Computes every chunk of dirty positions against every block and yields (k, j, block, seconds) for chunk k """
+    for k, rows in enumerate(chunks):
+        A = cache.load_articles(cache.article_ids[rows])
+        for j in range(nb_blocks):
+            t0 = time()
+            B = cache.get(j)
+            if columns is not None:
+                A, B = columns.resize(A), columns.resize(B)
+            yield k, j, compute_update_block(A, B, rows, j, cache.block_size, cutoff, top_k), time()-t0
+
+
+def iter_update_blocks_parallel(chunks, cache, nb_blocks, n_jobs, cutoff=0.33, top_k=None):
+    """ Computes iter_update_blocks with a pool of n_jobs processes (see iter_blocks_parallel) """
+    path = tempfile.mkdtemp(prefix='gramian-')
+    try:
+        nb_columns = 0
+        for k, rows in enumerate(chunks):
+            X = cache.load_articles(cache.article_ids[rows])
+            feature_store.save_shared_matrix(path, 'dirty%i'%k, X)
+            nb_columns = max(nb_columns, X.shape[1])
+        for j in range(nb_blocks):
+            X = cache.get(j)
+            feature_store.save_shared_matrix(path, str(j), X)
+            nb_columns = max(nb_columns, X.shape[1])
+        tasks = [ (path, k, rows, j, cache.block_size, nb_columns, cutoff, top_k) for k, rows in enumerate(chunks) for j in range(nb_blocks) ]
+        with multiprocessing.Pool(n_jobs) as pool:
+            for result in pool.imap(compute_shared_update_block, tasks):
+                yield result
+    finally:
+        shutil.rmtree(path)
+
+
+def print_block_timings(timings, elapsed):
+    t = np.array(list(timings.values()))
+    if not len(t):
+        return
+    slowest = max(timings, key=timings.get)
+    print("Block timings: %i blocks, sum %.1fs in %.1fs wall time, median %.3fs, max %.3fs (block %i,%i)"%(
+        len(t), t.sum(), elapsed, np.median(t), t.max(), slowest[0], slowest[1]))
+
+
+def get_embedding_index(dense, compact=False):
+    """ Returns the embedding index for the dense Gramian (None for the sparse one) """
+    if not dense:
+        return None
+    if compact:
+        raise ValueError("The dense Gramian does not use the compacted column space")
+    index = embeddings.get_embedding_index()
+    if index is None:
+        raise ValueError("No embedding index, run update_embeddings.py --fit")
+    return index
+
+
+def compute_gramian(start_block=0, maxblock=None, cutoff=0.33, block_size=1000, compact=False, max_cached_blocks=None, top_k=None, n_jobs=1, dense=False):
     """ Computes the gramian matrix from feature vectores stored in the databse
 
     The function computes the sparse Gramian from feature vectors stored in the database. 
     To avoid loading the entire Gramian in memory, it is build from block matrices which are
     computed individually, sparsified (with a cutoff value) and then combined to one large 
-    sparse matrix.
+    sparse matrix. Articles are ordered by id and the weighted feature blocks are loaded through
+    a BlockCache, so that every block is read from the database only once. With n_jobs>1 the
+    blocks are computed by a process pool (see iter_blocks_parallel) with identical results.
 
     params:
     block_size The block size for the sub matrices
     start_block Assumes that the Gramian until start_block is already computed and only computes the rest
     maxblock Limits the block number to a maximum (for testing). When set to None the entire matrix is computed
     cutoff The cutoff value for the scalar product.
+    top_k Instead of applying the cutoff keep the top_k most similar articles of every article.
+          The pairs are stored directed (a is the article, b its neighbour). Requires start_block=0.
+          The similarities are read in the mode of settings.SIMILARITY_TOP_K, so stored results
+          must be computed with that value (see rebuild_full_gramian).
+    compact Compute the products in the compacted column space of feature_store.ColumnMap
+    max_cached_blocks Bound of the block cache (None keeps all blocks in memory)
+    n_jobs Number of worker processes computing the blocks
+    dense Compute the blocks as dense products of the article embeddings (see papers.embeddings)
 
     returns:
-    Sparse matrix Gramian in coo format
+    The ids of the articles (rows of the Gramian) which were processed
     """
 
-    articles = Article.objects.all()
-    nb_articles = articles.count()
+    article_ids = utils.get_article_ids(Article.objects.order_by('id'))
+    nb_articles = len(article_ids)
     bs = block_size
     if maxblock is None:
         lb = nb_articles//bs+1
     else:
         lb = maxblock
 
-    # Building metric M
-    offset = 0
-    row  = []
-    data = []
-    for key in utils.feature_dims.keys():
-        print(key)
-        n = utils.feature_dims[key]
-        row.append(np.arange(offset,offset+n))
-        data.append(feature_weights[key]*np.ones(n))
-        offset += n
-    row = np.concatenate(row)
-    data = np.concatenate(data)
-    col = row # we want a diagonal matrix
-    M = scipy.sparse.coo_matrix((data, (row, col)))
-    M = scipy.sparse.csc_matrix(M) # convert to csr format
+    if top_k is not None:
+        if start_block:
+            raise ValueError("The top-k Gramian can only be computed from scratch")
+        neighbours = TopKNeighbours(nb_articles, top_k)
+
+    columns = feature_store.ColumnMap() if compact else None
+    cache = BlockCache(article_ids, block_size, max_blocks=max_cached_blocks, columns=columns, embeddings=get_embedding_index(dense, compact))
 
     print("Computing Gramian for %i articles in blocks of %i..."%(nb_articles, block_size))
+    tasks = [ (i,j) for i in range(lb) for j in range(max(i,start_block),lb) ]
+    if n_jobs == 1:
+        results = iter_blocks(tasks, cache, cutoff, top_k, columns)
+    else:
+        results = iter_blocks_parallel(tasks, cache, lb, n_jobs, cutoff, top_k)
+
+    t0 = time()
+    timings = {}
     blocks = [ [None for i in range(lb)] for j in range(lb) ]
-    for i in tqdm(range(lb)):
-        lower_row = int(i*bs)
-        upper_row = int((i+1)*bs)
-        if i==lb-1: upper_row=nb_articles
-        for j in range(i,lb):
-            if j<start_block: continue
-            lower_col = int(j*bs)
-            upper_col = int((j+1)*bs)
-            if j==lb-1: upper_col=nb_articles
-            tmp = utils.get_features_from_db(Article.objects.all()[lower_row:upper_row])
-            A = scipy.sparse.csc_matrix(tmp)
-            tmp = utils.get_features_from_db(Article.objects.all()[lower_col:upper_col])
-            # B = scipy.sparse.csr_matrix(tmp)
-            B = scipy.sparse.csc_matrix(tmp.transpose())
-            C = A.dot(M.dot(B))
-            if i==j:
-                C = sparse.tril(C,-1)
-            C = C.multiply(C >= cutoff )
-            blocks[i][j] = C
+    for i, j, block, seconds in tqdm(results, total=len(tasks)):
+        timings[(i,j)] = seconds
+        if top_k is not None:
+            # Candidates for the rows of block i and (transposed) for the rows of block j
+            r, c, v = block[0]
+            neighbours.add(r+i*bs, c+j*bs, v)
+            if i!=j:
+                r, c, v = block[1]
+                neighbours.add(r+j*bs, c+i*bs, v)
+        else:
+            blocks[i][j] = block
+    print_block_timings(timings, time()-t0)
+    print("Block cache: %i hits, %i misses (hit rate %.1f%%)"%(cache.hits, cache.misses, 100*cache.hit_rate()))
 
     print("Saving to db...")
-    data = sparse.bmat(blocks,'coo')
+    if top_k is not None:
+        src, dst, val = neighbours.edges()
+        data = sparse.coo_matrix( (val, (src, dst)), shape=(nb_articles, nb_articles) )
+    else:
+        data = sparse.bmat(blocks,'coo')
     # Remove any junk above the blocksize limit
     Similarity.objects.filter(a__gt=start_block*block_size).delete()
     Similarity.objects.filter(b__gt=start_block*block_size).delete()
     print("sparseness=%f"%(1.0*data.nnz/np.prod(data.shape)))
-    add_similarities_to_db(articles[:nb_articles], data)
+    add_similarities_to_db(article_ids, data)
+    print("Saving neighbour lists...")
+    store_neighbour_lists(article_ids, data.row, data.col, data.data, directed=top_k is not None)
+    return article_ids
+
 
 
+def add_similarities_to_db(articles, C, batch_size=50000):
+    """ Stores the nonzero entries of the similarity matrix C
 
-def add_similarities_to_db(articles, C, commit_count=5000):
+    Row i of C holds the similarities of articles[i] and column k those of articles[k+off],
+    where off is the difference of the numbers of rows and columns. articles can be a list of
+    articles or an array of their ids.
+    """
+    article_ids = utils.get_article_ids(articles)
     off = C.shape[0]-C.shape[1]
-    transaction = []
-    for i in tqdm(range(len(articles))):
-        a = articles[i]
+    C = sparse.csr_matrix(C)
+    C.eliminate_zeros()
+    rows = np.repeat(np.arange(C.shape[0]), np.diff(C.indptr))
+    return add_similarity_pairs_to_db(article_ids[rows], article_ids[C.indices+off], C.data, batch_size)
 
-        # All all elements in row of similarity matrix
-        row = C.getrow(i)
-        _,idx,vals = sparse.find(row)
-        transaction.extend( [ Similarity( a=a, b=articles[int(k+off)], value=v) for k,v in zip(idx, vals) ] )
 
-        if len(transaction)>commit_count:
-            Similarity.objects.bulk_create( transaction )
-            transaction = []
+def compute_features():
+    print("Computing features for articles without feature vectors...")
+    count = compute_missing_features()
+    print("Added %i feature vectors to db"%count)
 
-    Similarity.objects.bulk_create( transaction )
 
+def copy_similarities(cursor, table, a_ids, b_ids, values):
+    """ Bulk loads similarities with COPY (PostgreSQL only) """
+    buf = io.StringIO()
+    np.savetxt(buf, np.column_stack((a_ids, b_ids, values)), fmt=['%d', '%d', '%.17g'], delimiter='\t')
+    buf.seek(0)
+    cursor.copy_from(buf, table, columns=('a_id', 'b_id', 'value'))
 
-def compute_features():
-    articles, data = get_articles_without_features()
 
-    if len(data):
-        print("Computing features for %i articles..."%(len(data)))
-        features = get_features(data)
+def add_similarity_pairs_to_db(a_ids, b_ids, values, batch_size=50000):
+    """ Stores the similarities of the pairs of articles (a_ids[i], b_ids[i])
 
-        print("Adding %i feature vectors to db... "%(features.shape[0]))
-        add_features_to_db(articles, features)
+    The rows bypass the ORM: every batch is inserted with a single executemany (or COPY on
+    PostgreSQL) in its own transaction.
 
+    returns:
+    The number of inserted rows
+    """
+    table = Similarity._meta.db_table
+    sql = "INSERT INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s)"%tuple(
+            connection.ops.quote_name(name) for name in (table, 'a_id', 'b_id', 'value'))
+    t0 = time()
+    for k in tqdm(range(0, len(values), batch_size)):
+        a, b, v = a_ids[k:k+batch_size], b_ids[k:k+batch_size], values[k:k+batch_size]
+        with transaction.atomic(), connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                copy_similarities(cursor.cursor, table, a, b, v)
+            else:
+                cursor.executemany(sql, list(zip(a.tolist(), b.tolist(), np.asarray(v, dtype=np.float64).tolist())))
+    elapsed = time()-t0
+    print("Inserted %i similarities in %.1fs (%.0f rows/sec)"%(len(values), elapsed, len(values)/max(elapsed, 1e-9)))
+    return len(values)
+
+
+def store_neighbour_lists(article_ids, src, dst, val, directed=False, dirty=None, stale=None):
+    """ Updates the neighbour lists (see NeighbourList) from similarities between positions in article_ids
+
+    Undirected similarities (stored once per pair) count for both articles. With dirty=None the
+    similarities are complete and the lists of all articles are replaced. Otherwise the
+    similarities of the dirty articles were replaced in the similarity table: the lists of the
+    dirty articles, of their new neighbours and of the stale articles (the ids which had a
+    similarity to a dirty article before, see utils.get_referrers) are rebuilt from the
+    similarity table. Articles similar to a deleted article were flagged as dirty on deletion.
+    """
+    if not directed:
+        src, dst, val = np.concatenate((src, dst)), np.concatenate((dst, src)), np.concatenate((val, val))
+    if dirty is None:
+        utils.save_neighbour_lists(article_ids, article_ids[src], article_ids[dst], val)
+        return
+    stale = np.intersect1d(stale if stale is not None else [], article_ids)
+    changed = np.union1d(article_ids[np.union1d(dirty, src)], stale)
+    print("Rebuilding %i neighbour lists (%i referred to changed or deleted articles)..."%(len(changed), len(stale)))
+    utils.rebuild_neighbour_lists(changed, directed)
 
-def update_gramian(block_size=1000):
-    # Find first article without similarities 
-    start_block = 0
-    if Similarity.objects.all().count():
-        qres = Similarity.objects.all().aggregate(Max('a'))
-        start_block   = qres['a__max']//block_size
-        print("Resuming at article_id=%i"%qres['a__max'])
-    # Compute the remaining blocks and add them to DB
-    compute_gramian(start_block=start_block, block_size=block_size)
 
+def delete_similarities(article_ids, chunk_size=500):
+    """ Deletes all similarities involving one of the given articles """
+    for k in range(0, len(article_ids), chunk_size):
+        chunk = article_ids[k:k+chunk_size].tolist()
+        Similarity.objects.filter(a__in=chunk).delete()
+        Similarity.objects.filter(b__in=chunk).delete()
 
-def rebuild_full_gramian():
+
+def get_top_k_referrers(article_ids, dirty, chunk_size=500):
+    """ Returns the positions of the clean articles which have a dirty article among their top-k neighbours """
+    referrers = utils.get_referrers(article_ids[dirty], directed=True, chunk_size=chunk_size)
+    referrers = np.searchsorted(article_ids, referrers[np.isin(referrers, article_ids)])
+    return np.setdiff1d(referrers, dirty)
+
+
+def clear_dirty_flags(article_ids, started, chunk_size=500):
+    """ Clears the flags of the given articles unless they were added or updated after started
+
+    Articles which an import changed while the similarities were computed keep their flag for
+    the next run.
+    """
+    for k in range(0, len(article_ids), chunk_size):
+        Article.objects.filter(id__in=article_ids[k:k+chunk_size].tolist(), date_added__lte=started).update(similarities_dirty=False)
+
+
+def update_gramian(block_size=1000, cutoff=0.33, compact=False, max_cached_blocks=None, n_jobs=1, dense=False):
+    """ Recomputes the similarities of new and updated articles only
+
+    The rows of the Gramian of the articles flagged with similarities_dirty are computed against
+    all articles (every chunk of dirty articles times every block, by a pool of n_jobs processes
+    if n_jobs>1) and replace the stored similarities involving them. Every feature block is still
+    read once, but the number of products scales with the number of dirty articles instead of
+    the corpus size.
+
+    In top-k mode the neighbour list of a dirty article is recomputed entirely, while clean
+    articles merge the dirty articles into their stored neighbours. A clean article which had a
+    dirty article among its neighbours might lose it without knowing its k+1-th neighbour, so its
+    row is recomputed entirely as well. The articles similar to a deleted article are flagged as
+    dirty when it is deleted (see papers/models.py).
+
+    The mode is read from settings.SIMILARITY_TOP_K, which get_similar_articles uses as well to
+    tell directed top-k pairs from undirected pairs above the cutoff.
+    """
+    top_k = settings.SIMILARITY_TOP_K
+    started = timezone.now()
+    flags = np.array(Article.objects.order_by('id').values_list('id', 'similarities_dirty'), dtype=np.int64).reshape(-1, 2)
+    article_ids, is_dirty = flags[:,0], flags[:,1].astype(bool)
+    dirty = np.flatnonzero(is_dirty)
+    nb_articles = len(article_ids)
+    if not len(dirty):
+        print("No new or updated articles")
+        return
+    if len(dirty) == nb_articles:
+        print("All articles are dirty, rebuilding the full Gramian...")
+        rebuild_full_gramian(block_size=block_size, cutoff=cutoff, compact=compact, max_cached_blocks=max_cached_blocks, n_jobs=n_jobs, dense=dense)
+        return
+
+    flagged = dirty
+    if top_k is not None:
+        stale = get_top_k_referrers(article_ids, dirty)
+        print("Recomputing %i articles whose neighbours changed or were deleted"%len(stale))
+        is_dirty[stale] = True
+        dirty = np.flatnonzero(is_dirty)
+
+    bs = block_size
+    lb = (nb_articles+bs-1)//bs
+    columns = feature_store.ColumnMap() if compact else None
+    cache = BlockCache(article_ids, block_size, max_blocks=max_cached_blocks, columns=columns, embeddings=get_embedding_index(dense, compact))
+    if top_k is not None:
+        neighbours = TopKNeighbours(nb_articles, top_k)
+    else:
+        pairs = []
+
+    print("Computing similarities of %i new or updated articles against %i articles..."%(len(dirty), nb_articles))
+    chunks = [ dirty[k:k+bs] for k in range(0, len(dirty), bs) ]
+    if n_jobs == 1:
+        results = iter_update_blocks(chunks, cache, lb, cutoff, top_k, columns)
+    else:
+        results = iter_update_blocks_parallel(chunks, cache, lb, n_jobs, cutoff, top_k)
+    t0 = time()
+    timings = {}
+    for k, j, block, seconds in tqdm(results, total=len(chunks)*lb):
+        timings[(k, j)] = seconds
+        rows = chunks[k]
+        if top_k is not None:
+            r, c, v = block[0]
+            neighbours.add(rows[r], c+j*bs, v)
+            # Dirty articles as candidates of the clean articles of block j
+            r, c, v = block[1]
+            clean = ~is_dirty[r+j*bs]
+            neighbours.add(r[clean]+j*bs, rows[c[clean]], v[clean])
+            continue
+        src, dst = rows[block.row], block.col+j*bs
+        # Pairs of two dirty articles are kept once
+        sel = (src != dst) & (~is_dirty[dst] | (src < dst))
+        pairs.append( (src[sel], dst[sel], block.data[sel]) )
+    print_block_timings(timings, time()-t0)
+    print("Block cache: %i hits, %i misses (hit rate %.1f%%)"%(cache.hits, cache.misses, 100*cache.hit_rate()))
+
+    print("Saving to db...")
+    with transaction.atomic():
+        stale = utils.get_referrers(article_ids[dirty]) if top_k is None else None
+        delete_similarities(article_ids[dirty])
+        if top_k is not None:
+            src, dst, val = neighbours.edges()
+            # Merge the candidates of clean articles with their stored neighbours
+            clean = np.unique(src[~is_dirty[src]])
+            stored = []
+            for k in range(0, len(clean), 500):
+                stored.extend(Similarity.objects.filter(a__in=article_ids[clean[k:k+500]].tolist()).values_list('id', 'a_id', 'b_id', 'value'))
+            stored = np.array(stored, dtype=np.float64).reshape(-1, 4)
+            stored = stored[np.isin(stored[:,2], article_ids)]
+            a, b = np.searchsorted(article_ids, stored[:,1:3].astype(np.int64)).T
+            neighbours.add(a, b, stored[:,3])
+
+            # Only write the edges which changed: new edges are either from a dirty article or to
+            # one, stored edges of clean articles which were pushed out of the top k are deleted
+            edges = src, dst, val = neighbours.edges()
+            kept = np.isin(a*nb_articles + b, src*nb_articles + dst)
+            displaced = stored[~kept,0].astype(np.int64)
+            new = is_dirty[src] | is_dirty[dst]
+            changed = np.union1d(dirty, np.union1d(src[new], a[~kept]))
+            src, dst, val = src[new], dst[new], val[new]
+            for k in range(0, len(displaced), 500):
+                Similarity.objects.filter(id__in=displaced[k:k+500].tolist()).delete()
+        elif pairs:
+            src, dst, val = [ np.concatenate(p) for p in zip(*pairs) ]
+        else:
+            src, dst, val = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        add_similarity_pairs_to_db(article_ids[src], article_ids[dst], val)
+        print("Stored %i new similarities"%len(val))
+        if top_k is not None:
+            # The merged neighbours are complete, replace the lists which changed
+            src, dst, val = edges
+            utils.save_neighbour_lists(article_ids[changed], article_ids[src], article_ids[dst], val)
+        else:
+            store_neighbour_lists(article_ids, src, dst, val, dirty=dirty, stale=stale)
+        clear_dirty_flags(article_ids[flagged], started)
+
+
+def rebuild_full_gramian(**kwargs):
+    """ Recomputes all similarities in the mode of settings.SIMILARITY_TOP_K """
+    started = timezone.now()
     Similarity.objects.all().delete()
-    compute_gramian()
+    article_ids = compute_gramian(top_k=settings.SIMILARITY_TOP_K, **kwargs)
+    clear_dirty_flags(article_ids, started)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute article similarities")
+    parser.add_argument('--compact', action='store_true', help="Use the compacted feature column space")
+    parser.add_argument('--max-cached-blocks', type=int, default=None, help="Bound of the feature block cache (default: unbounded)")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of processes computing the blocks")
+    parser.add_argument('--dense', action='store_true', help="Use dense products of the article embeddings (see update_embeddings.py)")
+    parser.add_argument('--rebuild', action='store_true', help="Recompute all similarities instead of those of new and updated articles")
+    args = parser.parse_args()
+
     print("Checking for missing feature vectors...")
     compute_features()
 
-    print("Updating full Gramian...")
-    # Similarity.objects.all().delete()
-    rebuild_full_gramian()
-    # update_gramian()
-
+    if args.rebuild:
+        print("Rebuilding full Gramian...")
+        rebuild_full_gramian(compact=args.compact, max_cached_blocks=args.max_cached_blocks, n_jobs=args.jobs, dense=args.dense)
+    else:
+        print("Updating Gramian...")
+        update_gramian(compact=args.compact, max_cached_blocks=args.max_cached_blocks, n_jobs=args.jobs, dense=args.dense)
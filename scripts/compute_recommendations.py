@@ -6,12 +6,20 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir) 
 
+import argparse
+import multiprocessing
+import shutil
+import tempfile
+from collections import OrderedDict
+from time import time
 import numpy as np
+from scipy import sparse
 import papers.utils as utils
+import papers.feature_store as feature_store
+import papers.embeddings as embeddings
+import papers.model_store as model_store
 
 from sklearn.svm import LinearSVC
-import gzip
-import pickle
 import datetime
 
 import logging
@@ -20,13 +28,14 @@ logger = logging.getLogger(__name__)
 
 import django
 from django.utils import timezone
+from django.db import connections, transaction
 from django.db.models import Max
 from django.db.models import F
 from django.db.models import Q
 
 django.setup()
 
-from papers.models import Article, Feature, Profile, Recommendation
+from papers.models import Article, Profile, Recommendation
 
 from compute_feature_vectors import *
 
@@ -34,48 +43,369 @@ min_number_of_ham = 4
 consider_inactive_after_days = 60
 
 
-def compute_recommendations(profile, articles, data, show_training_data=True, max_suggestions=500):
-    logger.info("Loading training data for profile %s..."%profile)
+def fit_profile(X_train, y_train):
+    """ Trains the classifier of a profile
+
+    returns:
+    the weight vector (as sparse row for sparse training data), the intercept and the fit time
+    """
+    t0 = time()
+    svm = LinearSVC()
+    svm.fit(X_train, y_train)
+    logger.debug("%f%% train accuracy"%(100*(svm.predict(X_train)==y_train).mean()))
+    coef = svm.coef_[0]
+    if sparse.issparse(X_train):
+        coef = sparse.csr_matrix(svm.coef_)
+    # The sign of the decision function decides for the second class
+    if svm.classes_[1] < 0:
+        coef, intercept = -coef, -svm.intercept_[0]
+    else:
+        intercept = svm.intercept_[0]
+    return coef, intercept, time()-t0
+
+
+def fit_profile_task(task):
+    """ Worker of the parallel mode: trains the classifier of a profile """
+    profile_id, X_train, y_train = task
+    return (profile_id,) + fit_profile(X_train, y_train)
+
+
+def to_stored_coef(coef, columns=None):
+    """ Maps a weight vector trained on compacted columns back to the hashed columns """
+    if columns is not None and sparse.issparse(coef):
+        coef = sparse.csr_matrix( (coef.data, columns.columns[coef.indices], coef.indptr), shape=(1, utils.get_feature_vector_size()) )
+        coef.sort_indices()
+    return coef
+
+
+def from_stored_coef(coef, columns=None):
+    """ Maps a stored weight vector to the compacted columns (adding unknown columns to the map) """
+    if columns is not None and sparse.issparse(coef):
+        columns.update(coef.indices)
+        coef = sparse.csr_matrix( (coef.data, columns.lookup[coef.indices], coef.indptr), shape=(1, len(columns)) )
+        coef.sort_indices()
+    return coef
+
+
+def get_weight_matrix(coefs, nb_columns):
+    """ Stacks the weight vectors of several profiles into the columns of one weight matrix """
+    if all(sparse.issparse(c) for c in coefs):
+        coefs = [ sparse.csr_matrix( (c.data, c.indices, c.indptr), shape=(1, nb_columns) ) for c in coefs ]
+        return sparse.vstack(coefs).T.tocsr()
+    return np.vstack(coefs).T
+
+
+def top_k_per_column(S, k):
+    """ Returns the row indices and values of the k largest entries of every column of S, sorted by decreasing value """
+    k = min(k, S.shape[0])
+    idx = np.argpartition(-S, k-1, axis=0)[:k]
+    vals = np.take_along_axis(S, idx, axis=0)
+    order = np.argsort(-vals, axis=0, kind='stable')
+    return np.take_along_axis(idx, order, axis=0), np.take_along_axis(vals, order, axis=0)
+
+
+def score_rows(data, W, b, k, start=0, excluded=None):
+    """ Scores the rows of data for all profiles (columns of W) and keeps the k best rows of every profile
+
+    excluded is a pair of arrays of global row and profile indices whose scores are ignored.
+
+    returns:
+    global row indices and scores, arrays of shape (min(k, nb_rows), nb_profiles)
+    """
+    if sparse.issparse(data) and data.shape[1] != W.shape[0]:
+        # The compacted training data may have added columns to the map
+        data = sparse.csr_matrix( (data.data, data.indices, data.indptr), shape=(data.shape[0], W.shape[0]) )
+    S = data.dot(W)
+    S = (S.toarray() if sparse.issparse(S) else np.asarray(S, dtype=np.float64)) + b
+    if excluded is not None:
+        rows, cols = excluded
+        sel = (rows >= start) & (rows < start+S.shape[0])
+        S[rows[sel]-start, cols[sel]] = -np.inf
+    idx, vals = top_k_per_column(S, k)
+    return idx+start, vals
+
+
+_shared_data = {}
+
+def score_rows_task(task):
+    """ Worker of the parallel mode: scores a range of rows of the shared candidate matrix """
+    path, start, end, W, b, k, excluded = task
+    if path not in _shared_data:
+        _shared_data.clear()
+        _shared_data[path] = feature_store.load_shared_matrix(path, 'data')
+    return score_rows(_shared_data[path][start:end], W, b, k, start, excluded)
+
+
+def score_profiles(data, W, b, k, excluded=None, pool=None, path=None, chunk_size=100000):
+    """ Scores all candidates for all profiles with one product per chunk of rows of data
+
+    The rows are scored in chunks (distributed over the pool if given, which reads the candidate
+    matrix from path) and the k best rows of every profile are merged.
+
+    returns:
+    row indices and scores of the k best candidates of every profile, sorted by decreasing score
+    """
+    chunks = [ (start, min(start+chunk_size, data.shape[0])) for start in range(0, data.shape[0], chunk_size) ]
+    if not chunks:
+        return np.zeros((0, W.shape[1]), dtype=np.int64), np.zeros((0, W.shape[1]))
+    if pool is not None:
+        parts = pool.map(score_rows_task, [ (path, start, end, W, b, k, excluded) for start, end in chunks ])
+    else:
+        parts = [ score_rows(data[start:end], W, b, k, start, excluded) for start, end in chunks ]
+    idx = np.concatenate([ p[0] for p in parts ])
+    vals = np.concatenate([ p[1] for p in parts ])
+    top, vals = top_k_per_column(vals, k)
+    return np.take_along_axis(idx, top, axis=0), vals
+
+
+def get_excluded_rows(profiles, article_ids):
+    """ Returns the (row, profile) index pairs of the ham articles of the profiles in the candidates """
+    order = np.argsort(article_ids)
+    rows, cols = [], []
+    for j, profile in enumerate(profiles):
+        ham = np.array(list(profile.ham.values_list('id', flat=True)), dtype=np.int64)
+        pos = np.clip(np.searchsorted(article_ids[order], ham), 0, max(len(article_ids)-1, 0))
+        found = article_ids[order][pos] == ham
+        rows.append(order[pos[found]])
+        cols.append(j*np.ones(found.sum(), dtype=np.int64))
+    return np.concatenate(rows), np.concatenate(cols)
+
+
+def load_training_set(profile, columns=None, embedding_index=None):
+    """ Loads the training set of a profile in the representation of the candidate matrix """
     X_train, y_train = utils.get_training_set( profile )
-    logger.debug("%i samples in training set (%i positive)"%(len(y_train), (y_train>0).sum()))
+    if embedding_index is not None:
+        X_train = embedding_index.transform(X_train)
+    elif columns is not None:
+        columns.update(X_train)
+        X_train = columns.transform(X_train)
+    return X_train, y_train
+
+
+def save_recommendations(recommendations):
+    """ Replaces the recommendations of several profiles (a dict profile -> (article ids, scores)) in one transaction """
+    now = timezone.now()
+    with transaction.atomic():
+        profile_ids = [ profile.id for profile in recommendations ]
+        Recommendation.objects.filter( profile_id__in=profile_ids ).delete()
+        Recommendation.objects.bulk_create( [ Recommendation( profile_id=profile.id, article_id=int(a), date_added=now, score=float(v) )
+            for profile, (article_ids, scores) in recommendations.items() for a, v in zip(article_ids, scores) ] )
+    for profile, (article_ids, _) in recommendations.items():
+        logger.info("Saved %i suggestions for profile %s"%(len(article_ids), profile))
+
+
+def mark_profiles_updated(profiles, now=None):
+    """ Saves the last prediction time of the profiles (last_time_active is updated like by save()) """
+    now = now or timezone.now()
+    Profile.objects.filter( id__in=[ profile.id for profile in profiles ] ).update( last_prediction_run=now, last_time_active=now )
+
+
+def load_candidates(article_ids, columns=None, embedding_index=None):
+    """ Loads the candidate matrix of the given articles in the representation the classifiers are trained in """
+    if embedding_index is not None:
+        return embedding_index.get_embeddings(article_ids)
+    data = feature_store.get_features(article_ids)
+    if columns is not None:
+        columns.update(data)
+        data = columns.transform(data)
+    return data
+
+
+def get_online_profiles(profiles):
+    """ Returns the ids of the profiles with recommendations from the online classifier (see papers/online.py)
+
+    Their stored recommendations are not the top of the batch classifier anymore, so they are
+    scored on all candidates.
+    """
+    return set(Recommendation.objects.filter( profile_id__in=[ profile.id for profile in profiles ], online=True ).values_list( 'profile_id', flat=True ).distinct())
+
+
+def get_incremental_candidates(profiles, article_ids):
+    """ Returns the candidates of profiles whose classifier did not change since their last prediction run
+
+    Only the articles added since the last run of a profile and its current recommendations (whose
+    scores are recomputed for the merge) have to be scored. The candidates are the union of these
+    articles over the profiles, restricted to article_ids. Only recommendations written by this
+    script are merged (see get_online_profiles).
 
-    # See if conditions for fit are met
-    if X_train.shape[0] > min_number_of_ham:
-        logger.debug("Fitting SVM...")
-        svm = LinearSVC()
-        svm.fit(X_train, y_train)
+    returns:
+    the candidate article ids and the (row, profile) index pairs of the candidates which are not
+    scored for a profile
+    """
+    since = min(profile.last_prediction_run for profile in profiles)
+    new = list(Article.objects.filter( date_added__gt=since ).values_list( 'id', 'date_added' ))
+    new_ids = np.array([ r[0] for r in new ], dtype=np.int64)
+    recommended = np.array(list(Recommendation.objects.filter( profile_id__in=[ profile.id for profile in profiles ], online=False ).values_list( 'profile_id', 'article_id' )), dtype=np.int64).reshape(-1, 2)
+    candidate_ids = np.unique(np.concatenate((new_ids, recommended[:,1])))
+    candidate_ids = candidate_ids[np.isin(candidate_ids, article_ids)]
 
-        logger.debug("Validating...")
-        predictions = svm.predict(X_train)
-        logger.debug("%f%% train accuracy"%(100*(predictions==y_train).mean()))
+    scored = np.zeros((len(candidate_ids), len(profiles)), dtype=bool)
+    for j, profile in enumerate(profiles):
+        added = new_ids[np.array([ r[1] > profile.last_prediction_run for r in new ], dtype=bool)]
+        scored[:,j] = np.isin(candidate_ids, added) | np.isin(candidate_ids, recommended[recommended[:,0]==profile.id, 1])
+    return candidate_ids, np.nonzero(~scored)
 
-        logger.debug("Predicting...") 
-        predictions = svm.predict(data)
-        logger.debug("%f%% relevant"%(100*(predictions==1).mean()))
 
-        logger.debug("Saving recommendations...")
-        recommended_articles = []
-        for a,p in zip(articles, predictions):
-            if p>0:
-                if show_training_data: 
-                    recommended_articles.append(a)
-                elif not profile.ham.filter(id=a.id).exists(): 
-                    recommended_articles.append(a)
+def score_batch(results, data, article_ids, max_suggestions=500, excluded=None, columns=None, pool=None, path=None):
+    """ Scores the candidates for the classifiers in results (tuples of profile id, weight vector and intercept)
 
-            if len(recommended_articles)>=max_suggestions:
-                break
+    returns the recommended article ids and their scores for every profile in results
+    """
+    nb_columns = len(columns) if columns is not None else max(r[1].shape[-1] for r in results)
+    W = get_weight_matrix([ r[1] for r in results ], nb_columns)
+    b = np.array([ r[2] for r in results ])
+    if columns is not None:
+        data = columns.resize(data)
+    rows, scores = score_profiles(data, W, b, max_suggestions, excluded, pool, path)
+    positive = scores > 0
+    return [ (article_ids[rows[:,j][positive[:,j]]], scores[:,j][positive[:,j]]) for j in range(len(results)) ]
 
-        Recommendation.objects.filter( profile=profile ).delete()
-        Recommendation.objects.bulk_create( [ Recommendation( profile=profile, article=a, date_added=timezone.now() ) for a in recommended_articles ] )
-        logger.info("Saved %i suggestions"%(len(recommended_articles)))
 
-    # Save last prediction time to profile
-    profile.last_prediction_run = timezone.now()
-    profile.save()
+def compute_recommendations(profile, articles, data=None, show_training_data=True, max_suggestions=500, columns=None, embedding_index=None):
+    """ Trains (or loads) the classifier of a profile and stores the recommended articles
 
+    When a feature_store.ColumnMap is given, data has to be compacted with it and the
+    training data is compacted with the same map. With an embeddings.EmbeddingIndex, data
+    holds the embeddings of the articles and the classifier is trained on embeddings.
+    """
+    compute_all_recommendations([ profile ], articles, data, show_training_data=show_training_data,
+            max_suggestions=max_suggestions, columns=columns, embedding_index=embedding_index)
+
+
+def compute_all_recommendations(profiles, articles, data=None, n_jobs=1, batch_size=50, show_training_data=True, max_suggestions=500, columns=None, embedding_index=None, models=None, retrain=False, incremental=True):
+    """ Computes the recommendations of several profiles and reports the time spent per profile
+
+    Profiles are processed in batches: the training sets of a batch are loaded and the
+    classifiers are trained (with n_jobs>1 by a pool of worker processes). Their weight vectors
+    and intercepts are gathered into one weight matrix W, all candidates are scored for the whole
+    batch with data.dot(W)+b and the max_suggestions best articles with a positive score are
+    selected for every profile. With n_jobs>1 the rows of data are scored by the pool, which
+    memory-maps the candidate matrix from a temporary directory. The recommendations of a batch
+    are written at once. If data is None, the candidate matrix of articles is loaded when it is
+    first needed.
+
+    With a model_store.ModelStore the classifier of a profile is only trained if its ham and spam
+    articles or the feature config changed since the stored model was fitted (or if retrain is
+    set), otherwise the stored weight vector is scored directly. Trained models are stored.
+    With incremental set, profiles with an unchanged classifier only score the articles added
+    since their last prediction run together with their current recommendations and keep the
+    max_suggestions best of them. Profiles with online recommendations are scored on all articles.
+    """
+    started = timezone.now()
+    article_ids = utils.get_article_ids(articles)
+    profiles = list(profiles)
+    timings = []
+    version = model_store.get_feature_config_version(embedding_index)
+    hits = misses = 0
+    pool = None
+    path = None
+    shared = False
+    if n_jobs != 1:
+        path = tempfile.mkdtemp(prefix='recommendations-')
+        # The workers fork this process and must not share its database connections
+        connections.close_all()
+        pool = multiprocessing.Pool(n_jobs)
+
+    try:
+        for k in range(0, len(profiles), batch_size):
+            batch = profiles[k:k+batch_size]
+            tasks = []
+            cached = []
+            fingerprints = {}
+            t_load = {}
+            for profile in batch:
+                t0 = time()
+                if models is not None:
+                    fingerprints[profile.id] = model_store.get_training_fingerprint(profile, version)
+                    model = None if retrain else models.load(profile.id, fingerprints[profile.id])
+                    if model is not None:
+                        coef, intercept = model
+                        cached.append( (profile.id, from_stored_coef(coef, columns), intercept, 0.0) )
+                        t_load[profile.id] = time()-t0
+                        continue
+                X_train, y_train = load_training_set( profile, columns, embedding_index )
+                t_load[profile.id] = time()-t0
+                if X_train.shape[0] > min_number_of_ham:
+                    tasks.append( (profile.id, X_train, y_train) )
+
+            if pool is not None:
+                results = pool.map(fit_profile_task, tasks)
+            else:
+                results = [ fit_profile_task(task) for task in tasks ]
+            if models is not None:
+                for profile_id, coef, intercept, _ in results:
+                    models.save(profile_id, fingerprints[profile_id], to_stored_coef(coef, columns), intercept)
+                hits += len(cached)
+                misses += len(batch)-len(cached)
+                logger.info("Model cache: %i hits, %i misses"%(len(cached), len(batch)-len(cached)))
+
+            by_id = dict( (profile.id, profile) for profile in batch )
+            online_ids = get_online_profiles(batch) if incremental else set()
+            unchanged_ids = set( r[0] for r in cached if incremental and by_id[r[0]].last_prediction_run is not None and r[0] not in online_ids )
+            unchanged = [ r for r in cached if r[0] in unchanged_ids ]
+            results = [ r for r in cached + results if r[0] not in unchanged_ids ]
+
+            recommendations = OrderedDict()
+            t_score = {}
+            if results:
+                t0 = time()
+                if data is None:
+                    data = load_candidates(article_ids, columns, embedding_index)
+                if pool is not None and not shared:
+                    feature_store.save_shared_matrix(path, 'data', data)
+                    shared = True
+                excluded = None if show_training_data else get_excluded_rows([ by_id[r[0]] for r in results ], article_ids)
+                selected = score_batch(results, data, article_ids, max_suggestions, excluded, columns, pool, path)
+                t = time()-t0
+                logger.info("Scored %i candidates for %i profiles in %.2fs"%(len(article_ids), len(results), t))
+                for r, selection in zip(results, selected):
+                    recommendations[by_id[r[0]]] = selection
+                    t_score[r[0]] = t/len(results)
+
+            if unchanged:
+                t0 = time()
+                candidates = [ by_id[r[0]] for r in unchanged ]
+                candidate_ids, excluded = get_incremental_candidates(candidates, article_ids)
+                if not show_training_data:
+                    ham = get_excluded_rows(candidates, candidate_ids)
+                    excluded = ( np.concatenate((excluded[0], ham[0])), np.concatenate((excluded[1], ham[1])) )
+                selected = score_batch(unchanged, load_candidates(candidate_ids, columns, embedding_index), candidate_ids, max_suggestions, excluded, columns)
+                t = time()-t0
+                logger.info("Scored %i new and recommended candidates for %i unchanged profiles in %.2fs"%(len(candidate_ids), len(unchanged), t))
+                for r, selection in zip(unchanged, selected):
+                    recommendations[by_id[r[0]]] = selection
+                    t_score[r[0]] = t/len(unchanged)
+
+            for profile_id, _, _, t_fit in unchanged + results:
+                profile = by_id[profile_id]
+                timings.append( (profile, t_load[profile_id], t_fit, t_score[profile_id]) )
+                logger.info("Profile %s: load %.2fs, fit %.2fs"%(profile, t_load[profile_id], t_fit))
+            save_recommendations(recommendations)
+            mark_profiles_updated(batch, started)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+            shutil.rmtree(path)
+
+    if timings:
+        total = np.array([ sum(t[1:]) for t in timings ])
+        slowest = timings[int(np.argmax(total))][0]
+        logger.info("Updated %i profiles: %.1fs in total, median %.2fs, max %.2fs (profile %s)"%(len(timings), total.sum(), np.median(total), total.max(), slowest))
+    if models is not None:
+        logger.info("Model cache: %i hits, %i misses in total"%(hits, misses))
+    return timings
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute recommendations for all profiles which need an update")
+    parser.add_argument('--compact', action='store_true', help="Train on the compacted feature column space")
+    parser.add_argument('--dense', action='store_true', help="Train on the dense article embeddings (see update_embeddings.py)")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of processes training profiles in parallel")
+    parser.add_argument('--retrain', action='store_true', help="Retrain all profiles instead of reusing the stored models")
+    parser.add_argument('--full', action='store_true', help="Rescore all candidates also for profiles whose model did not change")
+    args = parser.parse_args()
+
     logger.debug("Loading user profiles...")
     # get users which need updating
     qres = Article.objects.all().aggregate(Max('date_added'))
@@ -88,10 +418,17 @@ if __name__ == "__main__":
         from_date = datetime.date.today() - datetime.timedelta(356)
         articles = Article.objects.filter(pubdate__gte=from_date).order_by('-pubdate')
 
-        logger.debug("Loading data ...")
-        data = utils.get_features_from_db(articles)
-      
-        for profile in profiles:
-            compute_recommendations(profile, articles, data)
+        columns = None
+        embedding_index = None
+        if args.dense:
+            embedding_index = embeddings.get_embedding_index()
+            if embedding_index is None:
+                sys.exit("No embedding index, run update_embeddings.py --fit")
+        elif args.compact:
+            columns = feature_store.ColumnMap()
+
+        # The candidate matrix is only loaded if a profile has to be scored on all articles
+        compute_all_recommendations(profiles, articles, n_jobs=args.jobs, columns=columns, embedding_index=embedding_index,
+                models=model_store.ModelStore(), retrain=args.retrain, incremental=not args.full)
     else:
         logger.debug("Nothing to do. Exiting...")
@@ -1,122 +1,164 @@
 #!/usr/bin/python3
-
+""" Imports arXiv OAI-PMH ListRecords pages into the database
+
+The pages are the harvested pages of the spool (see papers/spool.py) that have not been imported
+yet, or the given dumps of arxiv_download_xml.py. A pool of processes parses the files, while
+this process alone writes their records with batched upserts, one transaction per file. A spooled
+page is marked as imported in the manifest after its transaction is committed, so after a crash
+the import is simply run again. A page which cannot be parsed or written is reported, marked as
+failed and skipped, also by later imports unless they retry failed pages. --prune deletes the
+imported pages from the spool.
+
+usage: import_arxiv_xml.py [--jobs N] [--spool DIR] [--force] [--retry-failed] [--prune [--keep-days N]] [raw-00000001.xml ...]
+"""
 from __future__ import print_function
 
-__all__ = [u"parse"]
+__all__ = [u"parse", u"import_spool"]
 
-import os
-import re
-import random
-from datetime import datetime
-import xml.etree.cElementTree as ET
-# from multiprocessing import Pool
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
 
-import django
-from django.utils import timezone
-from django.utils.encoding import smart_text
+import argparse
+import traceback
+import multiprocessing
 
-import utils
+import django
+from django.db import connections, transaction
 
 django.setup()
 
-from papers.models import Article
-from django.contrib.auth.models import User
-
-record_tag = u".//{http://www.openarchives.org/OAI/2.0/}record"
-ns_re = re.compile(r"\{(?:.*?)\}(.*)")
-date_fmt = u"%a, %d %b %Y %H:%M:%S %Z"
-
-comma_and = r"(?:,* and )|(?:,\s*)"
-ca_re = re.compile(comma_and)
-au_re = re.compile(r"(.+?)(?:" + comma_and + "|(?:\s*$))")
-
-affil_re = re.compile(r"(.*?)(?:\((.*)\)|$)")
-affils_re = re.compile(r"\(([0-9]+)\) (.*?)(?=(?:,*\s*\()|\))")
-
-def parse_one(f):
-    print(u"Starting: {0}".format(f))
-    reflist = []
-
-    tree = ET.parse(f)
-    root = tree.getroot()
-    for i, r in enumerate(root.findall(record_tag)):
-        ref = {}
-        for el in r.iter():
-            txt = smart_text(el.text)
-            if txt is None:
-                for k, v in el.attrib.iteritems():
-                    ref[unicode(k.lower())] = unicode(v)
-            elif txt.strip() != u"":
-                k = unicode(ns_re.search(el.tag).groups()[0].lower())
-                txt = unicode(txt.strip())
-
-                if k == u"date":
-                    txt = datetime.strptime(txt, date_fmt)
-                elif k == u"categories":
-                    txt = [c.strip() for c in txt.split()]
-                elif k == u"authors":
-                    spl = txt.replace(u"\n", u"").split(u"((")
-                    if len(spl) > 1:
-                        if len(spl) > 2:
-                            spl = [spl[0], u"(".join(spl[1:])]
-                        authors, affils = spl
-                        affils = dict(affils_re.findall(u"(" + affils))
-                    else:
-                        authors, affils = txt, {}
-                    authors = [affil_re.findall(a.strip())[0]
-                                            for a in au_re.findall(authors)]
-                    ref[u"authors"] = []
-                    for a in authors:
-                        if len(a[1]) > 0 and a[1][0] in u"1234567890":
-                            ref[u"authors"].append({u"name": a[0],
-                                    u"affil": ", ".join([affils.get(af.strip(),
-                                                                    af.strip())
-                                        for af in ca_re.split(a[1])])})
-                        else:
-                            ref[u"authors"].append({u"name": a[0],
-                                u"affil": a[1].strip()})
-
-                    k = u"authors_raw"
-
-                ref[k] = txt
-   
-        # build pseudo journal name from arxiv categories
-        ref['journal'] = 'arXiv'+str(ref['categories'])
-        if 'journal-ref' in ref.keys():
-            ref['journal'] += ' '+ref['journal-ref']
-
-        if 'doi' not in ref.keys():
-            ref['doi'] = ''
-
-        # insert into list
-        art, created = utils.add_or_update_article(title=ref['title'], 
-                authors=ref['authors_raw'], 
-                pubdate=ref['date'], 
-                journal=ref['journal'], 
-                abstract=ref['abstract'], 
-                url='https://arxiv.org/abs/'+ref['id'], 
-                doi=ref['doi'], 
-            )
-
-        if created:
-            print("Adding article %i: %s"%(len(reflist),ref['title']))
-        else:
-            print("Updating article %i: %s"%(len(reflist),ref['title']))
-
-        reflist.append(art)
-
-    # create in database
-    # Article.objects.bulk_create( reflist )
-    print(u"Finished {0}".format(f))
-
-
-def parse(fns):
-    # p = Pool()
-    # p.map(parse_one, list(fns))
-    for one in list(fns):
-        parse_one(one)
+import papers.utils as utils
+import papers.oai as oai
+from papers.spool import Spool, get_spool_dir
+
+spool_name = 'arxiv'
+
+
+def get_journal_name(record):
+    # build pseudo journal name from arxiv categories
+    journal = 'arXiv'+str(record['categories'])
+    if record['journal_ref']:
+        journal += ' '+record['journal_ref']
+    return journal
+
+
+def parse_file(task):
+    """ Returns the records of a file for add_or_update_articles
+
+    args:
+        task (filename, journal name of the articles or None to build it from the categories)
+    """
+    filename, journal = task
+    records = []
+    for record in oai.iter_records(filename):
+        records.append(dict(title=utils.prepare_string(record['title'], 250),
+                authors=utils.prepare_string(record['authors'], 500),
+                pubdate=record['date'], # date of the first version
+                journal=utils.prepare_string(journal or get_journal_name(record), 250),
+                abstract=utils.prepare_string(record['abstract']),
+                url=record['url'],
+                doi=record['doi'],
+            ))
+    return records
+
+
+def try_parse_file(task):
+    """ Returns the records of a file (see parse_file) and None, or None and the traceback if it cannot be parsed """
+    try:
+        return parse_file(task), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def import_records(records, batch_size=1000):
+    """ Writes the records of a file in one transaction """
+    nb_created = 0
+    nb_changed = 0
+    with transaction.atomic():
+        for k in range(0, len(records), batch_size):
+            article_ids, created, changed = utils.add_or_update_articles(records[k:k+batch_size])
+            nb_created += len(set(article_ids[created]))
+            nb_changed += len(set(article_ids[changed]))
+    print("Added %i and updated %i articles"%(nb_created, nb_changed))
+    return len(records)
+
+
+def import_files(tasks, n_jobs=1, batch_size=1000, callback=None, error_callback=None):
+    """ Parses the files of tasks (see parse_file) with n_jobs processes and writes their records
+
+    callback(k, nb_records) is called after the records of the k-th task are committed. A file
+    which cannot be parsed or written is reported and skipped, error_callback(k, error) is called
+    with the traceback.
+
+    returns the number of records
+    """
+    pool = None
+    if n_jobs != 1 and len(tasks) > 1:
+        # The workers fork this process and must not share its database connections
+        connections.close_all()
+        pool = multiprocessing.Pool(n_jobs)
+    count = 0
+    try:
+        # imap keeps the order of the files, so newer versions of an article are written last
+        results = pool.imap(try_parse_file, tasks) if pool is not None else map(try_parse_file, tasks)
+        for k, (records, error) in enumerate(results):
+            if error is None:
+                print(u"Importing {0}: {1} records".format(tasks[k][0], len(records)))
+                try:
+                    nb_records = import_records(records, batch_size)
+                except Exception:
+                    error = traceback.format_exc()
+            if error is not None:
+                print(u"Failed to import {0}:\n{1}".format(tasks[k][0], error), file=sys.stderr)
+                if error_callback is not None:
+                    error_callback(k, error)
+                continue
+            if callback is not None:
+                callback(k, nb_records)
+            count += nb_records
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return count
+
+
+def import_spool(spool=None, n_jobs=1, force=False, retry_failed=False):
+    """ Imports the pending pages of the spool (all pages if force) and marks them as imported or failed """
+    spool = spool or Spool(get_spool_dir(spool_name))
+    entries = spool.get_pending(force, retry_failed)
+    tasks = [ (spool.filename(e['name']), e.get('journal')) for e in entries ]
+    failed = []
+    def mark_failed(k, error):
+        failed.append(k)
+        spool.mark_failed(entries[k], error.strip().splitlines()[-1])
+    count = import_files(tasks, n_jobs, callback=lambda k, nb_records: spool.mark_imported(entries[k], nb_records),
+            error_callback=mark_failed)
+    print(u"Imported {0} records from {1} spooled pages, {2} failed".format(count, len(entries)-len(failed), len(failed)))
+    return count
+
+
+def parse(fns, n_jobs=1):
+    return import_files([ (fn, None) for fn in fns ], n_jobs)
 
 
 if __name__ == "__main__":
-    import sys
-    parse(sys.argv[1:])
+    parser = argparse.ArgumentParser(description="Import harvested arXiv OAI-PMH pages")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of parsing processes (0 for one per core)")
+    parser.add_argument('--spool', help="Spool directory (default DATA_DIR/spool/%s)"%spool_name)
+    parser.add_argument('--force', action='store_true', help="Import the pages of the spool that were already imported again")
+    parser.add_argument('--retry-failed', action='store_true', help="Import the pages of the spool whose import failed again")
+    parser.add_argument('--prune', action='store_true', help="Delete the imported pages from the spool after the import")
+    parser.add_argument('--keep-days', type=int, default=0, help="Keep the imported pages harvested in the last days when pruning")
+    parser.add_argument('filenames', nargs='*', help="Dumps to import instead of the spool")
+    args = parser.parse_args()
+
+    if args.filenames:
+        parse(args.filenames, n_jobs=args.jobs or None)
+    else:
+        spool = Spool(args.spool) if args.spool else Spool(get_spool_dir(spool_name))
+        import_spool(spool, n_jobs=args.jobs or None, force=args.force, retry_failed=args.retry_failed)
+        if args.prune:
+            print(u"Pruned {0} imported pages".format(len(spool.prune(args.keep_days))))
@@ -11,91 +11,43 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir) 
 
+import argparse
 import requests
 import logging
 import datetime
 import time
-from tqdm import tqdm
 
 import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 # logger.setLevel(10)
 
-from bs4 import BeautifulSoup as bs
-
 import django
-from django.utils import timezone
-from django.utils.encoding import smart_text
 
 
 django.setup()
 
-from papers.models import Article, Profile
-from django.contrib.auth.models import User
+from papers.spool import Spool, get_spool_dir
 
-import papers.utils as utils
+import import_arxiv_xml
 
 
 resume_re = re.compile(r".*<resumptionToken.*?>(.*?)</resumptionToken>.*")
 export_url = "http://export.arxiv.org/oai2"
 harvest_sets = ['q-bio','cs', 'stat']
 
-base_url = "https://arxiv.org/abs"
-
-
-def conv_str(x, max_length=None):
-    return utils.prepare_string(x.text.strip(), max_length)
-
-def process_xml(data, journal_name):
-    """ Process raw arxive xml data and insert them into the database.
-
-    args:
-        data the xml data
-    returns: 
-        list of articles added or updated
+def scrape_articles(start_date=None, end_date=None, harvest_set=None, max_tries=10, timedelta=1, spool=None):
     """
+    Get raw data from the ArXiv.
 
-    xml = bs(data, 'lxml')
-    raw_articles = xml.find_all('record')
-    for entry in tqdm(raw_articles):
-        arxiv_id = entry.find('id').text
-        title    = conv_str(entry.find('title'),250)
-        authors  = conv_str(entry.find('authors'),500)
-        abstract = conv_str(entry.find('abstract'))
-        date_str = conv_str(entry.find('date'))
-        pubdate = datetime.datetime.strptime(date_str, "%a, %d %b %Y %H:%M:%S GMT") # presumably get the date of the first version
-        # categories = xml.find('categories') # not used
-
-        doi = entry.find('doi')
-        if doi: 
-            doi = doi.text.strip()
-        else:
-            doi = ""
-        url = "%s/%s"%(base_url,arxiv_id)
-
-        # create database object
-        art, created = utils.add_or_update_article(
-                title=title, 
-                authors=authors,
-                pubdate=pubdate,
-                journal=journal_name,
-                abstract=abstract,
-                url=url,
-                doi=doi,
-                )
-
-        if created:
-            logger.debug("Added article %i: %s"%(art.id,title))
-        else:
-            logger.debug("Updated article %i: %s"%(art.id,title))
-
-
+    The pages are written to the spool (see papers/spool.py) together with the journal name
+    of their articles and imported by import_arxiv_xml.import_spool.
 
-def scrape_articles(start_date=None, end_date=None, harvest_set=None, max_tries=10, timedelta=1):
-    """
-    Get raw data from the ArXiv.
+    returns the spooled entries
     """
+    spool = spool or Spool(get_spool_dir(import_arxiv_xml.spool_name))
+    harvest_id = datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    entries = []
 
     sleep_time = 20
 
@@ -138,8 +90,10 @@ def scrape_articles(start_date=None, end_date=None, harvest_set=None, max_tries=
             failures = 0
             data = r.text
             count += 1
-            # process content
-            process_xml(data, journal_name)
+            # spool the page, it is parsed and imported separately
+            name = "%s-%s-%04i.xml"%(harvest_set or 'all', harvest_id, count)
+            entries.append( spool.add(name, r.content, journal=journal_name, harvest_set=harvest_set,
+                    start_date=str(start_date), end_date=str(end_date)) )
 
             # Look for a resumption token
             token = resume_re.search(data)
@@ -161,11 +115,22 @@ def scrape_articles(start_date=None, end_date=None, harvest_set=None, max_tries=
 
         else:
             r.raise_for_status()
+    return entries
 
 
 if __name__ == "__main__":
-
+    parser = argparse.ArgumentParser(description="Harvest the arXiv articles of the last days and import them")
+    parser.add_argument('--days', type=int, default=1, help="Number of days before today to harvest")
+    parser.add_argument('--spool', help="Spool directory (default DATA_DIR/spool/%s)"%import_arxiv_xml.spool_name)
+    parser.add_argument('--no-import', action='store_true', help="Only harvest, import later with import_arxiv_xml.py")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of parsing processes of the import (0 for one per core)")
+    args = parser.parse_args()
+
+    spool = Spool(args.spool) if args.spool else None
     for s in harvest_sets:
-        logger.info("Importing %s"%s)
-        scrape_articles(harvest_set=s)
+        logger.info("Harvesting %s"%s)
+        scrape_articles(harvest_set=s, timedelta=args.days, spool=spool)
 
+    if not args.no_import:
+        # also imports pages left over by earlier runs
+        import_arxiv_xml.import_spool(spool, n_jobs=args.jobs or None)
@@ -10,39 +10,102 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir) 
 
-import requests
-import pandas as pd
-import seaborn as sns
-import numpy as np
-from bs4 import BeautifulSoup as bs
-import matplotlib.pyplot as plt
-from tqdm import tqdm
-import datetime
-import time
+import argparse
 import datetime
+from time import time
+from bs4 import BeautifulSoup as bs
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 import django
-from django.utils import timezone
-from django.utils.encoding import smart_text
 
 
 django.setup()
 
-from papers.models import Article, Profile
-from django.contrib.auth.models import User
-
 import papers.utils as utils
+from papers.fetcher import Fetcher, get_page_filename
 
 # Define the URL parameters
 n_results = 400
 search_term = ""
 url_base = "http://biorxiv.org"
-url_search_base = url_base + "/search/{}".format(search_term)
 url_params = "%20limit_from%3A{0}-{1}-{2}%20limit_to%3A{0}-{1}-{3}%20numresults%3A{3}%20format_result%3Aascending format_result%3Astandard"
-url_template = url_search_base + url_params
 
 
-def scrape_articles(start_date=None, end_date=None):
+def parse_listing(text, base_url=url_base):
+    """ Extracts title, url, date, authors and doi of the entries of a search result page """
+    html = bs(text, 'lxml')
+    entries = []
+    # Collect the articles in the result in a list
+    raw_articles = html.find_all('li', attrs={'class': 'search-result'})
+    for entry in raw_articles:
+        # Pull the title, if it's empty then skip it
+        title_link = entry.find('a', attrs={'class': 'highwire-cite-linked-title'})
+        if title_link is None:
+            continue
+
+        # Extract title
+        title = title_link.text.strip()
+        # Extract url
+        url = base_url + title_link.get('href')
+
+        # Extract date from url
+        sp = title_link.get('href').split('/')
+        date = datetime.date(int(sp[3]), int(sp[4]), int(sp[5]))
+
+        # Collect author information
+        authors_raw = entry.find_all('span', attrs={'class': 'highwire-citation-author'})
+        authors = ", ".join( author.text for author in authors_raw )
+
+        doi = entry.find('span', attrs={'class': 'highwire-cite-metadata-doi'})
+        doi = doi.text.strip()
+        doi = doi.replace("doi: ", "", 1)
+        doi = doi.replace("https://doi.org/", "", 1)
+
+        entries.append( dict(title=title, url=url, date=date, authors=authors, doi=doi) )
+    return entries
+
+
+def parse_detail(text):
+    """ Extracts the abstract and the journal name (with the categories) of a detail page
+
+    returns None as abstract if the page has none
+    """
+    detail_html = bs(text, 'lxml')
+    abstract_raw = detail_html.find('div', attrs={'class': 'section abstract'})
+    if abstract_raw is None:
+        return None, None
+    abstract = abstract_raw.text.strip().replace("Abstract","",1)
+
+    # Set this statically
+    journal = 'bioRxiv'
+
+    # append categories to journal name
+    categories_raw = detail_html.find_all('span', attrs={'class': 'highwire-article-collection-term'})
+    for cat in categories_raw:
+        journal += " "
+        journal += cat.text
+    return abstract, journal
+
+
+def save_page(save_dir, url, text):
+    """ Saves a fetched page in the layout replayed by biorxiv_stub_server.py """
+    filename = get_page_filename(save_dir, url)
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as f:
+        f.write(text)
+
+
+def scrape_articles(start_date=None, end_date=None, base_url=url_base, concurrency=4, rate=5.0, save_dir=None):
+    """ Imports the bioRxiv articles published from start_date to end_date (excluded)
+
+    The listing of every day is fetched first, then the detail pages of its entries (for the
+    abstracts and categories) are fetched concurrently (see papers.fetcher.Fetcher) and the
+    articles of the day are written at once.
+    """
     if end_date is None:
         end_date = datetime.date.today()
 
@@ -50,95 +113,69 @@ def scrape_articles(start_date=None, end_date=None):
         start_date = datetime.date.today() - datetime.timedelta(1)
 
     # Now we'll do the scraping...
-    all_articles = []
+    count = 0
     current_date = start_date
-    while current_date<end_date:
-        yr = current_date.year
-        mn = current_date.month
-        dy = current_date.day
-        current_date +=  datetime.timedelta(1) 
-
-        print("Processing %i-%i-%i"%(yr,mn,dy))
-        # Populate the fields with our current query and post it
-        this_url = url_template.format(yr, mn, dy, dy+1, n_results) 
-        resp = requests.post(this_url)
-        html = bs(resp.text, 'lxml')
-        
-        # Collect the articles in the result in a list
-        raw_articles = html.find_all('li', attrs={'class': 'search-result'})
-        for entry in raw_articles:
-            time.sleep(0.1)
-            e = {}
-            # Pull the title, if it's empty then skip it
-            title_link = entry.find('a', attrs={'class': 'highwire-cite-linked-title'})
-            if title_link is None:
-                continue
-
-            # Extract title
-            title = title_link.text.strip()
-            # Extract url
-            url = url_base + title_link.get('href')
-
-            # Extract date from url
-            str = title_link.get('href')
-            sp = str.split('/')
-            date = datetime.date(int(sp[3]), int(sp[4]), int(sp[5]))
-
-            # Collect author information
-            authors_raw = entry.find_all('span', attrs={'class': 'highwire-citation-author'})
-            authors = ""
-            for i, author in enumerate(authors_raw):
-                authors += author.text 
-                if i < len(authors_raw)-1:
-                    authors += ", "
-
-            doi = entry.find('span', attrs={'class': 'highwire-cite-metadata-doi'})
-            doi = doi.text.strip()
-            doi = doi.replace("doi: ", "", 1)
-            doi = doi.replace("https://doi.org/", "", 1)
-
-            # Get the abstract
-            detail_resp = requests.post(url)
-            detail_html = bs(detail_resp.text, 'lxml')
-            abstract_raw = detail_html.find('div', attrs={'class': 'section abstract'})
-            #with open('dump.txt','w') as f:
-            #    f.write(detail_resp.text.encode('utf8'))
-            if abstract_raw is None:
+    with Fetcher(concurrency=concurrency, rate=rate) as fetcher:
+        while current_date<end_date:
+            yr = current_date.year
+            mn = current_date.month
+            dy = current_date.day
+            current_date +=  datetime.timedelta(1) 
+
+            print("Processing %i-%i-%i"%(yr,mn,dy))
+            # Populate the fields with our current query and post it
+            this_url = base_url + "/search/" + search_term + url_params.format(yr, mn, dy, dy+1, n_results)
+            resp = fetcher.fetch_all([ this_url ], method='POST')[0]
+            if isinstance(resp, Exception):
+                logger.error("Could not fetch the listing of %i-%i-%i: %s"%(yr, mn, dy, resp))
                 continue
-            abstract = abstract_raw.text.strip().replace("Abstract","",1)
-
-            
-            # Set this statically
-            journal = 'bioRxiv'
-
-            # append categories to journal name
-            categories_raw = detail_html.find_all('span', attrs={'class': 'highwire-article-collection-term'})
-            for i, cat in enumerate(categories_raw):
-                journal += " "
-                journal += cat.text
-
-            # create database object
-            art, created = utils.add_or_update_article(
-                    title=utils.prepare_string(title,250), 
-                    authors=utils.prepare_string(authors,500),
-                    pubdate=date,
-                    journal=utils.prepare_string(journal,250),
-                    abstract=utils.prepare_string(abstract),
-                    url=url,
-                    doi=doi,
-                    )
-
-            if created:
-                print("Added article %i: %s"%(art.id,title))
-            else:
-                print("Updated article %i: %s"%(art.id,title))
-
-            all_articles.append(art)
-
-
-
-    print("Finished processing %i articles"%(len(all_articles)))
+            if save_dir is not None:
+                save_page(save_dir, this_url, resp.text)
+            entries = parse_listing(resp.text, base_url)
+
+            # Get the abstracts
+            t0 = time()
+            nb_requests, nb_retries = fetcher.nb_requests, fetcher.nb_retries
+            responses = fetcher.fetch_all([ e['url'] for e in entries ], method='POST')
+            logger.info("Fetched %i detail pages in %.1fs (%i requests, %i retries)"%(len(entries), time()-t0,
+                fetcher.nb_requests-nb_requests, fetcher.nb_retries-nb_retries))
+
+            records = []
+            for e, detail_resp in zip(entries, responses):
+                if isinstance(detail_resp, Exception) or detail_resp.status_code != 200:
+                    logger.warning("Skipping %s: %s"%(e['url'], detail_resp if isinstance(detail_resp, Exception) else detail_resp.status_code))
+                    continue
+                if save_dir is not None:
+                    save_page(save_dir, e['url'], detail_resp.text)
+                abstract, journal = parse_detail(detail_resp.text)
+                if abstract is None:
+                    continue
+                records.append(dict(
+                        title=utils.prepare_string(e['title'],250), 
+                        authors=utils.prepare_string(e['authors'],500),
+                        pubdate=e['date'],
+                        journal=utils.prepare_string(journal,250),
+                        abstract=utils.prepare_string(abstract),
+                        url=e['url'],
+                        doi=e['doi'],
+                        ))
+
+            # create database objects
+            article_ids, created, changed = utils.add_or_update_articles(records)
+            print("Added %i and updated %i articles"%(len(set(article_ids[created])), len(set(article_ids[changed]))))
+            count += len(records)
+
+    print("Finished processing %i articles"%(count))
 
 
 if __name__ == "__main__":
-    scrape_articles()
+    parser = argparse.ArgumentParser(description="Import the bioRxiv articles of the last days")
+    parser.add_argument('--days', type=int, default=1, help="Number of days before today to import")
+    parser.add_argument('--base-url', default=url_base, help="bioRxiv server (e.g. a local biorxiv_stub_server.py)")
+    parser.add_argument('--concurrency', type=int, default=4, help="Maximum number of concurrent requests")
+    parser.add_argument('--rate', type=float, default=5.0, help="Maximum number of requests per second")
+    parser.add_argument('--save-pages', help="Directory to save the fetched pages in for biorxiv_stub_server.py")
+    args = parser.parse_args()
+
+    scrape_articles(start_date=datetime.date.today() - datetime.timedelta(args.days), base_url=args.base_url,
+            concurrency=args.concurrency, rate=args.rate, save_dir=args.save_pages)
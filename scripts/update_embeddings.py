@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+""" Fits the embedding index in DATA_DIR/embeddings or appends the embeddings of new articles
+
+usage: update_embeddings.py [--fit] [--components N] [--max-columns N] [--sample-size N]
+"""
+from __future__ import print_function
+
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import argparse
+
+import django
+
+django.setup()
+
+from papers.models import Article
+import papers.utils as utils
+from papers.embeddings import EmbeddingIndex
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit or update the embedding index")
+    parser.add_argument('--fit', action='store_true', help="(Re)fit the truncated SVD and recompute all embeddings")
+    parser.add_argument('--components', type=int, default=128, help="Number of components of a new fit")
+    parser.add_argument('--max-columns', type=int, default=2**16, help="Number of most frequent feature columns used by a new fit")
+    parser.add_argument('--sample-size', type=int, default=100000, help="Number of articles a new fit is computed on")
+    args = parser.parse_args()
+
+    index = EmbeddingIndex()
+    if args.fit:
+        print("Fitting embedding index in %s..."%index.path)
+        article_ids = utils.get_article_ids(Article.objects.filter(featurevector__isnull=False).order_by('id'))
+        variance = index.fit(article_ids, n_components=args.components, max_columns=args.max_columns, sample_size=args.sample_size)
+        print("%i components explain %.1f%% of the variance"%(index.nb_components, 100*variance))
+    elif not index.exists():
+        print("No embedding index in %s, nothing to update (fit one with --fit)"%index.path)
+        sys.exit(0)
+
+    print("Projecting new feature vectors...")
+    count = index.sync()
+    print("Added %i embeddings, the index holds %i articles"%(count, len(index)))
@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+""" Updates the memory-mapped feature matrix snapshot in DATA_DIR/features
+
+usage: update_feature_snapshot.py [--rebuild] [--check]
+"""
+from __future__ import print_function
+
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir) 
+
+import argparse
+
+import django
+
+django.setup()
+
+from papers.feature_store import FeatureSnapshot, ColumnMap
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the feature matrix snapshot")
+    parser.add_argument('--rebuild', action='store_true', help="Recreate the snapshot from scratch")
+    parser.add_argument('--check', action='store_true', help="Compare the snapshot with the database")
+    args = parser.parse_args()
+
+    snapshot = FeatureSnapshot()
+    if args.rebuild:
+        print("Rebuilding feature snapshot in %s..."%snapshot.path)
+        count = snapshot.rebuild()
+    else:
+        print("Appending new feature vectors to snapshot in %s..."%snapshot.path)
+        count = snapshot.sync()
+    print("Added %i rows, snapshot holds %i articles"%(count, len(snapshot)))
+
+    columns = ColumnMap()
+    first_new = snapshot.indptr[len(snapshot.indptr)-1-count]
+    nb_new = columns.update(snapshot.indices[first_new:snapshot.indptr[-1]])
+    print("Added %i columns to the column map, %i of %i columns are active"%(nb_new, len(columns), len(columns.lookup)))
+
+    if args.check:
+        report = snapshot.check()
+        for key, ids in report.items():
+            print("%i articles %s"%(len(ids), key))
+        if any(len(ids) for ids in report.values()):
+            sys.exit(1)